@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Benchmark the SQLite storage profiles against a synthetic user database.
+
+Each profile runs in its own process, with DEVDZ_DB_PATH and DEVDZ_DB_PROFILE
+set before bot.database is imported. It seeds the users table and then times
+the real bot.database functions.
+
+Usage: python benchmark_storage.py [--users 100000] [--writes 2000] [--reads 5000]
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PROFILES = ("safe", "balanced", "fast")
+
+
+def seed_users(database, count):
+    """Insert `count` synthetic users in a single transaction"""
+    now = time.strftime("%Y-%m-%d %H:%M:%S")
+    rows = (
+        (user_id, f"user{user_id}", f"User {user_id}", user_id % 3 == 0, "2030-01-01", now, now)
+        for user_id in range(1, count + 1)
+    )
+    with database._pool.write() as cursor:
+        cursor.executemany("""
+            INSERT INTO users
+            (telegram_id, username, full_name, has_subscription, subscription_end, join_date, last_active)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+
+
+def run_profile(users, writes, reads):
+    """Benchmark the profile selected in the environment and print JSON"""
+    from bot import database
+
+    database.create_tables()
+    seed_users(database, users)
+
+    start = time.perf_counter()
+    for i in range(writes):
+        user_id = random.randint(1, users * 2)  # half updates, half inserts
+        if i % 4 == 0:
+            database.save_quiz_result(user_id, 1, 4, 5)
+        elif i % 4 == 1:
+            database.set_bot_setting(f"bench_{i % 10}", str(i))
+        else:
+            database.add_user(user_id, f"user{user_id}", f"User {user_id}")
+    write_elapsed = time.perf_counter() - start
+
+    latencies = []
+    for _ in range(reads):
+        user_id = random.randint(1, users)
+        start = time.perf_counter()
+        database.get_user(user_id)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+
+    print(json.dumps({
+        'writes_per_sec': round(writes / write_elapsed, 1),
+        'read_p50_ms': round(statistics.median(latencies), 4),
+        'read_p99_ms': round(latencies[int(len(latencies) * 0.99) - 1], 4),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--writes", type=int, default=2000)
+    parser.add_argument("--reads", type=int, default=5000)
+    parser.add_argument("--profile", choices=PROFILES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.profile:
+        run_profile(args.users, args.writes, args.reads)
+        return
+
+    print(f"📊 {args.users} users, {args.writes} single-commit writes, {args.reads} reads\n")
+    print(f"{'profile':<10} {'writes/s':>10} {'read p50 ms':>12} {'read p99 ms':>12}")
+    for profile in PROFILES:
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, DEVDZ_DB_PATH=os.path.join(tmp, "bench.db"), DEVDZ_DB_PROFILE=profile)
+            output = subprocess.run(
+                [sys.executable, __file__, "--profile", profile,
+                 "--users", str(args.users), "--writes", str(args.writes), "--reads", str(args.reads)],
+                env=env, capture_output=True, text=True, check=True,
+            ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{profile:<10} {result['writes_per_sec']:>10} {result['read_p50_ms']:>12} {result['read_p99_ms']:>12}")
+
+
+if __name__ == "__main__":
+    main()
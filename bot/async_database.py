@@ -0,0 +1,154 @@
+"""Awaitable access to bot.database for handlers and scheduled jobs.
+
+Every public function of bot.database has an async twin here with the same
+name and arguments. The sync function runs on a dedicated database executor,
+so the event loop keeps serving updates while SQLite reads or fsyncs. Scripts
+such as setup_admin.py and setup_payment.py keep calling bot.database directly.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from bot import database
+
+# One worker per pooled connection: readers run in parallel while writes queue
+# on the pool's single writer.
+_executor = ThreadPoolExecutor(max_workers=database.DB_READERS + 1, thread_name_prefix="devdz-db")
+
+
+async def run_db(func, *args, **kwargs):
+    """Run a sync database function on the database executor"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+async def run_atomic(func, *args, **kwargs):
+    """Run a sync function inside database.transaction() on the database executor.
+
+    Every bot.database call made by `func` lands in a single commit.
+    """
+    def unit_of_work():
+        with database.transaction():
+            return func(*args, **kwargs)
+    return await run_db(unit_of_work)
+
+
+def shutdown():
+    """Wait for queued database work, flush buffered activity and stop the executor"""
+    _executor.shutdown(wait=True)
+    database.flush_activity()
+
+
+def _awaitable(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_db(func, *args, **kwargs)
+    return wrapper
+
+
+get_pool_stats = _awaitable(database.get_pool_stats)
+create_tables = _awaitable(database.create_tables)
+create_indexes = _awaitable(database.create_indexes)
+migrate_database = _awaitable(database.migrate_database)
+
+# Users
+add_user = _awaitable(database.add_user)
+get_user = _awaitable(database.get_user)
+mark_user_unreachable = _awaitable(database.mark_user_unreachable)
+get_unreachable_users = _awaitable(database.get_unreachable_users)
+get_blocked_users_count = _awaitable(database.get_blocked_users_count)
+touch_user = _awaitable(database.touch_user)
+flush_activity = _awaitable(database.flush_activity)
+get_activity_stats = _awaitable(database.get_activity_stats)
+get_user_cache_stats = _awaitable(database.get_user_cache_stats)
+update_user_subscription = _awaitable(database.update_user_subscription)
+get_user_role = _awaitable(database.get_user_role)
+set_user_role = _awaitable(database.set_user_role)
+activate_subscription = _awaitable(database.activate_subscription)
+extend_subscription = _awaitable(database.extend_subscription)
+get_subscription_status = _awaitable(database.get_subscription_status)
+remove_user = _awaitable(database.remove_user)
+get_recent_users = _awaitable(database.get_recent_users)
+get_expired_users = _awaitable(database.get_expired_users)
+check_expired_subscriptions = _awaitable(database.check_expired_subscriptions)
+claim_expired_users = _awaitable(database.claim_expired_users)
+get_pending_expiry_cleanups = _awaitable(database.get_pending_expiry_cleanups)
+record_expiry_cleanup = _awaitable(database.record_expiry_cleanup)
+get_active_users = _awaitable(database.get_active_users)
+get_all_active_users = _awaitable(database.get_all_active_users)
+get_users_expiring_soon = _awaitable(database.get_users_expiring_soon)
+claim_due_reminders = _awaitable(database.claim_due_reminders)
+record_reminder = _awaitable(database.record_reminder)
+get_user_stats = _awaitable(database.get_user_stats)
+get_statistics = _awaitable(database.get_statistics)
+
+# Admins
+add_admin = _awaitable(database.add_admin)
+remove_admin = _awaitable(database.remove_admin)
+is_admin = _awaitable(database.is_admin)
+get_all_admins = _awaitable(database.get_all_admins)
+set_main_admin = _awaitable(database.set_main_admin)
+is_main_admin = _awaitable(database.is_main_admin)
+get_access_role = _awaitable(database.get_access_role)
+refresh_admins = _awaitable(database.refresh_admins)
+
+# Settings
+set_bot_setting = _awaitable(database.set_bot_setting)
+set_bot_settings = _awaitable(database.set_bot_settings)
+get_bot_setting = _awaitable(database.get_bot_setting)
+get_bot_settings = _awaitable(database.get_bot_settings)
+get_admin_username = _awaitable(database.get_admin_username)
+set_admin_username = _awaitable(database.set_admin_username)
+set_payment_info = _awaitable(database.set_payment_info)
+get_payment_info = _awaitable(database.get_payment_info)
+link_group = _awaitable(database.link_group)
+set_linked_group = _awaitable(database.set_linked_group)
+get_linked_group = _awaitable(database.get_linked_group)
+
+# Referrals
+add_referral = _awaitable(database.add_referral)
+get_user_referrals = _awaitable(database.get_user_referrals)
+get_referral_stats = _awaitable(database.get_referral_stats)
+
+# Payments
+add_payment_notification = _awaitable(database.add_payment_notification)
+create_payment_notification = _awaitable(database.create_payment_notification)
+get_pending_payments = _awaitable(database.get_pending_payments)
+get_pending_payment_notifications = _awaitable(database.get_pending_payment_notifications)
+approve_payment_notification = _awaitable(database.approve_payment_notification)
+reject_payment_notification = _awaitable(database.reject_payment_notification)
+approve_payment_notification_by_id = _awaitable(database.approve_payment_notification_by_id)
+approve_subscription_payment = _awaitable(database.approve_subscription_payment)
+reject_payment_notification_by_id = _awaitable(database.reject_payment_notification_by_id)
+get_pending_payment = _awaitable(database.get_pending_payment)
+get_payment_notification_by_user_id = _awaitable(database.get_payment_notification_by_user_id)
+cleanup_old_payments = _awaitable(database.cleanup_old_payments)
+get_payment_history = _awaitable(database.get_payment_history)
+get_user_payment_history = _awaitable(database.get_user_payment_history)
+
+# Quizzes
+save_quiz_result = _awaitable(database.save_quiz_result)
+save_quiz_attempt = _awaitable(database.save_quiz_attempt)
+get_quiz_question_stats = _awaitable(database.get_quiz_question_stats)
+get_quiz_results = _awaitable(database.get_quiz_results)
+get_quiz_stats = _awaitable(database.get_quiz_stats)
+has_completed_quiz = _awaitable(database.has_completed_quiz)
+
+# Broadcasts
+create_broadcast_job = _awaitable(database.create_broadcast_job)
+get_broadcast_job = _awaitable(database.get_broadcast_job)
+get_latest_broadcast_job = _awaitable(database.get_latest_broadcast_job)
+get_unfinished_broadcast_jobs = _awaitable(database.get_unfinished_broadcast_jobs)
+claim_broadcast_recipients = _awaitable(database.claim_broadcast_recipients)
+get_pending_deliveries = _awaitable(database.get_pending_deliveries)
+record_delivery = _awaitable(database.record_delivery)
+finish_broadcast_job = _awaitable(database.finish_broadcast_job)
+
+# Handler state
+load_persistence = _awaitable(database.load_persistence)
+save_persistence = _awaitable(database.save_persistence)
+
+# Inline button payloads
+store_callback_payload = _awaitable(database.store_callback_payload)
+get_callback_payload = _awaitable(database.get_callback_payload)
+prune_callback_payloads = _awaitable(database.prune_callback_payloads)
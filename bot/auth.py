@@ -0,0 +1,63 @@
+"""Caller roles, resolved once per update.
+
+The first check in an update looks the caller up with one get_access_role()
+call, answered from the in-memory admin registry and settings, and keeps the
+result on the context, which PTB shares between every handler of an update.
+Inline actions declare the role they need in the router's table; commands
+use @require_role.
+"""
+import functools
+import logging
+
+from bot.async_database import get_access_role
+
+logger = logging.getLogger(__name__)
+
+USER, ADMIN, MAIN_ADMIN = 'user', 'admin', 'main_admin'
+_RANK = {USER: 0, ADMIN: 1, MAIN_ADMIN: 2}
+
+CALLBACK_DENIED = {
+    ADMIN: "❌ غير مصرح لك بهذا الإجراء",
+    MAIN_ADMIN: "❌ هذا الإجراء متاح للمشرف الرئيسي فقط",
+}
+COMMAND_DENIED = {
+    ADMIN: "❌ هذا الأمر متاح للمشرفين فقط.",
+    MAIN_ADMIN: "❌ هذا الأمر متاح للمشرف الرئيسي فقط.",
+}
+
+
+async def get_role(update, context):
+    """The caller's role, looked up on first use in this update"""
+    role = getattr(context, 'caller_role', None)
+    if role is None:
+        user = update.effective_user
+        role = await get_access_role(user.id) if user else USER
+        context.caller_role = role
+    return role
+
+
+async def has_role(update, context, role):
+    return _RANK[await get_role(update, context)] >= _RANK[role]
+
+
+async def deny(update, role):
+    """Tell the caller the action needs `role`"""
+    user = update.effective_user
+    logger.warning(f"Denied {role} action to {user.id if user else 'unknown user'}")
+    if update.callback_query:
+        await update.callback_query.answer(CALLBACK_DENIED[role], show_alert=True)
+    elif update.effective_message:
+        await update.effective_message.reply_text(COMMAND_DENIED[role])
+
+
+def require_role(role):
+    """Decorator for handlers that only `role` and above may run"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            if not await has_role(update, context, role):
+                await deny(update, role)
+                return
+            return await handler(update, context)
+        return wrapper
+    return decorator
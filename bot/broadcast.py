@@ -0,0 +1,418 @@
+"""Rate-limited fan-out of one message to many chats.
+
+Telegram allows about 30 messages per second per bot, one per second to the
+same private chat and 20 per minute to the same group. broadcast() sends with
+a small pool of workers that share a global token bucket and a per-chat
+spacing table, backs off on RetryAfter, and reports progress while it runs.
+
+Broadcast jobs (start_job/run_job) persist every recipient's outcome in the
+database, page recipients in from the users table instead of loading them
+all, and are resumed by resume_jobs() after a restart. They run as
+bot.tasks background tasks, so /tasks shows their progress and an admin can
+cancel one with /cancel_task.
+"""
+import asyncio
+import logging
+import os
+import time
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TimedOut, NetworkError
+
+from bot.tasks import get_task_manager
+from bot.async_database import (
+    claim_broadcast_recipients, create_broadcast_job, finish_broadcast_job,
+    get_broadcast_job, get_pending_deliveries, get_unfinished_broadcast_jobs, record_delivery
+)
+
+logger = logging.getLogger(__name__)
+
+# Stay a little under Telegram's ~30 msg/s so interactive replies still get through
+GLOBAL_RATE = float(os.getenv("DEVDZ_BROADCAST_RATE", "25"))
+CONCURRENCY = int(os.getenv("DEVDZ_BROADCAST_CONCURRENCY", "10"))
+PRIVATE_CHAT_INTERVAL = 1.0  # seconds between messages to one user
+GROUP_CHAT_INTERVAL = 3.0    # 20 messages per minute to one group
+MAX_ATTEMPTS = 3
+PROGRESS_INTERVAL = 5.0      # seconds between progress callbacks
+PAGE_SIZE = int(os.getenv("DEVDZ_BROADCAST_PAGE_SIZE", "500"))
+
+# Outcomes passed to on_result
+SENT = 'sent'
+FAILED = 'failed'
+BLOCKED = 'blocked'
+
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts up to `capacity`"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Hold every sender back, e.g. after Telegram answered RetryAfter"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+# Shared by every broadcast so two concurrent fan-outs can't exceed the limit together
+_global_bucket = TokenBucket(GLOBAL_RATE)
+# chat_id -> earliest monotonic time the next message may go to that chat
+_chat_next_send = {}
+
+
+async def _wait_for_chat(chat_id):
+    now = time.monotonic()
+    if len(_chat_next_send) > 10000:
+        for stale in [key for key, at in _chat_next_send.items() if at < now]:
+            del _chat_next_send[stale]
+
+    interval = PRIVATE_CHAT_INTERVAL if chat_id > 0 else GROUP_CHAT_INTERVAL
+    send_at = max(now, _chat_next_send.get(chat_id, 0.0))
+    _chat_next_send[chat_id] = send_at + interval
+    if send_at > now:
+        await asyncio.sleep(send_at - now)
+
+
+def paginate(header, lines, footer="", limit=4096):
+    """Split `lines` into messages of at most `limit` characters.
+
+    The header goes on the first message and the footer on the last; a line
+    longer than the limit is cut.
+    """
+    pages = []
+    current = header
+    for line in lines:
+        line = line[:limit - 1] + "\n"
+        if len(current) + len(line) > limit:
+            pages.append(current)
+            current = ""
+        current += line
+    if len(current) + len(footer) > limit:
+        pages.append(current)
+        current = ""
+    pages.append(current + footer)
+    return pages
+
+
+def _retry_seconds(error):
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+
+def is_unreachable(error):
+    """True when the chat blocked the bot or no longer exists"""
+    if isinstance(error, Forbidden):
+        return True
+    return isinstance(error, BadRequest) and "chat not found" in str(error).lower()
+
+
+class BroadcastStats:
+    """Running counters for one broadcast"""
+
+    def __init__(self, total=None):
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retries = 0
+        self.started = time.monotonic()
+        self.finished = None
+        self.carried_over = 0  # chats already handled by an earlier run
+
+    @property
+    def done(self):
+        return self.sent + self.failed + self.blocked
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self):
+        """Messages handled per second so far"""
+        return (self.done - self.carried_over) / self.elapsed if self.elapsed > 0 else 0.0
+
+    def as_dict(self):
+        return {
+            'total': self.total,
+            'sent': self.sent,
+            'failed': self.failed,
+            'blocked': self.blocked,
+            'retries': self.retries,
+            'seconds': round(self.elapsed, 1),
+            'per_second': round(self.rate, 1),
+        }
+
+
+async def call_with_limits(call, chat_id=None, stats=None):
+    """Await `call()` under the global limit, retrying RetryAfter and network errors.
+
+    `call` builds a fresh coroutine per attempt. Pass `chat_id` to also keep
+    the per-chat message spacing.
+    """
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        await _global_bucket.acquire()
+        if chat_id is not None:
+            await _wait_for_chat(chat_id)
+        try:
+            return await call()
+        except RetryAfter as e:
+            seconds = _retry_seconds(e)
+            logger.warning(f"Flood control: pausing broadcasts for {seconds}s")
+            _global_bucket.pause(seconds)
+            if stats:
+                stats.retries += 1
+            if attempt == MAX_ATTEMPTS:
+                raise
+        except BadRequest:
+            raise  # a NetworkError subclass, but retrying can't fix it
+        except (TimedOut, NetworkError):
+            if attempt == MAX_ATTEMPTS:
+                raise
+            if stats:
+                stats.retries += 1
+            await asyncio.sleep(attempt)
+
+
+async def send_with_limits(bot, chat_id, text, stats=None, **kwargs):
+    """Send one message under the global and per-chat limits, retrying RetryAfter"""
+    return await call_with_limits(lambda: bot.send_message(chat_id, text, **kwargs), chat_id, stats)
+
+
+async def broadcast(bot, recipients, text, total=None, on_progress=None, on_result=None,
+                    concurrency=CONCURRENCY, stats=None, **kwargs):
+    """Send `text` to every chat ID in `recipients` and return BroadcastStats.
+
+    `recipients` may be a list or an async iterator. `on_progress(stats)` is
+    awaited every PROGRESS_INTERVAL seconds and `on_result(chat_id, outcome,
+    error)` after every chat, with outcome SENT, FAILED or BLOCKED. Extra
+    keyword arguments go to send_message. Pass `stats` to continue counting
+    from an earlier run.
+    """
+    if total is None and hasattr(recipients, '__len__'):
+        total = len(recipients)
+    stats = stats or BroadcastStats(total)
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def produce():
+        try:
+            if hasattr(recipients, '__aiter__'):
+                async for chat_id in recipients:
+                    await queue.put(chat_id)
+            else:
+                for chat_id in recipients:
+                    await queue.put(chat_id)
+        finally:
+            # Always release the workers, even if reading recipients failed
+            for _ in range(concurrency):
+                await queue.put(None)
+
+    async def work():
+        while (chat_id := await queue.get()) is not None:
+            error = None
+            try:
+                await send_with_limits(bot, chat_id, text, stats, **kwargs)
+                stats.sent += 1
+                outcome = SENT
+            except Exception as e:
+                error = e
+                if is_unreachable(e):
+                    stats.blocked += 1
+                    outcome = BLOCKED
+                else:
+                    stats.failed += 1
+                    outcome = FAILED
+                    logger.warning(f"Broadcast to {chat_id} failed: {e}")
+            if on_result:
+                try:
+                    await on_result(chat_id, outcome, error)
+                except Exception as e:
+                    logger.error(f"Broadcast result hook failed for {chat_id}: {e}")
+
+    async def report():
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            try:
+                await on_progress(stats)
+            except Exception as e:
+                logger.warning(f"Broadcast progress update failed: {e}")
+
+    reporter = asyncio.create_task(report()) if on_progress else None
+    try:
+        await asyncio.gather(produce(), *(work() for _ in range(concurrency)))
+    finally:
+        stats.finished = time.monotonic()
+        if reporter:
+            reporter.cancel()
+
+    logger.info(f"Broadcast finished: {stats.as_dict()}")
+    return stats
+
+
+async def job_recipients(job_id):
+    """Stream a job's recipients page by page, leftovers from an earlier run first"""
+    after_id = 0
+    while page := await get_pending_deliveries(job_id, after_id, PAGE_SIZE):
+        for chat_id in page:
+            yield chat_id
+        after_id = page[-1]
+    while page := await claim_broadcast_recipients(job_id, PAGE_SIZE):
+        for chat_id in page:
+            yield chat_id
+
+
+def _progress_text(stats, task=None):
+    text = (
+        f"🔄 **جاري إرسال الإعلان...**\n\n"
+        f"📤 تم: {stats.done}/{stats.total}\n"
+        f"⚡ السرعة: {stats.rate:.1f} رسالة/ثانية"
+    )
+    if task:
+        # Legacy Markdown would read the underscore as the start of italics
+        text += f"\n🆔 المهمة #{task.id} — للإلغاء: /cancel\\_task {task.id}"
+    return text
+
+
+def _report_text(job, stats):
+    counts = job['counts']
+    report = "✅ **تم إرسال الإعلان بنجاح!**\n\n"
+    report += "📊 **تقرير الإرسال:**\n"
+    if 'group_sent' in job['meta']:
+        if job['meta']['group_sent']:
+            report += "📱 تم الإرسال للمجموعة: ✅\n"
+        else:
+            report += "📱 تم الإرسال للمجموعة: ❌ (لا توجد مجموعة مربوطة أو خطأ)\n"
+    
+    report += f"👥 المشتركين النشطين: {job['total']}\n"
+    report += f"✅ تم الإرسال بنجاح: {counts.get(SENT, 0)}\n"
+    report += f"🚫 حظروا البوت: {counts.get(BLOCKED, 0)}\n"
+    report += f"❌ فشل الإرسال: {counts.get(FAILED, 0)}\n"
+    report += f"⏱️ المدة: {stats.elapsed:.0f} ثانية ({stats.rate:.1f} رسالة/ثانية)\n\n"
+    
+    if counts.get(FAILED):
+        report += "💡 **ملاحظة:** قد يكون سبب فشل الإرسال:\n"
+        report += "• المستخدم حذف حسابه\n"
+        report += "• مشاكل تقنية مؤقتة"
+    return report
+
+
+async def run_job(bot, job_id, task=None):
+    """Send a broadcast job to every recipient that has not had it yet.
+
+    With a bot.tasks BackgroundTask, progress is reported on it after every
+    recipient.
+    """
+    job = await get_broadcast_job(job_id)
+    if job['status'] != 'running':
+        return None
+    counts = job['counts']
+    stats = BroadcastStats(job['total'])
+    stats.sent = counts.get(SENT, 0)
+    stats.failed = counts.get(FAILED, 0)
+    stats.blocked = counts.get(BLOCKED, 0)
+    stats.carried_over = stats.done
+
+    async def save_result(chat_id, outcome, error):
+        await record_delivery(job_id, chat_id, outcome, str(error) if error else None)
+        if task:
+            task.report(stats.done, stats.total)
+
+    async def show_progress(stats):
+        await bot.edit_message_text(
+            _progress_text(stats, task), job['admin_chat_id'], job['status_message_id'], parse_mode='Markdown'
+        )
+    on_progress = show_progress if job['status_message_id'] else None
+
+    stats = await broadcast(
+        bot, job_recipients(job_id), job['text'], stats=stats,
+        on_progress=on_progress, on_result=save_result, parse_mode=job['parse_mode'],
+    )
+    await finish_broadcast_job(job_id)
+
+    if job['status_message_id']:
+        report = _report_text(await get_broadcast_job(job_id), stats)
+        try:
+            await bot.edit_message_text(report, job['admin_chat_id'], job['status_message_id'], parse_mode='Markdown')
+        except Exception:
+            await bot.send_message(job['admin_chat_id'], report, parse_mode='Markdown')
+    return stats
+
+
+async def _run_job_logged(bot, job_id):
+    try:
+        await run_job(bot, job_id)
+    except Exception as e:
+        # The job stays 'running' and is picked up again on the next start
+        logger.error(f"Broadcast job {job_id} stopped: {e}")
+
+
+async def _run_job_tracked(bot, job_id, task):
+    try:
+        return await run_job(bot, job_id, task)
+    except asyncio.CancelledError:
+        # Cancelled by an admin: don't resume it on the next start. At
+        # shutdown the job stays 'running' and resume_jobs() continues it.
+        if task.cancel_requested:
+            await finish_broadcast_job(job_id, 'cancelled')
+        raise
+
+
+async def _report_cancelled(bot, job_id, task):
+    job = await get_broadcast_job(job_id)
+    if task.status != 'cancelled' or not job['status_message_id']:
+        return
+    counts = job['counts']
+    text = (
+        "🛑 **تم إلغاء إرسال الإعلان**\n\n"
+        f"📤 تم الإرسال إلى {counts.get(SENT, 0)} من {job['total']} قبل الإلغاء."
+    )
+    await bot.edit_message_text(text, job['admin_chat_id'], job['status_message_id'], parse_mode='Markdown')
+
+
+def _track_job(application, job_id, kind):
+    """Run a broadcast job as a background task; returns the task, or None without a TaskManager"""
+    manager = get_task_manager()
+    if manager is None:
+        application.create_task(_run_job_logged(application.bot, job_id))
+        return None
+    bot = application.bot
+    return manager.start(
+        'broadcast', f"{kind} #{job_id}",
+        lambda task: _run_job_tracked(bot, job_id, task),
+        on_finish=lambda task: _report_cancelled(bot, job_id, task),
+    )
+
+
+async def start_job(application, kind, text, parse_mode=None, admin_chat_id=None, status_message_id=None, meta=None):
+    """Persist a broadcast job and send it in the background; returns the job ID"""
+    job_id = await create_broadcast_job(kind, text, parse_mode, admin_chat_id, status_message_id, meta)
+    _track_job(application, job_id, kind)
+    return job_id
+
+
+async def resume_jobs(application):
+    """Restart broadcast jobs that were interrupted by a shutdown or crash"""
+    job_ids = await get_unfinished_broadcast_jobs()
+    for job_id in job_ids:
+        logger.info(f"Resuming broadcast job {job_id}")
+        job = await get_broadcast_job(job_id)
+        _track_job(application, job_id, job['kind'])
+    return job_ids
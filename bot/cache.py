@@ -0,0 +1,147 @@
+"""Small in-process caches for hot database reads."""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from types import MappingProxyType
+
+logger = logging.getLogger(__name__)
+
+# Returned by TTLCache.get() on a miss, so None can be cached as a value
+MISSING = object()
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after `ttl` seconds.
+
+    Loaders take version() before reading the database and pass it to put(),
+    which drops the value if anything was invalidated in between. That keeps
+    a slow read from re-caching a row that a concurrent write just changed.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60.0, enabled=True):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.enabled = enabled
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        if not self.enabled:
+            return MISSING
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def version(self):
+        return self._version
+
+    def put(self, key, value, version=None):
+        if not self.enabled:
+            return
+        with self._lock:
+            if version is not None and version != self._version:
+                return
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._version += 1
+            self.invalidations += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self.invalidations += 1
+            self._data.clear()
+
+    def set_enabled(self, enabled):
+        """Turn the cache on or off; turning it off also empties it"""
+        self.enabled = enabled
+        if not enabled:
+            self.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+class SettingsStore:
+    """Immutable in-memory snapshot of a key/value table.
+
+    The snapshot is swapped atomically on reload(), so readers never see a
+    half-applied change. Callbacks registered with subscribe() run on the
+    reloading thread with (key, new_value) for every key whose value changed.
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self.reloads = 0
+
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self.reload()
+        return snapshot
+
+    def get(self, key, default=None):
+        return self.snapshot().get(key, default)
+
+    def reload(self):
+        """Load the table again and notify subscribers of changed keys"""
+        with self._lock:
+            old = self._snapshot
+            new = MappingProxyType(dict(self._loader()))
+            self._snapshot = new
+            self.reloads += 1
+
+        if old is not None:
+            for key in set(old) | set(new):
+                if old.get(key) != new.get(key):
+                    self._notify(key, new.get(key))
+        return new
+
+    def subscribe(self, key, callback):
+        """Call `callback(key, value)` whenever `key` changes"""
+        self._subscribers.setdefault(key, []).append(callback)
+
+    def unsubscribe(self, key, callback):
+        self._subscribers.get(key, []).remove(callback)
+
+    def _notify(self, key, value):
+        for callback in list(self._subscribers.get(key, ())):
+            try:
+                callback(key, value)
+            except Exception as e:
+                logger.error(f"Settings subscriber for {key} failed: {e}")
@@ -0,0 +1,130 @@
+"""Compact callback_data for inline buttons that carry arguments.
+
+A button's data is "~" followed by base64url (no padding) of:
+
+    header byte   version << 4 | flags
+    action code   one byte, from ACTION_CODES
+    arguments     each a varint tag: an int is zigzag(n) << 1, a string is
+                  len << 1 | 1 followed by its UTF-8 bytes
+
+A user ID plus a day count comes to about 12 characters, well under
+Telegram's 64-byte limit. Contexts too large for that go through
+encode_stored(): the arguments are kept in the callback_payloads table and
+the button only carries their row ID, with the STORED flag set.
+
+Codes are persisted on buttons in already-sent messages, so never reuse or
+renumber one; add new actions at the end.
+"""
+import base64
+
+from bot.async_database import store_callback_payload
+
+PREFIX = "~"
+VERSION = 1
+STORED = 0x01  # flag: the only argument is a callback_payloads row ID
+MAX_LENGTH = 64
+
+ACTION_CODES = {
+    'plan': 1,
+    'payment_completed': 2,
+    'approve_payment': 3,
+    'reject_payment': 4,
+    'manage_user': 5,
+    'extend_user': 6,
+    'extend_days': 7,
+    'renew_user': 8,
+    'renew_plan': 9,
+    'suspend_user': 10,
+    'promote_user': 11,
+    'demote_user': 12,
+    'delete_user': 13,
+    'confirm_delete': 14,
+    'quiz': 15,
+    'answer': 16,
+}
+ACTION_NAMES = {code: name for name, code in ACTION_CODES.items()}
+
+
+def _varint(value, out):
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift > 70:
+            raise ValueError("varint too long")
+
+
+def _pack(action, args, flags=0):
+    out = bytearray((VERSION << 4 | flags, ACTION_CODES[action]))
+    for arg in args:
+        if isinstance(arg, bool) or not isinstance(arg, (int, str)):
+            raise TypeError(f"callback arguments must be int or str, not {type(arg).__name__}")
+        if isinstance(arg, int):
+            _varint((arg << 1 if arg >= 0 else (-arg << 1) - 1) << 1, out)
+        else:
+            raw = arg.encode('utf-8')
+            _varint(len(raw) << 1 | 1, out)
+            out += raw
+    return PREFIX + base64.urlsafe_b64encode(bytes(out)).rstrip(b"=").decode('ascii')
+
+
+def encode(action, *args):
+    """callback_data for `action` with int/str arguments; ValueError if over 64 bytes"""
+    data = _pack(action, args)
+    if len(data) > MAX_LENGTH:
+        raise ValueError(f"callback data for {action!r} is {len(data)} bytes, use encode_stored()")
+    return data
+
+
+async def encode_stored(action, *args):
+    """callback_data for arguments of any size: they are stored and the button carries the row ID"""
+    data = _pack(action, args)
+    if len(data) <= MAX_LENGTH:
+        return data
+    payload_id = await store_callback_payload(action, list(args))
+    return _pack(action, (payload_id,), STORED)
+
+
+def is_encoded(data):
+    return data.startswith(PREFIX)
+
+
+def decode(data):
+    """Return (action, args, stored) for encoded callback_data.
+
+    With `stored` true, args is [payload_id] and the real arguments must be
+    loaded from callback_payloads. Raises ValueError on malformed data.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(data[len(PREFIX):] + "=" * (-(len(data) - len(PREFIX)) % 4))
+        header, code = raw[0], raw[1]
+        if header >> 4 != VERSION:
+            raise ValueError(f"unsupported callback data version {header >> 4}")
+        action = ACTION_NAMES[code]
+        args = []
+        pos = 2
+        while pos < len(raw):
+            tag, pos = _read_varint(raw, pos)
+            if tag & 1:
+                length = tag >> 1
+                if pos + length > len(raw):
+                    raise ValueError("truncated string argument")
+                args.append(raw[pos:pos + length].decode('utf-8'))
+                pos += length
+            else:
+                zigzag = tag >> 1
+                args.append(zigzag >> 1 if not zigzag & 1 else -((zigzag + 1) >> 1))
+    except (IndexError, KeyError, UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f"invalid callback data {data!r}: {e}") from None
+    return action, args, bool(header & STORED)
@@ -1,196 +1,388 @@
-import sqlite3
+import atexit
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
-conn = sqlite3.connect("devdz_bot.db", check_same_thread=False)
-cursor = conn.cursor()
+from bot import migrations
+from bot.cache import MISSING, SettingsStore, TTLCache
+from bot.db_pool import ConnectionPool
+
+DB_PATH = os.getenv("DEVDZ_DB_PATH", "devdz_bot.db")
+DB_READERS = int(os.getenv("DEVDZ_DB_READERS", "4"))
+# Storage profile from bot.db_pool.STORAGE_PROFILES: safe, balanced or fast
+DB_PROFILE = os.getenv("DEVDZ_DB_PROFILE", "balanced")
+# Share one COMMIT between writes arriving within this many milliseconds (0 = off)
+DB_GROUP_COMMIT_MS = float(os.getenv("DEVDZ_DB_GROUP_COMMIT_MS", "0"))
+
+# How often buffered last_active timestamps are written back, in seconds
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv("DEVDZ_ACTIVITY_FLUSH_INTERVAL", "30"))
+
+# get_user cache: DEVDZ_USER_CACHE=0 turns it off
+USER_CACHE_SIZE = int(os.getenv("DEVDZ_USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("DEVDZ_USER_CACHE_TTL", "60"))
+_user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL, enabled=os.getenv("DEVDZ_USER_CACHE", "1") != "0")
+
+# One writer plus DB_READERS reader connections; every query gets its own cursor
+_pool = ConnectionPool(DB_PATH, readers=DB_READERS, profile=DB_PROFILE, group_commit_ms=DB_GROUP_COMMIT_MS)
+
+def get_pool_stats():
+    """Get connection pool metrics (wait times, in-use counts, commits)"""
+    return _pool.stats()
+
+def get_user_cache_stats():
+    """Get get_user cache counters (hits, misses, evictions)"""
+    return _user_cache.stats()
+
+def set_user_cache_enabled(enabled):
+    """Turn the get_user cache on or off (off also empties it)"""
+    _user_cache.set_enabled(enabled)
+
+def _invalidate_user(telegram_id):
+    # Drop the row now and again after commit, so a reader that raced the
+    # write cannot leave the old row cached
+    _user_cache.invalidate(telegram_id)
+    _pool.after_write(lambda: _user_cache.invalidate(telegram_id))
+
+def _invalidate_all_users():
+    _user_cache.clear()
+    _pool.after_write(_user_cache.clear)
+
+@contextmanager
+def transaction():
+    """Run several database calls as one atomic unit of work.
+
+    Every function called inside the block joins the same transaction, which
+    commits once at the end or rolls back entirely if the block raises.
+    """
+    with _pool.write() as cursor:
+        yield cursor
 
 def create_tables():
     """Create all necessary tables if they don't exist"""
-    # Users table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            telegram_id INTEGER PRIMARY KEY,
-            username TEXT,
-            full_name TEXT,
-            has_subscription BOOLEAN DEFAULT 0,
-            subscription_end TEXT,
-            join_date TEXT,
-            last_active TEXT
-        )
-    """)
-    
-    # Admins table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS admins (
-            telegram_id INTEGER PRIMARY KEY,
-            full_name TEXT,
-            added_date TEXT
-        )
-    """)
-    
-    # Referrals table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS referrals (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            referrer_id INTEGER,
-            referred_id INTEGER,
-            date TEXT,
-            FOREIGN KEY (referrer_id) REFERENCES users(telegram_id),
-            FOREIGN KEY (referred_id) REFERENCES users(telegram_id)
-        )
-    """)
-    
-    # Quiz results table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS quiz_results (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id INTEGER,
-            quiz_id INTEGER,
-            score INTEGER,
-            total_questions INTEGER,
-            date TEXT,
-            FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
-        )
-    """)
-    
-    # Payment notifications table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS payment_notifications (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id INTEGER,
-            username TEXT,
-            full_name TEXT,
-            plan_name TEXT,
-            amount TEXT,
-            date TEXT,
-            status TEXT DEFAULT 'pending',
-            FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
-        )
-    """)
+    migrate_database(verbose=False)
+    # Warm the in-memory settings snapshot and admin registry
+    _settings.reload()
+    refresh_admins()
+
+def create_indexes():
+    """Create the managed secondary indexes and drop retired ones"""
+    with _pool.write() as cursor:
+        migrations.ensure_indexes(cursor)
+
+# last_active write-behind buffer: telegram_id -> newest activity timestamp.
+# A background thread writes it back every ACTIVITY_FLUSH_INTERVAL seconds.
+_activity = {}
+_activity_lock = threading.Lock()
+_activity_stats = {'touches': 0, 'flushes': 0, 'rows_flushed': 0, 'last_flush_ms': 0.0}
+_activity_thread = None
+
+def add_user(telegram_id, username, full_name, reachable=False):
+    """Add a new user or update existing user.
+
+    reachable=True means the user just messaged the bot privately, which
+    clears any earlier blocked mark.
+    """
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
-    # Bot settings table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS bot_settings (
-            key TEXT PRIMARY KEY,
-            value TEXT,
-            updated_at TEXT
-        )
-    """)
+    # One statement; an existing row is only rewritten when something changed
+    with _pool.write() as cursor:
+        cursor.execute("""
+            INSERT INTO users (telegram_id, username, full_name, join_date, last_active)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(telegram_id) DO UPDATE SET
+                username = excluded.username,
+                full_name = excluded.full_name,
+                blocked_at = CASE WHEN ? THEN NULL ELSE blocked_at END,
+                failure_count = CASE WHEN ? THEN 0 ELSE failure_count END
+            WHERE username IS NOT excluded.username OR full_name IS NOT excluded.full_name
+               OR (? AND blocked_at IS NOT NULL)
+        """, (telegram_id, username, full_name, now, now, reachable, reachable, reachable))
+        if cursor.rowcount:
+            _invalidate_user(telegram_id)
     
-    conn.commit()
+    touch_user(telegram_id, now)
+    return True
 
-def add_user(telegram_id, username, full_name):
-    """Add a new user or update existing user"""
+def mark_user_unreachable(telegram_id):
+    """Record that a user blocked the bot or deleted their account.
+
+    Blocked users are left out of every fan-out until they send /start again.
+    """
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with _pool.write() as cursor:
+        cursor.execute("""
+            UPDATE users SET blocked_at = COALESCE(blocked_at, ?), failure_count = failure_count + 1
+            WHERE telegram_id = ?
+        """, (now, telegram_id))
+        return cursor.rowcount > 0
+
+def get_unreachable_users(telegram_ids):
+    """Return which of the given users are marked as having blocked the bot"""
+    telegram_ids = list(telegram_ids)
+    if not telegram_ids:
+        return set()
+    with _pool.read() as cursor:
+        cursor.execute(f"""
+            SELECT telegram_id FROM users
+            WHERE telegram_id IN ({', '.join('?' * len(telegram_ids))}) AND blocked_at IS NOT NULL
+        """, telegram_ids)
+        return {row[0] for row in cursor.fetchall()}
+
+def get_blocked_users_count():
+    """Count users marked as having blocked the bot"""
+    with _pool.read() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM users WHERE blocked_at IS NOT NULL")
+        return cursor.fetchone()[0]
+
+def touch_user(telegram_id, timestamp=None):
+    """Record user activity; last_active is written back in batches"""
+    global _activity_thread
+    timestamp = timestamp or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with _activity_lock:
+        _activity[telegram_id] = timestamp
+        _activity_stats['touches'] += 1
+        if _activity_thread is None:
+            _activity_thread = threading.Thread(target=_flush_activity_loop, name="devdz-activity", daemon=True)
+            _activity_thread.start()
+
+def _flush_activity_loop():
+    while True:
+        time.sleep(ACTIVITY_FLUSH_INTERVAL)
+        try:
+            flush_activity()
+        except Exception as e:
+            print(f"❌ Failed to flush user activity: {e}")
+
+def flush_activity():
+    """Write buffered last_active timestamps in one executemany"""
+    with _activity_lock:
+        if not _activity:
+            return 0
+        pending = list(_activity.items())
+        _activity.clear()
     
-    cursor.execute("""
-        INSERT OR IGNORE INTO users 
-        (telegram_id, username, full_name, join_date, last_active) 
-        VALUES (?, ?, ?, ?, ?)
-    """, (telegram_id, username, full_name, now, now))
-    
-    # Update last active time if user already exists
-    cursor.execute("""
-        UPDATE users SET last_active = ?, username = ?, full_name = ?
-        WHERE telegram_id = ?
-    """, (now, username, full_name, telegram_id))
+    start = time.perf_counter()
+    try:
+        with _pool.write() as cursor:
+            cursor.executemany("""
+                UPDATE users SET last_active = ?
+                WHERE telegram_id = ? AND (last_active IS NULL OR last_active < ?)
+            """, ((timestamp, telegram_id, timestamp) for telegram_id, timestamp in pending))
+            for telegram_id, _ in pending:
+                _invalidate_user(telegram_id)
+    except Exception:
+        # Put the batch back unless newer activity arrived meanwhile
+        with _activity_lock:
+            for telegram_id, timestamp in pending:
+                _activity.setdefault(telegram_id, timestamp)
+        raise
     
-    conn.commit()
-    return True
+    with _activity_lock:
+        _activity_stats['flushes'] += 1
+        _activity_stats['rows_flushed'] += len(pending)
+        _activity_stats['last_flush_ms'] = round((time.perf_counter() - start) * 1000, 3)
+    return len(pending)
+
+def get_activity_stats():
+    """Get last_active buffer metrics (pending rows, flush counts)"""
+    with _activity_lock:
+        return dict(_activity_stats, pending=len(_activity), flush_interval=ACTIVITY_FLUSH_INTERVAL)
+
+atexit.register(flush_activity)
 
 def get_user(telegram_id):
     """Get user data by telegram ID"""
-    cursor.execute("""
-        SELECT telegram_id, username, full_name, has_subscription, subscription_end, join_date, last_active
-        FROM users WHERE telegram_id = ?
-    """, (telegram_id,))
-    return cursor.fetchone()
+    user = _user_cache.get(telegram_id)
+    if user is MISSING:
+        version = _user_cache.version()
+        with _pool.read() as cursor:
+            cursor.execute("""
+                SELECT telegram_id, username, full_name, has_subscription, subscription_end, join_date, last_active
+                FROM users WHERE telegram_id = ?
+            """, (telegram_id,))
+            user = cursor.fetchone()
+        # Rows read inside a write transaction may still be rolled back
+        if not _pool.in_write():
+            _user_cache.put(telegram_id, user, version)
+    
+    # Show activity that is still waiting in the write-behind buffer
+    pending = _activity.get(telegram_id)
+    if user and pending and (user[6] is None or pending > user[6]):
+        user = user[:6] + (pending,)
+    return user
 
 def update_user_subscription(telegram_id, has_subscription, subscription_end=None):
     """Update user subscription status"""
-    cursor.execute("""
-        UPDATE users SET has_subscription = ?, subscription_end = ?
-        WHERE telegram_id = ?
-    """, (has_subscription, subscription_end, telegram_id))
-    conn.commit()
-    return True
+    with _pool.write() as cursor:
+        cursor.execute("""
+            UPDATE users SET has_subscription = ?, subscription_end = ?
+            WHERE telegram_id = ?
+        """, (has_subscription, subscription_end, telegram_id))
+        _invalidate_user(telegram_id)
+        return True
 
 def add_admin(telegram_id, full_name="Admin"):
     """Add a new admin"""
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    cursor.execute("""
-        INSERT OR IGNORE INTO admins (telegram_id, full_name, added_date) VALUES (?, ?, ?)
-    """, (telegram_id, full_name, now))
-    
-    # Also set their role to admin in users table
-    cursor.execute("SELECT * FROM users WHERE telegram_id=?", (telegram_id,))
-    if cursor.fetchone():
-        cursor.execute("UPDATE users SET has_subscription=1 WHERE telegram_id=?", (telegram_id,))
-    else:
+    with _pool.write() as cursor:
         cursor.execute("""
-            INSERT INTO users (telegram_id, full_name, has_subscription, join_date, last_active)
-            VALUES (?, ?, 1, ?, ?)
-        """, (telegram_id, full_name, now, now))
+            INSERT OR IGNORE INTO admins (telegram_id, full_name, added_date) VALUES (?, ?, ?)
+        """, (telegram_id, full_name, now))
     
-    conn.commit()
-    return True
+        # Also set their role to admin in users table
+        cursor.execute("SELECT * FROM users WHERE telegram_id=?", (telegram_id,))
+        if cursor.fetchone():
+            cursor.execute("UPDATE users SET has_subscription=1 WHERE telegram_id=?", (telegram_id,))
+        else:
+            cursor.execute("""
+                INSERT INTO users (telegram_id, full_name, has_subscription, join_date, last_active)
+                VALUES (?, ?, 1, ?, ?)
+            """, (telegram_id, full_name, now, now))
+        _invalidate_user(telegram_id)
+        _reset_admins()
+    
+        return True
 
 def remove_admin(telegram_id):
     """Remove an admin"""
-    cursor.execute("DELETE FROM admins WHERE telegram_id = ?", (telegram_id,))
-    conn.commit()
-    return True
+    with _pool.write() as cursor:
+        cursor.execute("DELETE FROM admins WHERE telegram_id = ?", (telegram_id,))
+        _reset_admins()
+        return True
+
+# Admin registry: admin IDs loaded once and reloaded only after add_admin,
+# remove_admin, set_main_admin or remove_user change them
+_admin_lock = threading.Lock()
+_admin_registry = None
+_admin_version = 0
+
+def _load_admins():
+    global _admin_registry
+    registry = _admin_registry
+    if registry is not None:
+        return registry
+    
+    version = _admin_version
+    with _pool.read() as cursor:
+        cursor.execute("SELECT telegram_id FROM admins")
+        admin_ids = tuple(row[0] for row in cursor.fetchall())
+    registry = (admin_ids, frozenset(admin_ids))
+    
+    # Keep it unless a write changed the admins meanwhile or may still roll back
+    with _admin_lock:
+        if version == _admin_version and not _pool.in_write():
+            _admin_registry = registry
+    return registry
+
+def _reset_admins():
+    def reset():
+        global _admin_registry, _admin_version
+        with _admin_lock:
+            _admin_registry = None
+            _admin_version += 1
+    reset()
+    _pool.after_write(reset)
+
+def refresh_admins():
+    """Reload the admins and settings (main_admin_id) from the database.
+
+    Changes made by another process, such as setup_admin.py, are only seen by
+    a running bot after this, which /reload_admins calls, or a restart.
+    """
+    _reset_admins()
+    _settings.reload()
+    return _load_admins()[0]
 
 def is_admin(telegram_id):
     """Check if user is an admin"""
-    cursor.execute("SELECT 1 FROM admins WHERE telegram_id = ?", (telegram_id,))
-    return cursor.fetchone() is not None
+    return telegram_id in _load_admins()[1]
+
+def get_access_role(telegram_id):
+    """Return 'main_admin', 'admin' or 'user' from the cached admin registry and settings"""
+    if is_main_admin(telegram_id):
+        return 'main_admin'
+    return 'admin' if is_admin(telegram_id) else 'user'
 
 def get_all_admins():
     """Get all admin IDs"""
-    cursor.execute("SELECT telegram_id FROM admins")
-    return [row[0] for row in cursor.fetchall()]
+    return list(_load_admins()[0])
 
 def set_main_admin(telegram_id):
     """Set the main admin (bot owner)"""
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    cursor.execute("""
-        INSERT OR REPLACE INTO bot_settings (key, value, updated_at)
-        VALUES ('main_admin_id', ?, ?)
-    """, (str(telegram_id), now))
+    with _pool.write() as cursor:
+        cursor.execute("""
+            INSERT OR REPLACE INTO bot_settings (key, value, updated_at)
+            VALUES ('main_admin_id', ?, ?)
+        """, (str(telegram_id), now))
     
-    # Also add as regular admin if not already
-    cursor.execute("SELECT full_name FROM users WHERE telegram_id=?", (telegram_id,))
-    user_result = cursor.fetchone()
-    full_name = user_result[0] if user_result else "Main Admin"
+        # Also add as regular admin if not already
+        cursor.execute("SELECT full_name FROM users WHERE telegram_id=?", (telegram_id,))
+        user_result = cursor.fetchone()
+        full_name = user_result[0] if user_result else "Main Admin"
     
-    add_admin(telegram_id, full_name)
-    conn.commit()
-    return True
+        add_admin(telegram_id, full_name)
+        _settings_changed()
+        return True
 
 def is_main_admin(telegram_id):
     """Check if user is the main admin"""
-    cursor.execute("SELECT value FROM bot_settings WHERE key = 'main_admin_id'")
-    result = cursor.fetchone()
-    if result:
-        return str(telegram_id) == result[0]
-    return False
+    return str(telegram_id) == get_bot_setting('main_admin_id')
+
+def set_bot_settings(settings):
+    """Set several bot settings in one commit"""
+    with transaction():
+        for key, value in settings.items():
+            set_bot_setting(key, value)
+        return True
 
 def set_bot_setting(key, value):
     """Set a bot setting"""
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    cursor.execute("""
-        INSERT OR REPLACE INTO bot_settings (key, value, updated_at)
-        VALUES (?, ?, ?)
-    """, (key, value, now))
-    conn.commit()
-    return True
+    with _pool.write() as cursor:
+        cursor.execute("""
+            INSERT OR REPLACE INTO bot_settings (key, value, updated_at)
+            VALUES (?, ?, ?)
+        """, (key, value, now))
+        _settings_changed()
+        return True
+
+# bot_settings snapshot, reloaded after every committed settings write
+def _load_settings():
+    with _pool.read() as cursor:
+        cursor.execute("SELECT key, value FROM bot_settings")
+        return cursor.fetchall()
+
+_settings = SettingsStore(_load_settings)
+
+def _settings_changed():
+    # Reload once the write is committed, so a rollback never reaches the snapshot
+    _pool.after_write(_settings.reload)
 
 def get_bot_setting(key):
     """Get a bot setting"""
-    cursor.execute("SELECT value FROM bot_settings WHERE key = ?", (key,))
-    result = cursor.fetchone()
-    return result[0] if result else None
+    if _pool.in_write():
+        # Inside a transaction, see its own uncommitted settings
+        with _pool.read() as cursor:
+            cursor.execute("SELECT value FROM bot_settings WHERE key = ?", (key,))
+            result = cursor.fetchone()
+            return result[0] if result else None
+    return _settings.get(key)
+
+def get_bot_settings():
+    """Get an immutable snapshot of all bot settings"""
+    return _settings.snapshot()
+
+def subscribe_setting(key, callback):
+    """Call `callback(key, value)` after a committed change to a bot setting.
+
+    The callback runs on the database thread that made the change; async code
+    should hand the work to its event loop with loop.call_soon_threadsafe().
+    """
+    _settings.subscribe(key, callback)
 
 def get_admin_username():
     """Get admin username for contact"""
@@ -200,319 +392,415 @@ def add_referral(referrer_id, referred_id):
     """Add a new referral"""
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
-    # Check if referral already exists
-    cursor.execute("SELECT 1 FROM referrals WHERE referrer_id = ? AND referred_id = ?", 
-                  (referrer_id, referred_id))
-    if cursor.fetchone():
-        return False
+    with _pool.write() as cursor:
+        # Check if referral already exists
+        cursor.execute("SELECT 1 FROM referrals WHERE referrer_id = ? AND referred_id = ?", 
+                      (referrer_id, referred_id))
+        if cursor.fetchone():
+            return False
     
-    cursor.execute("""
-        INSERT INTO referrals (referrer_id, referred_id, date)
-        VALUES (?, ?, ?)
-    """, (referrer_id, referred_id, now))
-    conn.commit()
-    return True
+        cursor.execute("""
+            INSERT INTO referrals (referrer_id, referred_id, date)
+            VALUES (?, ?, ?)
+        """, (referrer_id, referred_id, now))
+        return True
 
 def get_user_referrals(telegram_id):
     """Get all referrals by a user"""
-    cursor.execute("""
-        SELECT r.referred_id, u.full_name, u.username, u.has_subscription
-        FROM referrals r
-        JOIN users u ON r.referred_id = u.telegram_id
-        WHERE r.referrer_id = ?
-    """, (telegram_id,))
-    return cursor.fetchall()
+    with _pool.read() as cursor:
+        cursor.execute("""
+            SELECT r.referred_id, u.full_name, u.username, u.has_subscription
+            FROM referrals r
+            JOIN users u ON r.referred_id = u.telegram_id
+            WHERE r.referrer_id = ?
+        """, (telegram_id,))
+        return cursor.fetchall()
 
 def get_referral_stats(telegram_id):
     """Get referral statistics for a user"""
-    cursor.execute("""
-        SELECT COUNT(*) FROM referrals WHERE referrer_id = ?
-    """, (telegram_id,))
-    total_referrals = cursor.fetchone()[0]
+    with _pool.read() as cursor:
+        cursor.execute("""
+            SELECT COUNT(*) FROM referrals WHERE referrer_id = ?
+        """, (telegram_id,))
+        total_referrals = cursor.fetchone()[0]
     
-    cursor.execute("""
-        SELECT COUNT(*) FROM referrals r
-        JOIN users u ON r.referred_id = u.telegram_id
-        WHERE r.referrer_id = ? AND u.has_subscription = 1
-    """, (telegram_id,))
-    active_referrals = cursor.fetchone()[0]
+        cursor.execute("""
+            SELECT COUNT(*) FROM referrals r
+            JOIN users u ON r.referred_id = u.telegram_id
+            WHERE r.referrer_id = ? AND u.has_subscription = 1
+        """, (telegram_id,))
+        active_referrals = cursor.fetchone()[0]
     
-    # Calculate free days (3 days per active referral)
-    free_days = active_referrals * 3
+        # Calculate free days (3 days per active referral)
+        free_days = active_referrals * 3
     
-    return {
-        'total_referrals': total_referrals,
-        'active_referrals': active_referrals,
-        'free_days': free_days
-    }
+        return {
+            'total_referrals': total_referrals,
+            'active_referrals': active_referrals,
+            'free_days': free_days
+        }
 
 def add_payment_notification(telegram_id, username, full_name, plan_name, amount):
     """Add a new payment notification"""
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    cursor.execute("""
-        INSERT INTO payment_notifications 
-        (telegram_id, username, full_name, plan_name, amount, date)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (telegram_id, username, full_name, plan_name, amount, now))
-    conn.commit()
-    return cursor.lastrowid
+    with _pool.write() as cursor:
+        cursor.execute("""
+            INSERT INTO payment_notifications 
+            (telegram_id, username, full_name, plan_name, amount, date)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (telegram_id, username, full_name, plan_name, amount, now))
+        return cursor.lastrowid
 
 def get_pending_payments():
     """Get all pending payment notifications"""
-    cursor.execute("""
-        SELECT id, telegram_id, username, full_name, plan_name, amount, date
-        FROM payment_notifications
-        WHERE status = 'pending'
-        ORDER BY date DESC
-    """)
-    return cursor.fetchall()
+    with _pool.read() as cursor:
+        cursor.execute("""
+            SELECT id, telegram_id, username, full_name, plan_name, amount, date
+            FROM payment_notifications
+            WHERE status = 'pending'
+            ORDER BY date DESC
+        """)
+        return cursor.fetchall()
 
 def approve_payment_notification(user_id):
     """Approve payment notification by user ID"""
-    cursor.execute("""
-        UPDATE payment_notifications
-        SET status = 'approved'
-        WHERE telegram_id = ? AND status = 'pending'
-    """, (user_id,))
-    conn.commit()
-    return cursor.rowcount > 0
+    with _pool.write() as cursor:
+        cursor.execute("""
+            UPDATE payment_notifications
+            SET status = 'approved'
+            WHERE telegram_id = ? AND status = 'pending'
+        """, (user_id,))
+        return cursor.rowcount > 0
 
 def reject_payment_notification(user_id):
     """Reject payment notification by user ID"""
-    cursor.execute("""
-        UPDATE payment_notifications
-        SET status = 'rejected'
-        WHERE telegram_id = ? AND status = 'pending'
-    """, (user_id,))
-    conn.commit()
-    return cursor.rowcount > 0
+    with _pool.write() as cursor:
+        cursor.execute("""
+            UPDATE payment_notifications
+            SET status = 'rejected'
+            WHERE telegram_id = ? AND status = 'pending'
+        """, (user_id,))
+        return cursor.rowcount > 0
 
 def link_group(group_id, group_title):
     """Link a Telegram group to the bot"""
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    cursor.execute("""
-        INSERT OR REPLACE INTO bot_settings (key, value, updated_at)
-        VALUES ('linked_group_id', ?, ?)
-    """, (str(group_id), now))
+    with _pool.write() as cursor:
+        cursor.execute("""
+            INSERT OR REPLACE INTO bot_settings (key, value, updated_at)
+            VALUES ('linked_group_id', ?, ?)
+        """, (str(group_id), now))
     
-    cursor.execute("""
-        INSERT OR REPLACE INTO bot_settings (key, value, updated_at)
-        VALUES ('linked_group_title', ?, ?)
-    """, (group_title, now))
+        cursor.execute("""
+            INSERT OR REPLACE INTO bot_settings (key, value, updated_at)
+            VALUES ('linked_group_title', ?, ?)
+        """, (group_title, now))
+        _settings_changed()
     
-    conn.commit()
-    return True
+        return True
 
 def get_linked_group():
     """Get the linked Telegram group"""
-    cursor.execute("SELECT value FROM bot_settings WHERE key = 'linked_group_id'")
-    group_id = cursor.fetchone()
-    
+    group_id = get_bot_setting('linked_group_id')
     if group_id:
-        return int(group_id[0])
+        return int(group_id)
     return None
 
 def save_quiz_result(telegram_id, quiz_id, score, total_questions):
     """Save a quiz result"""
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    cursor.execute("""
-        INSERT INTO quiz_results (telegram_id, quiz_id, score, total_questions, date)
-        VALUES (?, ?, ?, ?, ?)
-    """, (telegram_id, quiz_id, score, total_questions, now))
-    conn.commit()
-    return True
+    with _pool.write() as cursor:
+        cursor.execute("""
+            INSERT INTO quiz_results (telegram_id, quiz_id, score, total_questions, date)
+            VALUES (?, ?, ?, ?, ?)
+        """, (telegram_id, quiz_id, score, total_questions, now))
+        return True
+
+def save_quiz_attempt(telegram_id, quiz_id, answers, correct, once=False):
+    """Save a finished quiz and one row per answer in a single transaction.
+
+    `answers` are the selected option indexes and `correct` the right ones,
+    in question order. With `once`, nothing is written if the user already
+    has a result for this quiz; returns the new result id, or None then.
+    """
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    marks = [int(selected == right) for selected, right in zip(answers, correct)]
+    with _pool.write() as cursor:
+        if once and has_completed_quiz(telegram_id, quiz_id):
+            return None
+        cursor.execute("""
+            INSERT INTO quiz_results (telegram_id, quiz_id, score, total_questions, date)
+            VALUES (?, ?, ?, ?, ?)
+        """, (telegram_id, quiz_id, sum(marks), len(correct), now))
+        result_id = cursor.lastrowid
+        cursor.executemany("""
+            INSERT INTO quiz_answers (result_id, question_index, quiz_id, selected, is_correct)
+            VALUES (?, ?, ?, ?, ?)
+        """, [(result_id, index, quiz_id, selected, mark)
+              for index, (selected, mark) in enumerate(zip(answers, marks))])
+        return result_id
+
+def get_quiz_question_stats(quiz_id):
+    """Get (question_index, answers, correct answers) for each question of a quiz"""
+    with _pool.read() as cursor:
+        cursor.execute("""
+            SELECT question_index, COUNT(*), SUM(is_correct)
+            FROM quiz_answers
+            WHERE quiz_id = ?
+            GROUP BY question_index
+            ORDER BY question_index
+        """, (quiz_id,))
+        return cursor.fetchall()
 
 def get_quiz_results(telegram_id):
     """Get all quiz results for a user"""
-    cursor.execute("""
-        SELECT quiz_id, score, total_questions, date
-        FROM quiz_results
-        WHERE telegram_id = ?
-        ORDER BY date DESC
-    """, (telegram_id,))
-    return cursor.fetchall()
+    with _pool.read() as cursor:
+        cursor.execute("""
+            SELECT quiz_id, score, total_questions, date
+            FROM quiz_results
+            WHERE telegram_id = ?
+            ORDER BY date DESC
+        """, (telegram_id,))
+        return cursor.fetchall()
 
 def get_quiz_stats():
     """Get quiz statistics"""
-    # Get total quiz attempts
-    cursor.execute("SELECT COUNT(*) FROM quiz_results")
-    total_attempts = cursor.fetchone()[0]
+    with _pool.read() as cursor:
+        # Get total quiz attempts
+        cursor.execute("SELECT COUNT(*) FROM quiz_results")
+        total_attempts = cursor.fetchone()[0]
     
-    # Get average score
-    cursor.execute("SELECT AVG(score * 100.0 / total_questions) FROM quiz_results")
-    avg_score = cursor.fetchone()[0]
+        # Get average score
+        cursor.execute("SELECT AVG(score * 100.0 / total_questions) FROM quiz_results")
+        avg_score = cursor.fetchone()[0]
     
-    # Get quiz participation in the last week
-    week_ago = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
-    cursor.execute("""
-        SELECT COUNT(DISTINCT telegram_id) FROM quiz_results
-        WHERE date >= ?
-    """, (week_ago,))
-    weekly_participants = cursor.fetchone()[0]
+        # Get quiz participation in the last week
+        week_ago = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
+        cursor.execute("""
+            SELECT COUNT(DISTINCT telegram_id) FROM quiz_results
+            WHERE date >= ?
+        """, (week_ago,))
+        weekly_participants = cursor.fetchone()[0]
     
-    return {
-        'total_attempts': total_attempts or 0,
-        'avg_score': round(avg_score, 2) if avg_score else 0,
-        'weekly_participants': weekly_participants or 0
-    }
+        return {
+            'total_attempts': total_attempts or 0,
+            'avg_score': round(avg_score, 2) if avg_score else 0,
+            'weekly_participants': weekly_participants or 0
+        }
 
 def check_expired_subscriptions():
     """Check and update expired subscriptions"""
     today = datetime.now().strftime("%Y-%m-%d")
-    cursor.execute("""
-        UPDATE users
-        SET has_subscription = 0
-        WHERE has_subscription = 1
-        AND subscription_end < ?
-        AND subscription_end IS NOT NULL
-    """, (today,))
-    conn.commit()
-    return cursor.rowcount
+    with _pool.write() as cursor:
+        cursor.execute("""
+            UPDATE users
+            SET has_subscription = 0
+            WHERE has_subscription = 1
+            AND subscription_end < ?
+            AND subscription_end IS NOT NULL
+        """, (today,))
+        if cursor.rowcount:
+            _invalidate_all_users()
+        return cursor.rowcount
+
+def claim_expired_users():
+    """Turn off expired subscriptions and queue them for group cleanup.
+
+    Returns every cleanup still pending, including ones an interrupted run
+    left behind, as (telegram_id, full_name, username, subscription_end).
+    """
+    today = datetime.now().strftime("%Y-%m-%d")
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with _pool.write() as cursor:
+        cursor.execute("""
+            INSERT OR IGNORE INTO expiry_cleanups (telegram_id, subscription_end, status, claimed_at)
+            SELECT telegram_id, subscription_end, 'pending', ? FROM users
+            WHERE has_subscription = 1
+            AND subscription_end < ?
+            AND subscription_end IS NOT NULL
+        """, (now, today))
+        check_expired_subscriptions()
+        # Members who renewed since their row was queued (no linked group yet,
+        # or a run cut short) must not be kicked when it is replayed
+        cursor.execute("""
+            UPDATE expiry_cleanups SET status = 'renewed', processed_at = ?
+            WHERE status = 'pending'
+            AND EXISTS (
+                SELECT 1 FROM users u
+                WHERE u.telegram_id = expiry_cleanups.telegram_id
+                AND (u.has_subscription = 1 OR u.subscription_end IS NOT expiry_cleanups.subscription_end)
+            )
+        """, (now,))
+        return get_pending_expiry_cleanups()
+
+def get_pending_expiry_cleanups():
+    """Get expired members whose group cleanup has not finished and who have not renewed since"""
+    with _pool.read() as cursor:
+        cursor.execute("""
+            SELECT c.telegram_id, u.full_name, u.username, c.subscription_end
+            FROM expiry_cleanups c
+            LEFT JOIN users u ON u.telegram_id = c.telegram_id
+            WHERE c.status = 'pending'
+            AND (u.telegram_id IS NULL
+                 OR (u.has_subscription = 0 AND u.subscription_end = c.subscription_end))
+            ORDER BY c.telegram_id
+        """)
+        return cursor.fetchall()
+
+def record_expiry_cleanup(telegram_id, subscription_end, status, error=None):
+    """Checkpoint one member's cleanup as 'removed' or 'failed'"""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with _pool.write() as cursor:
+        cursor.execute("""
+            UPDATE expiry_cleanups SET status = ?, error = ?, processed_at = ?
+            WHERE telegram_id = ? AND subscription_end = ?
+        """, (status, error, now, telegram_id, subscription_end))
+        return True
 
 def get_active_users():
     """Get all active users (with subscription)"""
-    cursor.execute("""
-        SELECT telegram_id FROM users
-        WHERE has_subscription = 1
-    """)
-    return [row[0] for row in cursor.fetchall()]
+    with _pool.read() as cursor:
+        cursor.execute("""
+            SELECT telegram_id FROM users
+            WHERE has_subscription = 1
+        """)
+        return [row[0] for row in cursor.fetchall()]
 
 def get_user_stats():
     """Get user statistics"""
-    # Total users
-    cursor.execute("SELECT COUNT(*) FROM users")
-    total_users = cursor.fetchone()[0]
+    with _pool.read() as cursor:
+        # Total users
+        cursor.execute("SELECT COUNT(*) FROM users")
+        total_users = cursor.fetchone()[0]
     
-    # Active subscribers
-    cursor.execute("SELECT COUNT(*) FROM users WHERE has_subscription = 1")
-    active_subscribers = cursor.fetchone()[0]
+        # Active subscribers
+        cursor.execute("SELECT COUNT(*) FROM users WHERE has_subscription = 1")
+        active_subscribers = cursor.fetchone()[0]
     
-    # New users in the last week
-    week_ago = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
-    cursor.execute("""
-        SELECT COUNT(*) FROM users
-        WHERE join_date >= ?
-    """, (week_ago,))
-    new_users = cursor.fetchone()[0]
+        # New users in the last week
+        week_ago = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
+        cursor.execute("""
+            SELECT COUNT(*) FROM users
+            WHERE join_date >= ?
+        """, (week_ago,))
+        new_users = cursor.fetchone()[0]
     
-    # Pending payments
-    cursor.execute("SELECT COUNT(*) FROM payment_notifications WHERE status = 'pending'")
-    pending_payments = cursor.fetchone()[0]
+        # Pending payments
+        cursor.execute("SELECT COUNT(*) FROM payment_notifications WHERE status = 'pending'")
+        pending_payments = cursor.fetchone()[0]
     
-    return {
-        'total_users': total_users,
-        'active_subscribers': active_subscribers,
-        'new_users': new_users,
-        'pending_payments': pending_payments
-    }
-
-def migrate_database():
-    """Migrate existing database to new schema if needed"""
-    try:
-        # Check if we need to migrate from old schema
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [column[1] for column in cursor.fetchall()]
-        
-        # Check if old columns exist and migrate if needed
-        if 'rank' in columns and 'subscription_status' in columns:
-            print("🔄 Migrating database from old schema...")
-            
-            # Create backup of old data
-            cursor.execute("""
-                SELECT telegram_id, full_name, username, 
-                       CASE WHEN subscription_status = 'نشط' OR subscription_status = 'دائم' THEN 1 ELSE 0 END,
-                       subscription_end
-                FROM users
-            """)
-            old_users = cursor.fetchall()
-            
-            # Drop old tables
-            cursor.execute("DROP TABLE IF EXISTS users")
-            cursor.execute("DROP TABLE IF EXISTS subscription_requests")
-            
-            # Recreate tables with new schema
-            create_tables()
-            
-            # Migrate user data
-            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            for user_data in old_users:
-                telegram_id, full_name, username, has_subscription, subscription_end = user_data
-                cursor.execute("""
-                    INSERT OR IGNORE INTO users 
-                    (telegram_id, username, full_name, has_subscription, subscription_end, join_date, last_active)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                """, (telegram_id, username, full_name, has_subscription, subscription_end, now, now))
-            
-            conn.commit()
-            print("✅ Database migration completed successfully")
-        
-        # Check if admins table needs to be updated
-        cursor.execute("PRAGMA table_info(admins)")
-        admin_columns = [column[1] for column in cursor.fetchall()]
-        
-        if 'full_name' not in admin_columns:
-            print("🔄 Updating admins table schema...")
-            
-            # Backup existing admin data
-            cursor.execute("SELECT telegram_id FROM admins")
-            old_admins = cursor.fetchall()
-            
-            # Drop and recreate admins table
-            cursor.execute("DROP TABLE IF EXISTS admins")
-            cursor.execute("""
-                CREATE TABLE admins (
-                    telegram_id INTEGER PRIMARY KEY,
-                    full_name TEXT,
-                    added_date TEXT
-                )
-            """)
-            
-            # Restore admin data with default names
-            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            for admin_data in old_admins:
-                telegram_id = admin_data[0]
-                cursor.execute("""
-                    INSERT INTO admins (telegram_id, full_name, added_date)
-                    VALUES (?, 'Admin', ?)
-                """, (telegram_id, now))
-            
-            conn.commit()
-            print("✅ Admins table migration completed successfully")
-            
-    except Exception as e:
-        print(f"⚠️ Database migration error: {e}")
-        print("Creating fresh database...")
-        # If migration fails, just ensure tables exist
-        create_tables()
+        return {
+            'total_users': total_users,
+            'active_subscribers': active_subscribers,
+            'new_users': new_users,
+            'pending_payments': pending_payments
+        }
+
+def migrate_database(dry_run=False, verbose=True):
+    """Apply pending schema migrations and return the migration report.
+
+    With dry_run nothing is committed; the report holds the measured time and
+    rows touched for each pending step.
+    """
+    with _pool.write() as cursor:
+        report = migrations.migrate(cursor, dry_run=dry_run)
+    
+    if verbose and report['steps']:
+        action = "would take" if dry_run else "took"
+        print(f"🔄 Schema v{report['from_version']} → v{report['to_version']} {action} "
+              f"{report['seconds']:.3f}s, {report['rows_touched']} rows touched")
+        for step in report['steps']:
+            label = f"v{step['version']}" if step['version'] else "•"
+            print(f"   {label} {step['description']}: {step['seconds']:.3f}s, {step['rows_touched']} rows")
+    return report
 
 def get_users_expiring_soon(days=3):
     """Get users whose subscriptions are expiring within the specified number of days"""
     target_date = (datetime.now() + timedelta(days=days)).strftime("%Y-%m-%d")
-    cursor.execute("""
-        SELECT telegram_id, full_name, subscription_end 
-        FROM users 
-        WHERE has_subscription = 1 
-        AND subscription_end IS NOT NULL 
-        AND subscription_end <= ?
-        ORDER BY subscription_end ASC
-    """, (target_date,))
-    return cursor.fetchall()
-
-def get_all_active_users():
+    with _pool.read() as cursor:
+        cursor.execute("""
+            SELECT telegram_id, full_name, subscription_end 
+            FROM users 
+            WHERE has_subscription = 1 
+            AND subscription_end IS NOT NULL 
+            AND subscription_end <= ?
+            AND blocked_at IS NULL
+            ORDER BY subscription_end ASC
+        """, (target_date,))
+        return cursor.fetchall()
+
+def claim_due_reminders(offsets=(7, 3, 1)):
+    """Queue each expiry reminder that is due and not yet sent this subscription period.
+
+    `offsets` are days before subscription_end. A user gets the tightest
+    offset that still covers their remaining days, so someone with 2 days
+    left gets the 3-day reminder once and the 1-day reminder the day before.
+    Returns every pending reminder, including ones an interrupted run left
+    behind, as (telegram_id, full_name, subscription_end, reminder_kind).
+    """
+    today = datetime.now().date()
+    horizon = (today + timedelta(days=max(offsets))).strftime("%Y-%m-%d")
+    with _pool.write() as cursor:
+        cursor.execute("""
+            SELECT telegram_id, subscription_end
+            FROM users
+            WHERE has_subscription = 1
+            AND subscription_end >= ?
+            AND subscription_end <= ?
+            AND blocked_at IS NULL
+        """, (today.strftime("%Y-%m-%d"), horizon))
+        due = []
+        for telegram_id, subscription_end in cursor.fetchall():
+            try:
+                days_left = (datetime.strptime(subscription_end[:10], "%Y-%m-%d").date() - today).days
+            except ValueError:
+                continue
+            kind = min(offset for offset in offsets if offset >= days_left)
+            due.append((telegram_id, subscription_end, kind))
+
+        cursor.executemany("""
+            INSERT OR IGNORE INTO expiry_reminders (telegram_id, subscription_end, reminder_kind)
+            VALUES (?, ?, ?)
+        """, due)
+
+        cursor.execute("""
+            SELECT r.telegram_id, u.full_name, r.subscription_end, r.reminder_kind
+            FROM expiry_reminders r
+            JOIN users u ON u.telegram_id = r.telegram_id
+            WHERE r.status = 'pending'
+            AND r.subscription_end >= ?
+            ORDER BY r.subscription_end
+        """, (today.strftime("%Y-%m-%d"),))
+        return cursor.fetchall()
+
+def record_reminder(telegram_id, subscription_end, reminder_kind, status, error=None):
+    """Checkpoint one reminder as 'sent', 'failed' or 'blocked'"""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with _pool.write() as cursor:
+        cursor.execute("""
+            UPDATE expiry_reminders SET status = ?, error = ?, sent_at = ?
+            WHERE telegram_id = ? AND subscription_end = ? AND reminder_kind = ?
+        """, (status, error, now, telegram_id, subscription_end, reminder_kind))
+        return True
+
+def get_all_active_users(include_blocked=False):
     """Get all users with active subscriptions for notifications"""
-    cursor.execute("""
-        SELECT telegram_id FROM users 
-        WHERE has_subscription = 1
-    """)
-    return [row[0] for row in cursor.fetchall()]
+    with _pool.read() as cursor:
+        cursor.execute(f"""
+            SELECT telegram_id FROM users 
+            WHERE has_subscription = 1
+            {'' if include_blocked else 'AND blocked_at IS NULL'}
+        """)
+        return [row[0] for row in cursor.fetchall()]
 
 def has_completed_quiz(telegram_id, quiz_id):
     """Check if user has already completed a specific quiz"""
-    cursor.execute("""
-        SELECT 1 FROM quiz_results 
-        WHERE telegram_id = ? AND quiz_id = ?
-    """, (telegram_id, quiz_id))
-    return cursor.fetchone() is not None
+    with _pool.read() as cursor:
+        cursor.execute("""
+            SELECT 1 FROM quiz_results 
+            WHERE telegram_id = ? AND quiz_id = ?
+        """, (telegram_id, quiz_id))
+        return cursor.fetchone() is not None
 
 def get_user_role(telegram_id):
     """Get user role (for compatibility with old code)"""
@@ -540,18 +828,20 @@ def activate_subscription(telegram_id, plan="monthly"):
 
 def extend_subscription(telegram_id, days=10):
     """Extend user subscription by specified number of days"""
-    user = get_user(telegram_id)
-    if user:
-        current_end = user[4]  # subscription_end
-        if current_end:
-            end_date = datetime.strptime(current_end, "%Y-%m-%d")
-        else:
-            end_date = datetime.now()
-        
-        new_end = end_date + timedelta(days=days)
-        update_user_subscription(telegram_id, True, new_end.strftime("%Y-%m-%d"))
-        return True
-    return False
+    # Read and update in one transaction so concurrent extensions don't race
+    with _pool.write():
+        user = get_user(telegram_id)
+        if user:
+            current_end = user[4]  # subscription_end
+            if current_end:
+                end_date = datetime.strptime(current_end, "%Y-%m-%d")
+            else:
+                end_date = datetime.now()
+            
+            new_end = end_date + timedelta(days=days)
+            update_user_subscription(telegram_id, True, new_end.strftime("%Y-%m-%d"))
+            return True
+        return False
 
 def get_subscription_status(telegram_id):
     """Get subscription status for a user"""
@@ -565,13 +855,19 @@ def get_subscription_status(telegram_id):
 
 def remove_user(telegram_id):
     """Remove a user and all related data"""
-    cursor.execute("DELETE FROM users WHERE telegram_id = ?", (telegram_id,))
-    cursor.execute("DELETE FROM quiz_results WHERE telegram_id = ?", (telegram_id,))
-    cursor.execute("DELETE FROM referrals WHERE referrer_id = ? OR referred_id = ?", (telegram_id, telegram_id))
-    cursor.execute("DELETE FROM payment_notifications WHERE telegram_id = ?", (telegram_id,))
-    cursor.execute("DELETE FROM admins WHERE telegram_id = ?", (telegram_id,))
-    conn.commit()
-    return True
+    with _pool.write() as cursor:
+        cursor.execute("DELETE FROM users WHERE telegram_id = ?", (telegram_id,))
+        cursor.execute("""
+            DELETE FROM quiz_answers
+            WHERE result_id IN (SELECT id FROM quiz_results WHERE telegram_id = ?)
+        """, (telegram_id,))
+        cursor.execute("DELETE FROM quiz_results WHERE telegram_id = ?", (telegram_id,))
+        cursor.execute("DELETE FROM referrals WHERE referrer_id = ? OR referred_id = ?", (telegram_id, telegram_id))
+        cursor.execute("DELETE FROM payment_notifications WHERE telegram_id = ?", (telegram_id,))
+        cursor.execute("DELETE FROM admins WHERE telegram_id = ?", (telegram_id,))
+        _invalidate_user(telegram_id)
+        _reset_admins()
+        return True
 
 def get_statistics():
     """Get comprehensive statistics (alias for get_user_stats for compatibility)"""
@@ -583,9 +879,7 @@ def set_admin_username(username):
 
 def set_payment_info(ccp_number, rip_number):
     """Set payment information"""
-    set_bot_setting('ccp_number', ccp_number)
-    set_bot_setting('rip_number', rip_number)
-    return True
+    return set_bot_settings({'ccp_number': ccp_number, 'rip_number': rip_number})
 
 def get_payment_info():
     """Get payment information"""
@@ -599,13 +893,26 @@ def set_linked_group(group_id, group_title):
 
 def get_recent_users(limit=10):
     """Get recently registered users"""
-    cursor.execute("""
-        SELECT telegram_id, full_name, username, has_subscription, subscription_end, join_date
-        FROM users
-        ORDER BY join_date DESC
-        LIMIT ?
-    """, (limit,))
-    return cursor.fetchall()
+    with _pool.read() as cursor:
+        cursor.execute("""
+            SELECT telegram_id, full_name, username, has_subscription, subscription_end, join_date
+            FROM users
+            ORDER BY join_date DESC
+            LIMIT ?
+        """, (limit,))
+        return cursor.fetchall()
+
+def get_expired_users(limit=10):
+    """Get users whose subscription has ended, most recent first"""
+    with _pool.read() as cursor:
+        cursor.execute("""
+            SELECT telegram_id, username, full_name, subscription_end, join_date
+            FROM users
+            WHERE has_subscription = 0 AND subscription_end IS NOT NULL
+            ORDER BY subscription_end DESC
+            LIMIT ?
+        """, (limit,))
+        return cursor.fetchall()
 
 def create_payment_notification(telegram_id, full_name, username, plan_type, amount):
     """Create payment notification (alias for add_payment_notification for compatibility)"""
@@ -617,66 +924,243 @@ def get_pending_payment_notifications():
 
 def approve_payment_notification_by_id(notification_id):
     """Approve payment notification by notification ID"""
-    cursor.execute("""
-        UPDATE payment_notifications 
-        SET status = 'approved'
-        WHERE id = ? AND status = 'pending'
-    """, (notification_id,))
-    conn.commit()
-    return cursor.rowcount > 0
+    with _pool.write() as cursor:
+        cursor.execute("""
+            UPDATE payment_notifications 
+            SET status = 'approved'
+            WHERE id = ? AND status = 'pending'
+        """, (notification_id,))
+        return cursor.rowcount > 0
+
+def approve_subscription_payment(notification_id, telegram_id, subscription_end):
+    """Approve a pending payment and activate the subscription in one commit"""
+    with transaction():
+        if not approve_payment_notification_by_id(notification_id):
+            return False  # already approved or rejected by another admin
+        update_user_subscription(telegram_id, True, subscription_end)
+        return True
 
 def reject_payment_notification_by_id(notification_id):
     """Reject payment notification by notification ID"""
-    cursor.execute("""
-        UPDATE payment_notifications 
-        SET status = 'rejected'
-        WHERE id = ? AND status = 'pending'
-    """, (notification_id,))
-    conn.commit()
-    return cursor.rowcount > 0
+    with _pool.write() as cursor:
+        cursor.execute("""
+            UPDATE payment_notifications 
+            SET status = 'rejected'
+            WHERE id = ? AND status = 'pending'
+        """, (notification_id,))
+        return cursor.rowcount > 0
+
+def get_pending_payment(notification_id):
+    """Get a payment notification by ID if it is still pending"""
+    with _pool.read() as cursor:
+        cursor.execute("""
+            SELECT id, telegram_id, username, full_name, plan_name, amount, date
+            FROM payment_notifications
+            WHERE id = ? AND status = 'pending'
+        """, (notification_id,))
+        return cursor.fetchone()
 
 def get_payment_notification_by_user_id(user_id):
     """Get pending payment notification by user ID"""
-    cursor.execute("""
-        SELECT id, telegram_id, username, full_name, plan_name, amount, date
-        FROM payment_notifications
-        WHERE telegram_id = ? AND status = 'pending'
-        ORDER BY date DESC
-        LIMIT 1
-    """, (user_id,))
-    return cursor.fetchone()
+    with _pool.read() as cursor:
+        cursor.execute("""
+            SELECT id, telegram_id, username, full_name, plan_name, amount, date
+            FROM payment_notifications
+            WHERE telegram_id = ? AND status = 'pending'
+            ORDER BY date DESC
+            LIMIT 1
+        """, (user_id,))
+        return cursor.fetchone()
 
 def cleanup_old_payments(days_old=30):
     """Clean up old processed payment notifications"""
     cutoff_date = (datetime.now() - timedelta(days=days_old)).strftime("%Y-%m-%d")
-    cursor.execute("""
-        DELETE FROM payment_notifications 
-        WHERE status IN ('approved', 'rejected') 
-        AND date < ?
-    """, (cutoff_date,))
-    conn.commit()
-    return cursor.rowcount
+    with _pool.write() as cursor:
+        cursor.execute("""
+            DELETE FROM payment_notifications 
+            WHERE status IN ('approved', 'rejected') 
+            AND date < ?
+        """, (cutoff_date,))
+        return cursor.rowcount
 
 def get_payment_history(limit=50):
     """Get payment history (approved and rejected)"""
-    cursor.execute("""
-        SELECT id, telegram_id, username, full_name, plan_name, amount, date, status
-        FROM payment_notifications
-        WHERE status IN ('approved', 'rejected')
-        ORDER BY date DESC
-        LIMIT ?
-    """, (limit,))
-    return cursor.fetchall()
+    with _pool.read() as cursor:
+        cursor.execute("""
+            SELECT id, telegram_id, username, full_name, plan_name, amount, date, status
+            FROM payment_notifications
+            WHERE status IN ('approved', 'rejected')
+            ORDER BY date DESC
+            LIMIT ?
+        """, (limit,))
+        return cursor.fetchall()
 
 def get_user_payment_history(user_id):
     """Get payment history for a specific user"""
-    cursor.execute("""
-        SELECT id, plan_name, amount, date, status
-        FROM payment_notifications
-        WHERE telegram_id = ?
-        ORDER BY date DESC
-    """, (user_id,))
-    return cursor.fetchall()
-
-# Initialize database
-create_tables()
+    with _pool.read() as cursor:
+        cursor.execute("""
+            SELECT id, plan_name, amount, date, status
+            FROM payment_notifications
+            WHERE telegram_id = ?
+            ORDER BY date DESC
+        """, (user_id,))
+        return cursor.fetchall()
+
+# Broadcast jobs: one row per fan-out plus one delivery row per recipient, so an
+# interrupted broadcast resumes without sending to anyone twice
+BROADCAST_AUDIENCE = "has_subscription = 1 AND blocked_at IS NULL"
+
+def create_broadcast_job(kind, text, parse_mode=None, admin_chat_id=None, status_message_id=None, meta=None):
+    """Create a running broadcast job for all active subscribers and return its ID"""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with _pool.write() as cursor:
+        cursor.execute(f"SELECT COUNT(*) FROM users WHERE {BROADCAST_AUDIENCE}")
+        total = cursor.fetchone()[0]
+        cursor.execute("""
+            INSERT INTO broadcast_jobs
+            (kind, text, parse_mode, total, admin_chat_id, status_message_id, meta, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (kind, text, parse_mode, total, admin_chat_id, status_message_id,
+              json.dumps(meta) if meta else None, now))
+        return cursor.lastrowid
+
+def get_broadcast_job(job_id):
+    """Get a broadcast job as a dict with its delivery counts"""
+    with _pool.read() as cursor:
+        cursor.execute("""
+            SELECT id, kind, text, parse_mode, status, total, last_user_id,
+                   admin_chat_id, status_message_id, meta, created_at, finished_at
+            FROM broadcast_jobs WHERE id = ?
+        """, (job_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        job = dict(zip((
+            'id', 'kind', 'text', 'parse_mode', 'status', 'total', 'last_user_id',
+            'admin_chat_id', 'status_message_id', 'meta', 'created_at', 'finished_at'
+        ), row))
+        job['meta'] = json.loads(job['meta']) if job['meta'] else {}
+        
+        cursor.execute("""
+            SELECT status, COUNT(*) FROM broadcast_deliveries
+            WHERE job_id = ? GROUP BY status
+        """, (job_id,))
+        job['counts'] = dict(cursor.fetchall())
+        return job
+
+def get_latest_broadcast_job(kind):
+    """Get the most recent broadcast job of a kind, or None"""
+    with _pool.read() as cursor:
+        cursor.execute("SELECT MAX(id) FROM broadcast_jobs WHERE kind = ?", (kind,))
+        job_id = cursor.fetchone()[0]
+    return get_broadcast_job(job_id) if job_id else None
+
+def get_unfinished_broadcast_jobs():
+    """Get IDs of broadcast jobs that were interrupted before finishing"""
+    with _pool.read() as cursor:
+        cursor.execute("SELECT id FROM broadcast_jobs WHERE status = 'running' ORDER BY id")
+        return [row[0] for row in cursor.fetchall()]
+
+def claim_broadcast_recipients(job_id, limit=500):
+    """Add the next page of recipients to a job as pending deliveries and return their IDs"""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with _pool.write() as cursor:
+        cursor.execute("SELECT last_user_id FROM broadcast_jobs WHERE id = ?", (job_id,))
+        last_user_id = cursor.fetchone()[0]
+        # Keyset paging on the primary key: each page costs the same however far in
+        cursor.execute(f"""
+            SELECT telegram_id FROM users
+            WHERE telegram_id > ? AND {BROADCAST_AUDIENCE}
+            ORDER BY telegram_id LIMIT ?
+        """, (last_user_id, limit))
+        recipients = [row[0] for row in cursor.fetchall()]
+        if recipients:
+            cursor.executemany("""
+                INSERT OR IGNORE INTO broadcast_deliveries (job_id, telegram_id, status, updated_at)
+                VALUES (?, ?, 'pending', ?)
+            """, ((job_id, telegram_id, now) for telegram_id in recipients))
+            cursor.execute("UPDATE broadcast_jobs SET last_user_id = ? WHERE id = ?", (recipients[-1], job_id))
+        return recipients
+
+def get_pending_deliveries(job_id, after_id=0, limit=500):
+    """Get recipients claimed by a job but not yet sent to, in ID order"""
+    with _pool.read() as cursor:
+        cursor.execute("""
+            SELECT telegram_id FROM broadcast_deliveries
+            WHERE job_id = ? AND telegram_id > ? AND status = 'pending'
+            ORDER BY telegram_id LIMIT ?
+        """, (job_id, after_id, limit))
+        return [row[0] for row in cursor.fetchall()]
+
+def record_delivery(job_id, telegram_id, status, error=None):
+    """Record the outcome (sent/failed/blocked) of one broadcast delivery"""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with _pool.write() as cursor:
+        cursor.execute("""
+            UPDATE broadcast_deliveries SET status = ?, error = ?, updated_at = ?
+            WHERE job_id = ? AND telegram_id = ?
+        """, (status, error, now, job_id, telegram_id))
+        if status == 'blocked':
+            mark_user_unreachable(telegram_id)
+        return True
+
+def finish_broadcast_job(job_id, status='done'):
+    """Mark a broadcast job as finished"""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with _pool.write() as cursor:
+        cursor.execute("""
+            UPDATE broadcast_jobs SET status = ?, finished_at = ? WHERE id = ?
+        """, (status, now, job_id))
+        return True
+
+# Handler state for bot.persistence: pickled user_data/chat_data/bot_data
+# entries, one row each so only the entries that changed are rewritten
+
+def load_persistence(kind):
+    """Get every (key, value) stored under `kind`"""
+    with _pool.read() as cursor:
+        cursor.execute("SELECT key, value FROM bot_persistence WHERE kind = ?", (kind,))
+        return cursor.fetchall()
+
+def save_persistence(rows):
+    """Write (kind, key, value) rows in one transaction; a None value deletes the row"""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with _pool.write() as cursor:
+        cursor.executemany("""
+            INSERT INTO bot_persistence (kind, key, value, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(kind, key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+        """, [(kind, key, value, now) for kind, key, value in rows if value is not None])
+        cursor.executemany(
+            "DELETE FROM bot_persistence WHERE kind = ? AND key = ?",
+            [(kind, key) for kind, key, value in rows if value is None],
+        )
+        return len(rows)
+
+# Arguments of inline buttons too large for callback_data (bot.callback_codec)
+
+def store_callback_payload(action, args):
+    """Store button arguments and return the row ID the button will carry"""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with _pool.write() as cursor:
+        cursor.execute(
+            "INSERT INTO callback_payloads (action, args, created_at) VALUES (?, ?, ?)",
+            (action, json.dumps(args), now),
+        )
+        return cursor.lastrowid
+
+def get_callback_payload(payload_id, action):
+    """Get stored button arguments, or None if pruned or stored for another action"""
+    with _pool.read() as cursor:
+        cursor.execute(
+            "SELECT args FROM callback_payloads WHERE id = ? AND action = ?",
+            (payload_id, action),
+        )
+        row = cursor.fetchone()
+        return json.loads(row[0]) if row else None
+
+def prune_callback_payloads(days=30):
+    """Delete stored button arguments older than `days`"""
+    cutoff = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+    with _pool.write() as cursor:
+        cursor.execute("DELETE FROM callback_payloads WHERE created_at < ?", (cutoff,))
+        return cursor.rowcount
@@ -0,0 +1,311 @@
+"""Bounded SQLite connection pool: one writer and a set of readers.
+
+Readers run in autocommit mode; with a WAL storage profile they never block
+the writer and always see the last committed state. All writes go through the
+single writer connection inside an explicit BEGIN IMMEDIATE ... COMMIT.
+
+With group commit enabled, write blocks from different threads that arrive
+within a few milliseconds share one transaction: each block runs in its own
+savepoint (so a failing block only undoes itself) and every caller returns
+once the shared COMMIT, and its single fsync, has finished.
+"""
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Connection-level PRAGMAs per storage profile, applied in order to every
+# pooled connection when it is opened. journal_mode persists in the file;
+# the rest only live as long as the connection.
+STORAGE_PROFILES = {
+    # sqlite3 defaults: rollback journal and an fsync on every commit
+    'safe': (
+        ('journal_mode', 'DELETE'),
+        ('synchronous', 'FULL'),
+        ('busy_timeout', 5000),
+    ),
+    # WAL with fsync only at checkpoints; a power loss can drop the last
+    # commits but never corrupts the database
+    'balanced': (
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -16000),       # 16 MB page cache
+        ('mmap_size', 67108864),      # 64 MB memory-mapped reads
+        ('temp_store', 'MEMORY'),
+        ('busy_timeout', 5000),
+    ),
+    # For bulk imports and benchmarks; an OS crash can lose recent commits
+    'fast': (
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'OFF'),
+        ('cache_size', -65536),       # 64 MB page cache
+        ('mmap_size', 268435456),     # 256 MB memory-mapped reads
+        ('temp_store', 'MEMORY'),
+        ('busy_timeout', 5000),
+    ),
+}
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the pool timeout"""
+
+
+class _UsageStats:
+    """Acquisition counters for one side of the pool"""
+
+    def __init__(self):
+        self.acquisitions = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+
+    def acquired(self, waited):
+        self.acquisitions += 1
+        self.in_use += 1
+        self.max_in_use = max(self.max_in_use, self.in_use)
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def released(self):
+        self.in_use -= 1
+
+    def as_dict(self):
+        avg_wait = self.total_wait / self.acquisitions if self.acquisitions else 0.0
+        return {
+            'acquisitions': self.acquisitions,
+            'in_use': self.in_use,
+            'max_in_use': self.max_in_use,
+            'avg_wait_ms': round(avg_wait * 1000, 3),
+            'max_wait_ms': round(self.max_wait * 1000, 3),
+            'timeouts': self.timeouts,
+        }
+
+
+class _CommitBatch:
+    """Write blocks waiting on one shared COMMIT"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+        self.writes = 0
+
+
+class ConnectionPool:
+    """Hands out per-query cursors from a fixed set of SQLite connections"""
+
+    def __init__(self, path, readers=4, timeout=30.0, profile='balanced', group_commit_ms=0):
+        if profile not in STORAGE_PROFILES:
+            raise ValueError(f"Unknown storage profile {profile!r}; choose one of {', '.join(STORAGE_PROFILES)}")
+        self.path = path
+        self.profile = profile
+        self.size = readers
+        self.timeout = timeout
+        self._writer = self._connect()
+        self._writer_lock = threading.Lock()
+        self._local = threading.local()
+        self._readers = queue.LifoQueue()
+        for _ in range(readers):
+            self._readers.put(self._connect())
+        self._stats_lock = threading.Lock()
+        self._read_stats = _UsageStats()
+        self._write_stats = _UsageStats()
+        self.group_commit = group_commit_ms / 1000
+        self._batch = None
+        self._commits = 0
+        self._grouped_writes = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.timeout,
+            check_same_thread=False,
+            isolation_level=None,  # transactions are managed explicitly by write()
+        )
+        for name, value in STORAGE_PROFILES[self.profile]:
+            conn.execute(f"PRAGMA {name}={value}")
+        return conn
+
+    def _record(self, stats, waited):
+        with self._stats_lock:
+            stats.acquired(waited)
+
+    def _release(self, stats):
+        with self._stats_lock:
+            stats.released()
+
+    def _timed_out(self, stats, kind):
+        with self._stats_lock:
+            stats.timeouts += 1
+        raise PoolTimeout(f"No {kind} connection available after {self.timeout}s")
+
+    def _write_depth(self):
+        return getattr(self._local, 'depth', 0)
+
+    def in_write(self):
+        """True while the current thread is inside a write() block"""
+        return self._write_depth() > 0
+
+    @contextmanager
+    def read(self):
+        """Yield a cursor on a reader connection.
+
+        Inside a write() block on the same thread the writer connection is used
+        instead, so the caller sees its own uncommitted changes.
+        """
+        if self._write_depth():
+            cur = self._writer.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+            return
+
+        start = time.perf_counter()
+        try:
+            conn = self._readers.get(timeout=self.timeout)
+        except queue.Empty:
+            self._timed_out(self._read_stats, "reader")
+        self._record(self._read_stats, time.perf_counter() - start)
+        cur = conn.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+            self._readers.put(conn)
+            self._release(self._read_stats)
+
+    @contextmanager
+    def write(self):
+        """Yield a cursor inside a write transaction.
+
+        The outermost block commits on success and rolls back on error; nested
+        blocks on the same thread join the surrounding transaction.
+        """
+        depth = self._write_depth()
+        if depth:
+            self._local.depth = depth + 1
+            cur = self._writer.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+                self._local.depth = depth
+            return
+
+        start = time.perf_counter()
+        if not self._writer_lock.acquire(timeout=self.timeout):
+            self._timed_out(self._write_stats, "writer")
+        self._record(self._write_stats, time.perf_counter() - start)
+        self._local.depth = 1
+        self._local.after_write = []
+        cur = self._writer.cursor()
+        batch = None
+        leader = False
+        try:
+            if self.group_commit:
+                if self._batch is None:
+                    cur.execute("BEGIN IMMEDIATE")
+                    self._batch = _CommitBatch()
+                    leader = True
+                batch = self._batch
+                cur.execute("SAVEPOINT unit_of_work")
+                try:
+                    yield cur
+                except BaseException:
+                    cur.execute("ROLLBACK TO unit_of_work")
+                    cur.execute("RELEASE unit_of_work")
+                    raise
+                cur.execute("RELEASE unit_of_work")
+                batch.writes += 1
+            else:
+                cur.execute("BEGIN IMMEDIATE")
+                try:
+                    yield cur
+                except BaseException:
+                    self._writer.rollback()
+                    raise
+                self._writer.commit()
+                self._commits += 1
+        finally:
+            cur.close()
+            self._local.depth = 0
+            self._writer_lock.release()
+            self._release(self._write_stats)
+            callbacks, self._local.after_write = self._local.after_write, []
+            try:
+                if batch is not None:
+                    self._finish_batch(batch, leader)
+            finally:
+                for callback in callbacks:
+                    callback()
+
+    def after_write(self, callback):
+        """Call `callback` once the current write transaction has finished.
+
+        Used to invalidate in-memory caches only after the change is visible
+        to readers. Outside a write block the callback runs immediately.
+        """
+        if self._write_depth():
+            self._local.after_write.append(callback)
+        else:
+            callback()
+
+    def _finish_batch(self, batch, leader):
+        """Wait for the shared COMMIT; the thread that opened the batch issues it"""
+        if leader:
+            time.sleep(self.group_commit)
+            with self._writer_lock:
+                try:
+                    self._writer.commit()
+                except Exception as e:
+                    self._writer.rollback()
+                    batch.error = e
+                finally:
+                    self._batch = None
+                    self._commits += 1
+                    self._grouped_writes += batch.writes
+                    batch.done.set()
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+
+    def set_trace_callback(self, callback):
+        """Install a sqlite3 trace callback on every pooled connection"""
+        with self._writer_lock:
+            self._writer.set_trace_callback(callback)
+            idle = [self._readers.get(timeout=self.timeout) for _ in range(self.size)]
+            for conn in idle:
+                conn.set_trace_callback(callback)
+                self._readers.put(conn)
+
+    def stats(self):
+        """Return pool usage counters for sizing under load"""
+        with self._stats_lock:
+            return {
+                'profile': self.profile,
+                'readers': self.size,
+                'idle_readers': self._readers.qsize(),
+                'read': self._read_stats.as_dict(),
+                'write': self._write_stats.as_dict(),
+                'group_commit_ms': round(self.group_commit * 1000, 3),
+                'commits': self._commits,
+                'grouped_writes': self._grouped_writes,
+            }
+
+    def close(self):
+        """Close every connection in the pool"""
+        batch = self._batch
+        if batch is not None:
+            batch.done.wait(self.timeout)
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._writer_lock:
+            self._writer.close()
@@ -1,15 +1,20 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatMember
 from telegram.ext import ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ChatJoinRequestHandler
 from telegram.error import BadRequest, Forbidden
-from bot.database import (
+from bot.async_database import (
     add_user, get_user, update_user_subscription, is_admin, add_admin, 
     remove_admin, get_all_admins, add_payment_notification, 
     get_pending_payments, approve_payment_notification, reject_payment_notification,
     add_referral, get_user_referrals, get_referral_stats, set_bot_setting, get_bot_setting,
     link_group, get_linked_group, is_main_admin, set_main_admin, get_admin_username,
-    get_user_stats, get_quiz_stats
+    get_user_stats, get_quiz_stats, has_completed_quiz, save_quiz_attempt, get_quiz_question_stats,
+    refresh_admins
 )
-import json
+from bot import database
+from bot.quizzes import QuizSession, get_quiz_catalog
+from bot.router import CallbackRouter
+from bot.auth import ADMIN, MAIN_ADMIN, has_role, deny, require_role
+from bot.callback_codec import encode as encode_callback
 import random
 from datetime import datetime, timedelta
 import os
@@ -21,21 +26,61 @@ import asyncio
 
 logger = logging.getLogger(__name__)
 
-# Load quiz data
-def load_quiz(quiz_number):
-    try:
-        with open(f'quizzes/quiz{quiz_number}.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return None
+# The group handlers see joins from every chat the bot is in; they compare
+# against this copy of linked_group_id, which a settings subscription keeps
+# current, instead of going through the database executor per update
+_linked_group = None
+
+
+def _on_linked_group_changed(key, value):
+    # Runs on a database thread; rebinding a global needs no hand-off
+    global _linked_group
+    _linked_group = int(value) if value else None
+
+# Role each inline action needs, checked by the router before the handler
+# runs; actions not listed here are open to every user
+CALLBACK_ROLES = {
+    'approve': ADMIN,
+    'reject': ADMIN,
+    'approve_payment': ADMIN,
+    'reject_payment': ADMIN,
+    'admin_panel': ADMIN,
+    'admin_pending_payments': ADMIN,
+    'admin_stats': ADMIN,
+    'admin_users': ADMIN,
+    'admin_list_users': ADMIN,
+    'admin_active_users': ADMIN,
+    'admin_expired_users': ADMIN,
+    'admin_search_user': ADMIN,
+    'admin_requests': ADMIN,
+    'admin_members': ADMIN,
+    'admin_cleanup_group': ADMIN,
+    'confirm_cleanup_group': ADMIN,
+    'admin_announcements': ADMIN,
+    'create_announcement': ADMIN,
+    'announcement_stats': ADMIN,
+    'manage_user': ADMIN,
+    'extend_user': ADMIN,
+    'extend_days': ADMIN,
+    'renew_user': ADMIN,
+    'renew_plan': ADMIN,
+    'suspend_user': ADMIN,
+    'promote_user': MAIN_ADMIN,
+    'demote_user': MAIN_ADMIN,
+    'delete_user': MAIN_ADMIN,
+    'confirm_delete': MAIN_ADMIN,
+}
+
+# Every inline button goes through this router; see register_handlers
+callbacks = CallbackRouter(roles=CALLBACK_ROLES)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     chat = update.effective_chat
     
     try:
-        # Add user to database
-        add_user(user.id, user.username, user.first_name)
+        # Add user to database; a private /start also lifts an earlier blocked mark
+        await add_user(user.id, user.username, user.first_name, reachable=chat.type == 'private')
         
         # Check if it's a private chat
         if chat.type == 'private':
@@ -45,7 +90,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 try:
                     referrer_id = int(referral_code)
                     if referrer_id != user.id:  # Can't refer yourself
-                        add_referral(referrer_id, user.id)
+                        await add_referral(referrer_id, user.id)
                         
                         # Notify referrer
                         try:
@@ -60,7 +105,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     pass
             
             # Check if user is admin and show appropriate menu
-            if is_admin(user.id):
+            if await has_role(update, context, ADMIN):
                 keyboard = [
                     [InlineKeyboardButton("📚 الاشتراك", callback_data="subscribe")],
                     [InlineKeyboardButton("📊 حالة الاشتراك", callback_data="status")],
@@ -111,7 +156,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    admin_username = get_admin_username()
+    admin_username = await get_admin_username()
     admin_contact = f"@{admin_username}" if admin_username else "المشرف"
     
     help_text = f"""
@@ -195,840 +240,1038 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text(help_text, reply_markup=reply_markup, parse_mode='Markdown')
 
-async def subscription_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@callbacks.route("subscribe")
+async def subscribe_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    
     user = query.from_user
-    user_data = get_user(user.id)
+    user_data = await get_user(user.id)
     
-    if query.data == "subscribe":
-        if user_data and user_data[3]:  # has_subscription
-            await query.edit_message_text(
-                "✅ لديك اشتراك نشط بالفعل!\n"
-                f"📅 ينتهي في: {user_data[4]}\n\n"
-                "استخدم /quiz لحل الاختبارات الأسبوعية."
-            )
-            return
-        
-        keyboard = [
-            [InlineKeyboardButton("📅 شهري - 1500 دج", callback_data="plan_monthly")],
-            [InlineKeyboardButton("📅 ربع سنوي - 4000 دج", callback_data="plan_quarterly")],
-            [InlineKeyboardButton("📅 نصف سنوي - 7500 دج", callback_data="plan_semi_annual")],
-            [InlineKeyboardButton("📅 سنوي - 14000 دج", callback_data="plan_annual")],
-            [InlineKeyboardButton("🔙 رجوع", callback_data="back_to_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
+    if user_data and user_data[3]:  # has_subscription
         await query.edit_message_text(
-            "💳 اختر خطة الاشتراك المناسبة لك:\n\n"
-            "📅 **الخطط المتاحة:**\n"
-            "• شهري: 1500 دج (30 يوم)\n"
-            "• ربع سنوي: 4000 دج (90 يوم) - وفر 500 دج!\n"
-            "• نصف سنوي: 7500 دج (180 يوم) - وفر 1500 دج!\n"
-            "• سنوي: 14000 دج (365 يوم) - وفر 4000 دج!\n\n"
-            "🎁 **مميزات الاشتراك:**\n"
-            "✅ الوصول لجميع الدورات\n"
-            "✅ اختبارات أسبوعية\n"
-            "✅ مشاريع عملية\n"
-            "✅ دعم فني مباشر\n"
-            "✅ شهادات إتمام",
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
+            "✅ لديك اشتراك نشط بالفعل!\n"
+            f"📅 ينتهي في: {user_data[4]}\n\n"
+            "استخدم /quiz لحل الاختبارات الأسبوعية."
         )
-    
-    elif query.data.startswith("plan_"):
-        plan_type = query.data.replace("plan_", "")
-        plans = {
-            "monthly": {"name": "شهري", "price": "1500 دج", "days": 30},
-            "quarterly": {"name": "ربع سنوي", "price": "4000 دج", "days": 90},
-            "semi_annual": {"name": "نصف سنوي", "price": "7500 دج", "days": 180},
-            "annual": {"name": "سنوي", "price": "14000 دج", "days": 365}
-        }
-        
-        plan = plans[plan_type]
-        
-        keyboard = [
-            [InlineKeyboardButton("💰 تم الدفع", callback_data=f"payment_completed_{plan_type}")],
-            [InlineKeyboardButton("🔙 رجوع للخطط", callback_data="subscribe")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        # Get payment information from settings
-        ccp_number = get_bot_setting('ccp_number') or "غير محدد"
-        baridimob_number = get_bot_setting('baridimob_number') or "غير محدد"
-        baridimoney_number = get_bot_setting('baridimoney_number') or "غير محدد"
-        beneficiary_name = get_bot_setting('beneficiary_name') or "أكاديمية DevDZ"
+        return
 
-        await query.edit_message_text(
-            f"💳 **الخطة المختارة:** {plan['name']}\n"
-            f"💰 **السعر:** {plan['price']}\n"
-            f"📅 **المدة:** {plan['days']} يوم\n\n"
-            f"📱 **طرق الدفع:**\n"
-            f"• **CCP:** `{ccp_number}`\n"
-            f"• **Baridimob:** `{baridimob_number}`\n"
-            f"• **BaridiMoney:** `{baridimoney_number}`\n"
-            f"• **اسم المستفيد:** {beneficiary_name}\n\n"
-            f"📝 **تعليمات الدفع:**\n"
-            f"1. قم بتحويل المبلغ المطلوب إلى أحد الحسابات أعلاه\n"
-            f"2. احتفظ بإيصال التحويل (لقطة شاشة أو صورة)\n"
-            f"3. اضغط على 'تم الدفع' أدناه\n"
-            f"4. أرسل صورة الإيصال للمراجعة\n\n"
-            f"⚠️ **مهم:**\n"
-            f"• تأكد من صحة المبلغ المحول\n"
-            f"• احتفظ بإيصال التحويل\n"
-            f"• أرسل الإيصال مع رقم معرفك: `{user.id}`\n\n"
-            f"⏰ سيتم تفعيل اشتراكك خلال 24 ساعة من التأكيد.",
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
-        )
+    keyboard = [
+        [InlineKeyboardButton("📅 شهري - 1500 دج", callback_data=encode_callback("plan", "monthly"))],
+        [InlineKeyboardButton("📅 ربع سنوي - 4000 دج", callback_data=encode_callback("plan", "quarterly"))],
+        [InlineKeyboardButton("📅 نصف سنوي - 7500 دج", callback_data=encode_callback("plan", "semi_annual"))],
+        [InlineKeyboardButton("📅 سنوي - 14000 دج", callback_data=encode_callback("plan", "annual"))],
+        [InlineKeyboardButton("🔙 رجوع", callback_data="back_to_main")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await query.edit_message_text(
+        "💳 اختر خطة الاشتراك المناسبة لك:\n\n"
+        "📅 **الخطط المتاحة:**\n"
+        "• شهري: 1500 دج (30 يوم)\n"
+        "• ربع سنوي: 4000 دج (90 يوم) - وفر 500 دج!\n"
+        "• نصف سنوي: 7500 دج (180 يوم) - وفر 1500 دج!\n"
+        "• سنوي: 14000 دج (365 يوم) - وفر 4000 دج!\n\n"
+        "🎁 **مميزات الاشتراك:**\n"
+        "✅ الوصول لجميع الدورات\n"
+        "✅ اختبارات أسبوعية\n"
+        "✅ مشاريع عملية\n"
+        "✅ دعم فني مباشر\n"
+        "✅ شهادات إتمام",
+        reply_markup=reply_markup,
+        parse_mode='Markdown'
+    )
+
+@callbacks.route("plan")
+async def plan_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    user = query.from_user
     
-    elif query.data.startswith("payment_completed_"):
-        plan_type = query.data.replace("payment_completed_", "")
-        plans = {
-            "monthly": {"name": "شهري", "price": "1500 دج", "days": 30},
-            "quarterly": {"name": "ربع سنوي", "price": "4000 دج", "days": 90},
-            "semi_annual": {"name": "نصف سنوي", "price": "7500 دج", "days": 180},
-            "annual": {"name": "سنوي", "price": "14000 دج", "days": 365}
-        }
-        
-        plan = plans[plan_type]
-        
-        # Create payment notification for admin
-        add_payment_notification(user.id, user.username or "غير محدد", user.first_name, plan['name'], plan['price'])
-        
-        # Notify all admins
-        admins = get_all_admins()
-        admin_username = get_admin_username()
-        
-        for admin_id in admins:
-            try:
-                keyboard = [
-                    [InlineKeyboardButton("✅ قبول", callback_data=f"approve_{user.id}")],
-                    [InlineKeyboardButton("❌ رفض", callback_data=f"reject_{user.id}")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await context.bot.send_message(
-                    admin_id,
-                    f"💳 **طلب دفع جديد**\n\n"
-                    f"👤 **المستخدم:** {user.first_name}\n"
-                    f"🆔 **المعرف:** {user.id}\n"
-                    f"📱 **اليوزر:** @{user.username or 'غير محدد'}\n"
-                    f"📅 **الخطة:** {plan['name']}\n"
-                    f"💰 **المبلغ:** {plan['price']}\n"
-                    f"📅 **التاريخ:** {datetime.now().strftime('%Y-%m-%d %H:%M')}\n\n"
-                    f"⏳ في انتظار مراجعة الدفع...",
-                    reply_markup=reply_markup,
-                    parse_mode='Markdown'
-                )
-            except:
-                continue
-        
-        # Send confirmation to user with admin contact
-        contact_text = f"📞 **للتواصل المباشر:** @{admin_username}" if admin_username else "📞 تواصل مع الإدارة للتأكيد"
-        
-        await query.edit_message_text(
-            f"✅ **تم استلام طلب الدفع!**\n\n"
-            f"📋 **تفاصيل الطلب:**\n"
-            f"📅 الخطة: {plan['name']}\n"
-            f"💰 المبلغ: {plan['price']}\n"
-            f"📅 التاريخ: {datetime.now().strftime('%Y-%m-%d %H:%M')}\n\n"
-            f"⏳ **حالة الطلب:** قيد المراجعة\n\n"
-            f"📝 **الخطوات التالية:**\n"
-            f"1. أرسل صورة إيصال الدفع\n"
-            f"2. انتظر تأكيد الإدارة\n"
-            f"3. سيتم تفعيل اشتراكك خلال 24 ساعة\n\n"
-            f"{contact_text}\n"
-            f"💬 أرسل له صورة الإيصال مع رقم معرفك: `{user.id}`\n\n"
-            f"شكراً لثقتك في أكاديمية DevDZ! 🎓",
-            parse_mode='Markdown'
-        )
+    plan_type = "_".join(context.args)
+    plans = {
+        "monthly": {"name": "شهري", "price": "1500 دج", "days": 30},
+        "quarterly": {"name": "ربع سنوي", "price": "4000 دج", "days": 90},
+        "semi_annual": {"name": "نصف سنوي", "price": "7500 دج", "days": 180},
+        "annual": {"name": "سنوي", "price": "14000 دج", "days": 365}
+    }
+
+    plan = plans[plan_type]
+
+    keyboard = [
+        [InlineKeyboardButton("💰 تم الدفع", callback_data=encode_callback("payment_completed", plan_type))],
+        [InlineKeyboardButton("🔙 رجوع للخطط", callback_data="subscribe")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    # Get payment information from settings
+    from bot.async_database import get_bot_settings
+    settings = await get_bot_settings()
+    ccp_number = settings.get('ccp_number') or "غير محدد"
+    baridimob_number = settings.get('baridimob_number') or "غير محدد"
+    baridimoney_number = settings.get('baridimoney_number') or "غير محدد"
+    beneficiary_name = settings.get('beneficiary_name') or "أكاديمية DevDZ"
+
+    await query.edit_message_text(
+        f"💳 **الخطة المختارة:** {plan['name']}\n"
+        f"💰 **السعر:** {plan['price']}\n"
+        f"📅 **المدة:** {plan['days']} يوم\n\n"
+        f"📱 **طرق الدفع:**\n"
+        f"• **CCP:** `{ccp_number}`\n"
+        f"• **Baridimob:** `{baridimob_number}`\n"
+        f"• **BaridiMoney:** `{baridimoney_number}`\n"
+        f"• **اسم المستفيد:** {beneficiary_name}\n\n"
+        f"📝 **تعليمات الدفع:**\n"
+        f"1. قم بتحويل المبلغ المطلوب إلى أحد الحسابات أعلاه\n"
+        f"2. احتفظ بإيصال التحويل (لقطة شاشة أو صورة)\n"
+        f"3. اضغط على 'تم الدفع' أدناه\n"
+        f"4. أرسل صورة الإيصال للمراجعة\n\n"
+        f"⚠️ **مهم:**\n"
+        f"• تأكد من صحة المبلغ المحول\n"
+        f"• احتفظ بإيصال التحويل\n"
+        f"• أرسل الإيصال مع رقم معرفك: `{user.id}`\n\n"
+        f"⏰ سيتم تفعيل اشتراكك خلال 24 ساعة من التأكيد.",
+        reply_markup=reply_markup,
+        parse_mode='Markdown'
+    )
+
+@callbacks.route("payment_completed")
+async def payment_completed_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    user = query.from_user
     
-    elif query.data.startswith("approve_"):
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
+    plan_type = "_".join(context.args)
+    plans = {
+        "monthly": {"name": "شهري", "price": "1500 دج", "days": 30},
+        "quarterly": {"name": "ربع سنوي", "price": "4000 دج", "days": 90},
+        "semi_annual": {"name": "نصف سنوي", "price": "7500 دج", "days": 180},
+        "annual": {"name": "سنوي", "price": "14000 دج", "days": 365}
+    }
 
-        user_id = int(query.data.replace("approve_", ""))
+    plan = plans[plan_type]
 
-        # Get user payment notification
-        from bot.database import get_payment_notification_by_user_id
-        user_payment = get_payment_notification_by_user_id(user_id)
+    # Create payment notification for admin
+    notification_id = await add_payment_notification(user.id, user.username or "غير محدد", user.first_name, plan['name'], plan['price'])
 
-        if not user_payment:
-            await query.answer("❌ لم يتم العثور على طلب دفع معلق لهذا المستخدم", show_alert=True)
-            return
+    # Notify all admins, skipping any who blocked the bot
+    from bot.async_database import get_unreachable_users, mark_user_unreachable
+    from bot.broadcast import is_unreachable
+    admins = await get_all_admins()
+    blocked_admins = await get_unreachable_users(admins)
+    admin_username = await get_admin_username()
 
-        notification_id, telegram_id, username, full_name, plan_name, amount, date = user_payment
+    for admin_id in admins:
+        if admin_id in blocked_admins:
+            continue
+        try:
+            keyboard = [
+                [InlineKeyboardButton("✅ قبول", callback_data=encode_callback("approve_payment", notification_id))],
+                [InlineKeyboardButton("❌ رفض", callback_data=encode_callback("reject_payment", notification_id))]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
 
-        # Determine days based on plan
-        plan_days = {
-            "شهري": 30,
-            "ربع سنوي": 90,
-            "نصف سنوي": 180,
-            "سنوي": 365
-        }
+            await context.bot.send_message(
+                admin_id,
+                f"💳 **طلب دفع جديد**\n\n"
+                f"👤 **المستخدم:** {user.first_name}\n"
+                f"🆔 **المعرف:** {user.id}\n"
+                f"📱 **اليوزر:** @{user.username or 'غير محدد'}\n"
+                f"📅 **الخطة:** {plan['name']}\n"
+                f"💰 **المبلغ:** {plan['price']}\n"
+                f"📅 **التاريخ:** {datetime.now().strftime('%Y-%m-%d %H:%M')}\n\n"
+                f"⏳ في انتظار مراجعة الدفع...",
+                reply_markup=reply_markup,
+                parse_mode='Markdown'
+            )
+        except Exception as e:
+            if is_unreachable(e):
+                await mark_user_unreachable(admin_id)
+            continue
 
-        days = plan_days.get(plan_name, 30)
+    # Send confirmation to user with admin contact
+    contact_text = f"📞 **للتواصل المباشر:** @{admin_username}" if admin_username else "📞 تواصل مع الإدارة للتأكيد"
 
-        # Update user subscription
-        end_date = datetime.now() + timedelta(days=days)
-        update_user_subscription(user_id, True, end_date.strftime('%Y-%m-%d'))
+    await query.edit_message_text(
+        f"✅ **تم استلام طلب الدفع!**\n\n"
+        f"📋 **تفاصيل الطلب:**\n"
+        f"📅 الخطة: {plan['name']}\n"
+        f"💰 المبلغ: {plan['price']}\n"
+        f"📅 التاريخ: {datetime.now().strftime('%Y-%m-%d %H:%M')}\n\n"
+        f"⏳ **حالة الطلب:** قيد المراجعة\n\n"
+        f"📝 **الخطوات التالية:**\n"
+        f"1. أرسل صورة إيصال الدفع\n"
+        f"2. انتظر تأكيد الإدارة\n"
+        f"3. سيتم تفعيل اشتراكك خلال 24 ساعة\n\n"
+        f"{contact_text}\n"
+        f"💬 أرسل له صورة الإيصال مع رقم معرفك: `{user.id}`\n\n"
+        f"شكراً لثقتك في أكاديمية DevDZ! 🎓",
+        parse_mode='Markdown'
+    )
 
-        # Approve payment notification by ID
-        from bot.database import approve_payment_notification_by_id
-        approve_payment_notification_by_id(notification_id)
+async def _pending_payment_for_button(update: Update, context: ContextTypes.DEFAULT_TYPE, by_user=False):
+    """Resolve an approve/reject button to its pending payment, or alert the admin.
 
-        # Get linked group and create invite link
-        linked_group = get_linked_group()
-        invite_message = ""
-        group_link_created = False
+    The query is left unanswered when a payment is found; the caller answers
+    it once it knows the outcome, since a query can only be answered once.
+    """
+    query = update.callback_query
+    from bot.async_database import get_pending_payment, get_payment_notification_by_user_id
+    if by_user:
+        # Buttons sent before payments were keyed by notification ID
+        user_payment = await get_payment_notification_by_user_id(int(context.args[0]))
+    else:
+        user_payment = await get_pending_payment(int(context.args[0]))
 
-        if linked_group:
-            try:
-                # Create one-time invite link
-                invite_link = await context.bot.create_chat_invite_link(
-                    chat_id=linked_group,
-                    member_limit=1,  # One-time use
-                    expire_date=datetime.now() + timedelta(hours=24)  # Expires in 24 hours
-                )
-        
-                # Get group info
-                group_info = await context.bot.get_chat(linked_group)
-                group_name = group_info.title
-        
-                invite_message = f"\n\n🔗 **رابط الدخول للمجموعة:**\n{invite_link.invite_link}\n\n📱 **المجموعة:** {group_name}\n⚠️ هذا الرابط صالح لمرة واحدة فقط وينتهي خلال 24 ساعة."
-                group_link_created = True
-                logger.info(f"Created invite link for user {user_id}: {invite_link.invite_link}")
-                
-                # Store the invite link for later revocation
-                context.bot_data[f'invite_link_{user_id}'] = invite_link.invite_link
-        
-            except Exception as e:
-                logger.error(f"Failed to create invite link for user {user_id}: {e}")
-                invite_message = f"\n\n⚠️ حدث خطأ في إنشاء رابط الدخول. تواصل مع الإدارة للحصول على الرابط."
+    if not user_payment:
+        await query.answer("❌ لم يتم العثور على طلب دفع معلق لهذا المستخدم", show_alert=True)
+        return None
+    return user_payment
 
-        # Send approval message to user with enhanced error handling
-        welcome_sent = False
-        max_retries = 3
-    
-        for attempt in range(max_retries):
-            try:
-                # Create the welcome message
-                welcome_message = (
-                    f"🎉 **تم قبول دفعتك وتفعيل اشتراكك!**\n\n"
-                    f"✅ يمكنك الآن الوصول لجميع الدورات والمواد التعليمية.\n"
-                    f"🧠 استخدم /quiz لحل الاختبارات الأسبوعية.\n"
-                    f"📅 **ينتهي اشتراكك في:** {end_date.strftime('%Y-%m-%d')}"
-                    f"{invite_message}\n\n"
-                    f"مرحباً بك في أكاديمية DevDZ! 🎓"
-                )
-            
-                logger.info(f"Attempting to send welcome message to user {user_id}, attempt {attempt + 1}")
-            
-                # Try to send the message with Markdown
-                sent_message = await context.bot.send_message(
-                    user_id,
-                    welcome_message,
-                    parse_mode='Markdown'
-                )
+@callbacks.route("approve_payment")
+async def approve_payment_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_payment = await _pending_payment_for_button(update, context)
+    if user_payment:
+        await _approve_payment(update, context, user_payment)
 
-                # Store the message ID for later deletion
-                if group_link_created:
-                    context.bot_data[f'welcome_msg_{user_id}'] = sent_message.message_id
+@callbacks.route("approve")
+async def approve_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_payment = await _pending_payment_for_button(update, context, by_user=True)
+    if user_payment:
+        await _approve_payment(update, context, user_payment)
 
-                welcome_sent = True
-                logger.info(f"✅ Welcome message sent successfully to user {user_id} on attempt {attempt + 1}")
-                break
-            
-            except telegram.error.Forbidden:
-                logger.warning(f"❌ User {user_id} has blocked the bot - cannot send welcome message")
-                break
-            
-            except telegram.error.TimedOut:
-                logger.warning(f"⏰ Timeout sending welcome message to user {user_id}, attempt {attempt + 1}/{max_retries}")
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(2 ** attempt)  # Exponential backoff: 1s, 2s, 4s
-                continue
-            
-            except telegram.error.BadRequest as e:
-                logger.error(f"📝 Bad request sending welcome message to user {user_id}: {e}")
-                # Try sending without markdown if it's a parsing error
-                if "parse" in str(e).lower() and attempt == 0:
-                    try:
-                        simple_message = (
-                            f"🎉 تم قبول دفعتك وتفعيل اشتراكك!\n\n"
-                            f"✅ يمكنك الآن الوصول لجميع الدورات والمواد التعليمية.\n"
-                            f"🧠 استخدم /quiz لحل الاختبارات الأسبوعية.\n"
-                            f"📅 ينتهي اشتراكك في: {end_date.strftime('%Y-%m-%d')}"
-                            f"{invite_message.replace('**', '').replace('*', '')}\n\n"
-                            f"مرحباً بك في أكاديمية DevDZ! 🎓"
-                        )
-                        sent_message = await context.bot.send_message(user_id, simple_message)
-                        # Store the message ID for later deletion
-                        if group_link_created:
-                            context.bot_data[f'welcome_msg_{user_id}'] = sent_message.message_id
-                        welcome_sent = True
-                        logger.info(f"✅ Simple welcome message sent to user {user_id}")
-                        break
-                    except Exception as simple_error:
-                        logger.error(f"Failed to send simple message to user {user_id}: {simple_error}")
-                break
-            
-            except Exception as e:
-                logger.error(f"❌ Unexpected error sending welcome message to user {user_id}, attempt {attempt + 1}: {e}")
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(2 ** attempt)
-                continue
-
-        # Update admin with detailed result
-        if welcome_sent:
-            admin_message = (
-                f"✅ **تم قبول الدفع وتفعيل الاشتراك بنجاح**\n\n"
-                f"👤 **المستخدم:** {full_name}\n"
-                f"🆔 **المعرف:** {user_id}\n"
-                f"📱 **اليوزر:** @{username or 'غير محدد'}\n"
-                f"📅 **الخطة:** {plan_name} ({days} يوم)\n"
-                f"📅 **ينتهي في:** {end_date.strftime('%Y-%m-%d')}\n\n"
-                f"✅ **تم إرسال رسالة الترحيب للمستخدم**\n"
+async def _approve_payment(update: Update, context: ContextTypes.DEFAULT_TYPE, user_payment):
+    query = update.callback_query
+    notification_id, user_id, username, full_name, plan_name, amount, date = user_payment
+
+    # Determine days based on plan
+    plan_days = {
+        "شهري": 30,
+        "ربع سنوي": 90,
+        "نصف سنوي": 180,
+        "سنوي": 365
+    }
+
+    days = plan_days.get(plan_name, 30)
+
+    # Approve the payment and activate the subscription in one commit
+    end_date = datetime.now() + timedelta(days=days)
+    from bot.async_database import approve_subscription_payment
+    if not await approve_subscription_payment(notification_id, user_id, end_date.strftime('%Y-%m-%d')):
+        await query.answer("⚠️ تمت معالجة طلب الدفع هذا مسبقاً", show_alert=True)
+        return
+    await query.answer()
+
+    # Get linked group and create invite link
+    linked_group = await get_linked_group()
+    invite_message = ""
+    group_link_created = False
+
+    if linked_group:
+        try:
+            # Create one-time invite link
+            invite_link = await context.bot.create_chat_invite_link(
+                chat_id=linked_group,
+                member_limit=1,  # One-time use
+                expire_date=datetime.now() + timedelta(hours=24)  # Expires in 24 hours
             )
-        
-            if group_link_created:
-                admin_message += f"🔗 **تم إنشاء رابط المجموعة وإرساله**\n"
-            else:
-                admin_message += f"⚠️ **لم يتم إنشاء رابط المجموعة** (تحقق من إعدادات المجموعة)\n"
-            
-            admin_message += f"\n🗑️ تم إزالة الطلب من قائمة الدفعات المعلقة."
-        
-        else:
-            admin_message = (
-                f"⚠️ **تم تفعيل الاشتراك لكن فشل إرسال الرسالة**\n\n"
-                f"👤 **المستخدم:** {full_name}\n"
-                f"🆔 **المعرف:** {user_id}\n"
-                f"📱 **اليوزر:** @{username or 'غير محدد'}\n"
-                f"📅 **الخطة:** {plan_name} ({days} يوم)\n"
-                f"📅 **ينتهي في:** {end_date.strftime('%Y-%m-%d')}\n\n"
-                f"❌ **فشل في إرسال رسالة الترحيب**\n"
-                f"💬 **يرجى التواصل مع المستخدم مباشرة:**\n"
+
+            # Get group info
+            group_info = await context.bot.get_chat(linked_group)
+            group_name = group_info.title
+
+            invite_message = f"\n\n🔗 **رابط الدخول للمجموعة:**\n{invite_link.invite_link}\n\n📱 **المجموعة:** {group_name}\n⚠️ هذا الرابط صالح لمرة واحدة فقط وينتهي خلال 24 ساعة."
+            group_link_created = True
+            logger.info(f"Created invite link for user {user_id}: {invite_link.invite_link}")
+
+            # Store the invite link for later revocation
+            context.bot_data[f'invite_link_{user_id}'] = invite_link.invite_link
+
+        except Exception as e:
+            logger.error(f"Failed to create invite link for user {user_id}: {e}")
+            invite_message = f"\n\n⚠️ حدث خطأ في إنشاء رابط الدخول. تواصل مع الإدارة للحصول على الرابط."
+
+    # Send approval message to user with enhanced error handling
+    welcome_sent = False
+    max_retries = 3
+
+    for attempt in range(max_retries):
+        try:
+            # Create the welcome message
+            welcome_message = (
+                f"🎉 **تم قبول دفعتك وتفعيل اشتراكك!**\n\n"
+                f"✅ يمكنك الآن الوصول لجميع الدورات والمواد التعليمية.\n"
+                f"🧠 استخدم /quiz لحل الاختبارات الأسبوعية.\n"
+                f"📅 **ينتهي اشتراكك في:** {end_date.strftime('%Y-%m-%d')}"
+                f"{invite_message}\n\n"
+                f"مرحباً بك في أكاديمية DevDZ! 🎓"
             )
-        
+
+            logger.info(f"Attempting to send welcome message to user {user_id}, attempt {attempt + 1}")
+
+            # Try to send the message with Markdown
+            sent_message = await context.bot.send_message(
+                user_id,
+                welcome_message,
+                parse_mode='Markdown'
+            )
+
+            # Store the message ID for later deletion
             if group_link_created:
-                admin_message += f"🔗 **رابط المجموعة (أرسله للمستخدم):**\n{invite_message}\n\n"
-        
-            admin_message += f"🗑️ تم إزالة الطلب من قائمة الدفعات المعلقة."
-    
-        try:
-            await query.edit_message_text(admin_message)
+                context.bot_data[f'welcome_msg_{user_id}'] = sent_message.message_id
+
+            welcome_sent = True
+            logger.info(f"✅ Welcome message sent successfully to user {user_id} on attempt {attempt + 1}")
+            break
+
+        except telegram.error.Forbidden:
+            logger.warning(f"❌ User {user_id} has blocked the bot - cannot send welcome message")
+            break
+
+        except telegram.error.TimedOut:
+            logger.warning(f"⏰ Timeout sending welcome message to user {user_id}, attempt {attempt + 1}/{max_retries}")
+            if attempt < max_retries - 1:
+                await asyncio.sleep(2 ** attempt)  # Exponential backoff: 1s, 2s, 4s
+            continue
+
+        except telegram.error.BadRequest as e:
+            logger.error(f"📝 Bad request sending welcome message to user {user_id}: {e}")
+            # Try sending without markdown if it's a parsing error
+            if "parse" in str(e).lower() and attempt == 0:
+                try:
+                    simple_message = (
+                        f"🎉 تم قبول دفعتك وتفعيل اشتراكك!\n\n"
+                        f"✅ يمكنك الآن الوصول لجميع الدورات والمواد التعليمية.\n"
+                        f"🧠 استخدم /quiz لحل الاختبارات الأسبوعية.\n"
+                        f"📅 ينتهي اشتراكك في: {end_date.strftime('%Y-%m-%d')}"
+                        f"{invite_message.replace('**', '').replace('*', '')}\n\n"
+                        f"مرحباً بك في أكاديمية DevDZ! 🎓"
+                    )
+                    sent_message = await context.bot.send_message(user_id, simple_message)
+                    # Store the message ID for later deletion
+                    if group_link_created:
+                        context.bot_data[f'welcome_msg_{user_id}'] = sent_message.message_id
+                    welcome_sent = True
+                    logger.info(f"✅ Simple welcome message sent to user {user_id}")
+                    break
+                except Exception as simple_error:
+                    logger.error(f"Failed to send simple message to user {user_id}: {simple_error}")
+            break
+
         except Exception as e:
-            logger.error(f"Failed to update admin message: {e}")
-            # Try sending a new message if editing fails
-            try:
-                await context.bot.send_message(query.from_user.id, admin_message)
-            except:
-                pass
+            logger.error(f"❌ Unexpected error sending welcome message to user {user_id}, attempt {attempt + 1}: {e}")
+            if attempt < max_retries - 1:
+                await asyncio.sleep(2 ** attempt)
+            continue
 
-    elif query.data.startswith("reject_"):
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
+    # Update admin with detailed result
+    if welcome_sent:
+        admin_message = (
+            f"✅ **تم قبول الدفع وتفعيل الاشتراك بنجاح**\n\n"
+            f"👤 **المستخدم:** {full_name}\n"
+            f"🆔 **المعرف:** {user_id}\n"
+            f"📱 **اليوزر:** @{username or 'غير محدد'}\n"
+            f"📅 **الخطة:** {plan_name} ({days} يوم)\n"
+            f"📅 **ينتهي في:** {end_date.strftime('%Y-%m-%d')}\n\n"
+            f"✅ **تم إرسال رسالة الترحيب للمستخدم**\n"
+        )
 
-        user_id = int(query.data.replace("reject_", ""))
+        if group_link_created:
+            admin_message += f"🔗 **تم إنشاء رابط المجموعة وإرساله**\n"
+        else:
+            admin_message += f"⚠️ **لم يتم إنشاء رابط المجموعة** (تحقق من إعدادات المجموعة)\n"
 
-        # Get user payment notification
-        from bot.database import get_payment_notification_by_user_id
-        user_payment = get_payment_notification_by_user_id(user_id)
+        admin_message += f"\n🗑️ تم إزالة الطلب من قائمة الدفعات المعلقة."
 
-        if not user_payment:
-            await query.answer("❌ لم يتم العثور على طلب دفع معلق لهذا المستخدم", show_alert=True)
-            return
+    else:
+        admin_message = (
+            f"⚠️ **تم تفعيل الاشتراك لكن فشل إرسال الرسالة**\n\n"
+            f"👤 **المستخدم:** {full_name}\n"
+            f"🆔 **المعرف:** {user_id}\n"
+            f"📱 **اليوزر:** @{username or 'غير محدد'}\n"
+            f"📅 **الخطة:** {plan_name} ({days} يوم)\n"
+            f"📅 **ينتهي في:** {end_date.strftime('%Y-%m-%d')}\n\n"
+            f"❌ **فشل في إرسال رسالة الترحيب**\n"
+            f"💬 **يرجى التواصل مع المستخدم مباشرة:**\n"
+        )
 
-        notification_id, telegram_id, username, full_name, plan_name, amount, date = user_payment
+        if group_link_created:
+            admin_message += f"🔗 **رابط المجموعة (أرسله للمستخدم):**\n{invite_message}\n\n"
 
-        # Reject payment notification by ID
-        from bot.database import reject_payment_notification_by_id
-        reject_payment_notification_by_id(notification_id)
+        admin_message += f"🗑️ تم إزالة الطلب من قائمة الدفعات المعلقة."
 
-        # Send rejection message to user
+    try:
+        await query.edit_message_text(admin_message)
+    except Exception as e:
+        logger.error(f"Failed to update admin message: {e}")
+        # Try sending a new message if editing fails
         try:
-            await context.bot.send_message(
-                user_id,
-                f"❌ **تم رفض طلب الدفع**\n\n"
-                f"📝 يرجى التأكد من:\n"
-                f"• صحة المبلغ المحول\n"
-                f"• وضوح إيصال التحويل\n"
-                f"• تطابق البيانات\n\n"
-                f"💬 للاستفسار، تواصل مع الإدارة مع إرفاق إيصال الدفع.\n\n"
-                f"يمكنك المحاولة مرة أخرى من خلال /start"
-            )
+            await context.bot.send_message(query.from_user.id, admin_message)
         except:
             pass
 
-        await query.edit_message_text(
-            f"❌ **تم رفض الدفع**\n\n"
-            f"👤 المستخدم: {full_name}\n"
-            f"📅 الخطة: {plan_name}\n"
-            f"💰 المبلغ: {amount}\n\n"
-            f"🗑️ تم إزالة الطلب من قائمة الدفعات المعلقة."
+@callbacks.route("reject_payment")
+async def reject_payment_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_payment = await _pending_payment_for_button(update, context)
+    if user_payment:
+        await _reject_payment(update, context, user_payment)
+
+@callbacks.route("reject")
+async def reject_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_payment = await _pending_payment_for_button(update, context, by_user=True)
+    if user_payment:
+        await _reject_payment(update, context, user_payment)
+
+async def _reject_payment(update: Update, context: ContextTypes.DEFAULT_TYPE, user_payment):
+    query = update.callback_query
+    notification_id, user_id, username, full_name, plan_name, amount, date = user_payment
+
+    # Reject payment notification by ID
+    from bot.async_database import reject_payment_notification_by_id
+    if not await reject_payment_notification_by_id(notification_id):
+        await query.answer("⚠️ تمت معالجة طلب الدفع هذا مسبقاً", show_alert=True)
+        return
+    await query.answer()
+
+    # Send rejection message to user
+    try:
+        await context.bot.send_message(
+            user_id,
+            f"❌ **تم رفض طلب الدفع**\n\n"
+            f"📝 يرجى التأكد من:\n"
+            f"• صحة المبلغ المحول\n"
+            f"• وضوح إيصال التحويل\n"
+            f"• تطابق البيانات\n\n"
+            f"💬 للاستفسار، تواصل مع الإدارة مع إرفاق إيصال الدفع.\n\n"
+            f"يمكنك المحاولة مرة أخرى من خلال /start"
         )
+    except:
+        pass
+
+    await query.edit_message_text(
+        f"❌ **تم رفض الدفع**\n\n"
+        f"👤 المستخدم: {full_name}\n"
+        f"📅 الخطة: {plan_name}\n"
+        f"💰 المبلغ: {amount}\n\n"
+        f"🗑️ تم إزالة الطلب من قائمة الدفعات المعلقة."
+    )
+
+@callbacks.route("status")
+async def status_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    user = query.from_user
     
-    elif query.data == "status":
-        user_data = get_user(user.id)
-        if user_data and user_data[3]:  # has_subscription
-            referral_stats = get_referral_stats(user.id)
-            await query.edit_message_text(
-                f"📊 **حالة اشتراكك:**\n\n"
-                f"✅ **الحالة:** نشط\n"
-                f"📅 **ينتهي في:** {user_data[4]}\n"
-                f"🔗 **إحالاتك:** {referral_stats['total_referrals']} مستخدم\n"
-                f"🎁 **أيام مجانية مكتسبة:** {referral_stats['free_days']} يوم\n\n"
-                f"🧠 استخدم /quiz لحل الاختبارات الأسبوعية!"
-            )
-        else:
-            keyboard = [
-                [InlineKeyboardButton("📚 اشترك الآن", callback_data="subscribe")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                "❌ **ليس لديك اشتراك نشط**\n\n"
-                "🎓 اشترك الآن للوصول إلى:\n"
-                "✅ جميع الدورات التعليمية\n"
-                "✅ الاختبارات الأسبوعية\n"
-                "✅ المشاريع العملية\n"
-                "✅ الدعم الفني المباشر",
-                reply_markup=reply_markup
-            )
-    
-    elif query.data == "referral":
-        referral_link = f"https://t.me/{context.bot.username}?start={user.id}"
-        referral_stats = get_referral_stats(user.id)
-        
+    user_data = await get_user(user.id)
+    if user_data and user_data[3]:  # has_subscription
+        referral_stats = await get_referral_stats(user.id)
         await query.edit_message_text(
-            f"🔗 **رابط الإحالة الخاص بك:**\n\n"
-            f"`{referral_link}`\n\n"
-            f"📊 **إحصائياتك:**\n"
-            f"👥 إجمالي الإحالات: {referral_stats['total_referrals']}\n"
-            f"✅ إحالات مفعلة: {referral_stats['active_referrals']}\n"
-            f"🎁 أيام مجانية: {referral_stats['free_days']}\n\n"
-            f"💡 **كيف يعمل:**\n"
-            f"• شارك الرابط مع أصدقائك\n"
-            f"• احصل على 3 أيام مجانية لكل صديق يشترك\n"
-            f"• لا يوجد حد أقصى للإحالات!"
+            f"📊 **حالة اشتراكك:**\n\n"
+            f"✅ **الحالة:** نشط\n"
+            f"📅 **ينتهي في:** {user_data[4]}\n"
+            f"🔗 **إحالاتك:** {referral_stats['total_referrals']} مستخدم\n"
+            f"🎁 **أيام مجانية مكتسبة:** {referral_stats['free_days']} يوم\n\n"
+            f"🧠 استخدم /quiz لحل الاختبارات الأسبوعية!"
         )
-    
-    elif query.data == "help":
-        await query.answer()
-        await help_command(update, context)
-    
-    elif query.data == "admin_panel":
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
-    
-        stats = get_user_stats()
-    
+    else:
         keyboard = [
-            [InlineKeyboardButton("💳 الدفعات المعلقة", callback_data="admin_pending_payments")],
-            [InlineKeyboardButton("👥 إدارة المستخدمين", callback_data="admin_users")],
-            [InlineKeyboardButton("📢 إدارة الإعلانات", callback_data="admin_announcements")],
-            [InlineKeyboardButton("📋 طلبات الانضمام", callback_data="admin_requests")],
-            [InlineKeyboardButton("👥 أعضاء المجموعة", callback_data="admin_members")],
-            [InlineKeyboardButton("📊 إحصائيات النظام", callback_data="admin_stats")],
-            [InlineKeyboardButton("🔙 القائمة الرئيسية", callback_data="back_to_main")]
+            [InlineKeyboardButton("📚 اشترك الآن", callback_data="subscribe")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        
+
         await query.edit_message_text(
-            f"⚙️ **لوحة تحكم الإدارة**\n\n"
-            f"📊 **إحصائيات سريعة:**\n"
-            f"👥 إجمالي المستخدمين: {stats['total_users']}\n"
-            f"✅ المشتركين النشطين: {stats['active_subscribers']}\n"
-            f"💳 الدفعات المعلقة: {stats['pending_payments']}\n"
-            f"🆕 مستخدمين جدد هذا الأسبوع: {stats['new_users']}\n\n"
-            f"اختر العملية التي تريد تنفيذها:",
+            "❌ **ليس لديك اشتراك نشط**\n\n"
+            "🎓 اشترك الآن للوصول إلى:\n"
+            "✅ جميع الدورات التعليمية\n"
+            "✅ الاختبارات الأسبوعية\n"
+            "✅ المشاريع العملية\n"
+            "✅ الدعم الفني المباشر",
             reply_markup=reply_markup
         )
 
-    elif query.data == "admin_pending_payments":
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
+@callbacks.route("referral")
+async def referral_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    user = query.from_user
+    
+    referral_link = f"https://t.me/{context.bot.username}?start={user.id}"
+    referral_stats = await get_referral_stats(user.id)
+
+    await query.edit_message_text(
+        f"🔗 **رابط الإحالة الخاص بك:**\n\n"
+        f"`{referral_link}`\n\n"
+        f"📊 **إحصائياتك:**\n"
+        f"👥 إجمالي الإحالات: {referral_stats['total_referrals']}\n"
+        f"✅ إحالات مفعلة: {referral_stats['active_referrals']}\n"
+        f"🎁 أيام مجانية: {referral_stats['free_days']}\n\n"
+        f"💡 **كيف يعمل:**\n"
+        f"• شارك الرابط مع أصدقائك\n"
+        f"• احصل على 3 أيام مجانية لكل صديق يشترك\n"
+        f"• لا يوجد حد أقصى للإحالات!"
+    )
 
-        pending = get_pending_payments()
+@callbacks.route("help")
+async def help_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    await help_command(update, context)
 
-        if not pending:
-            keyboard = [
-                [InlineKeyboardButton("🔄 تحديث", callback_data="admin_pending_payments")],
-                [InlineKeyboardButton("🔙 لوحة الإدارة", callback_data="admin_panel")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("✅ لا توجد دفعات معلقة.", reply_markup=reply_markup)
-            return
+@callbacks.route("admin_panel")
+async def admin_panel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    stats = await get_user_stats()
 
-        message = f"💳 الدفعات المعلقة ({len(pending)}):\n\n"
-        keyboard = []
+    keyboard = [
+        [InlineKeyboardButton("💳 الدفعات المعلقة", callback_data="admin_pending_payments")],
+        [InlineKeyboardButton("👥 إدارة المستخدمين", callback_data="admin_users")],
+        [InlineKeyboardButton("📢 إدارة الإعلانات", callback_data="admin_announcements")],
+        [InlineKeyboardButton("📋 طلبات الانضمام", callback_data="admin_requests")],
+        [InlineKeyboardButton("👥 أعضاء المجموعة", callback_data="admin_members")],
+        [InlineKeyboardButton("📊 إحصائيات النظام", callback_data="admin_stats")],
+        [InlineKeyboardButton("🔙 القائمة الرئيسية", callback_data="back_to_main")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await query.edit_message_text(
+        f"⚙️ **لوحة تحكم الإدارة**\n\n"
+        f"📊 **إحصائيات سريعة:**\n"
+        f"👥 إجمالي المستخدمين: {stats['total_users']}\n"
+        f"✅ المشتركين النشطين: {stats['active_subscribers']}\n"
+        f"💳 الدفعات المعلقة: {stats['pending_payments']}\n"
+        f"🆕 مستخدمين جدد هذا الأسبوع: {stats['new_users']}\n\n"
+        f"اختر العملية التي تريد تنفيذها:",
+        reply_markup=reply_markup
+    )
+
+@callbacks.route("admin_pending_payments")
+async def admin_pending_payments_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    pending = await get_pending_payments()
+
+    if not pending:
+        keyboard = [
+            [InlineKeyboardButton("🔄 تحديث", callback_data="admin_pending_payments")],
+            [InlineKeyboardButton("🔙 لوحة الإدارة", callback_data="admin_panel")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await query.edit_message_text("✅ لا توجد دفعات معلقة.", reply_markup=reply_markup)
+        return
+
+    message = f"💳 الدفعات المعلقة ({len(pending)}):\n\n"
+    keyboard = []
+
+    for payment in pending[:5]:  # Show only first 5 to avoid message length limits
+        # Clean and escape text for safe display
+        username = payment[2] or 'غير محدد'
+        full_name = payment[3]
+        plan_name = payment[4]
+        amount = payment[5]
+        date = payment[6]
 
-        for payment in pending[:5]:  # Show only first 5 to avoid message length limits
-            # Clean and escape text for safe display
-            username = payment[2] or 'غير محدد'
-            full_name = payment[3]
-            plan_name = payment[4]
-            amount = payment[5]
-            date = payment[6]
-        
         # Remove any problematic characters and format safely
         message += f"👤 {full_name} (@{username})\n"
         message += f"🆔 المعرف: {payment[1]}\n"
         message += f"📅 الخطة: {plan_name}\n"
         message += f"💰 المبلغ: {amount}\n"
         message += f"📅 التاريخ: {date}\n"
-        
+
         keyboard.append([
-            InlineKeyboardButton(f"✅ قبول {full_name[:10]}...", callback_data=f"approve_{payment[1]}"),
-            InlineKeyboardButton(f"❌ رفض {full_name[:10]}...", callback_data=f"reject_{payment[1]}")
+            InlineKeyboardButton(f"✅ قبول {full_name[:10]}...", callback_data=encode_callback("approve_payment", payment[0])),
+            InlineKeyboardButton(f"❌ رفض {full_name[:10]}...", callback_data=encode_callback("reject_payment", payment[0]))
         ])
         message += "─────────────\n"
 
-        if len(pending) > 5:
-            message += f"... و {len(pending) - 5} طلب آخر\n\n"
+    if len(pending) > 5:
+        message += f"... و {len(pending) - 5} طلب آخر\n\n"
 
-        keyboard.append([InlineKeyboardButton("🔄 تحديث القائمة", callback_data="admin_pending_payments")])
-        keyboard.append([InlineKeyboardButton("🔙 لوحة الإدارة", callback_data="admin_panel")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    keyboard.append([InlineKeyboardButton("🔄 تحديث القائمة", callback_data="admin_pending_payments")])
+    keyboard.append([InlineKeyboardButton("🔙 لوحة الإدارة", callback_data="admin_panel")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
 
-        # Send without markdown parsing to avoid issues
-        await query.edit_message_text(message, reply_markup=reply_markup)
+    # Send without markdown parsing to avoid issues
+    await query.edit_message_text(message, reply_markup=reply_markup)
 
-    elif query.data == "admin_stats":
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
-        
-        stats = get_user_stats()
-        quiz_stats = get_quiz_stats()
-        
-        keyboard = [[InlineKeyboardButton("🔙 لوحة الإدارة", callback_data="admin_panel")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            f"📊 **إحصائيات النظام التفصيلية**\n\n"
-            f"👥 **المستخدمين:**\n"
-            f"• إجمالي المستخدمين: {stats['total_users']}\n"
-            f"• المشتركين النشطين: {stats['active_subscribers']}\n"
-            f"• مستخدمين جدد هذا الأسبوع: {stats['new_users']}\n\n"
-            f"💳 **المدفوعات:**\n"
-            f"• دفعات معلقة: {stats['pending_payments']}\n\n"
-            f"🧠 **الاختبارات:**\n"
-            f"• إجمالي المحاولات: {quiz_stats['total_attempts']}\n"
-            f"• متوسط النتائج: {quiz_stats['avg_score']}%\n"
-            f"• مشاركين هذا الأسبوع: {quiz_stats['weekly_participants']}\n\n"
-            f"📅 **آخر تحديث:** {datetime.now().strftime('%Y-%m-%d %H:%M')}",
-            reply_markup=reply_markup
-        )
+@callbacks.route("admin_stats")
+async def admin_stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
     
-    elif query.data == "admin_users":
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
-        
-        keyboard = [
-            [InlineKeyboardButton("👥 عرض جميع المستخدمين", callback_data="admin_list_users")],
-            [InlineKeyboardButton("🔍 البحث عن مستخدم", callback_data="admin_search_user")],
-            [InlineKeyboardButton("📊 المستخدمين النشطين", callback_data="admin_active_users")],
-            [InlineKeyboardButton("⏰ المستخدمين منتهي الصلاحية", callback_data="admin_expired_users")],
-            [InlineKeyboardButton("🔙 لوحة الإدارة", callback_data="admin_panel")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            "👥 **إدارة المستخدمين**\n\n"
-            "اختر العملية التي تريد تنفيذها:",
-            reply_markup=reply_markup
-        )
+    stats = await get_user_stats()
+    quiz_stats = await get_quiz_stats()
 
-    elif query.data == "admin_list_users":
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
-    
-        # Get recent users (last 10)
-        from bot.database import get_recent_users
-        recent_users = get_recent_users(10)
-    
-        if not recent_users:
-            keyboard = [[InlineKeyboardButton("🔙 إدارة المستخدمين", callback_data="admin_users")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("❌ لا يوجد مستخدمين.", reply_markup=reply_markup)
-            return
-    
-        message = "👥 **آخر 10 مستخدمين:**\n\n"
-        keyboard = []
-    
-        for user_data in recent_users:
-            telegram_id, full_name, username, has_subscription, subscription_end, join_date = user_data
-            status = "✅ نشط" if has_subscription else "❌ منتهي"
-            username_display = f"@{username}" if username else "بدون يوزر"
-        
-            message += f"👤 **{full_name}** ({username_display})\n"
-            message += f"🆔 المعرف: {telegram_id}\n"
-            message += f"📊 الحالة: {status}\n"
-            if subscription_end:
-                message += f"📅 ينتهي في: {subscription_end}\n"
-            message += f"📅 انضم في: {join_date}\n"
-        
-            keyboard.append([InlineKeyboardButton(f"⚙️ إدارة {full_name}", callback_data=f"manage_user_{telegram_id}")])
-            message += "─────────────\n"
-    
-        keyboard.append([InlineKeyboardButton("🔙 إدارة المستخدمين", callback_data="admin_users")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-    
-        await query.edit_message_text(message, reply_markup=reply_markup)  # Remove parse_mode='Markdown'
+    # Hardest question of each quiz, by share of correct answers
+    hardest = ""
+    for quiz_num, title in get_quiz_catalog().titles():
+        question_stats = await get_quiz_question_stats(quiz_num)
+        if question_stats:
+            index, answered, correct = min(question_stats, key=lambda row: row[2] / row[1])
+            hardest += f"• {title}: السؤال {index + 1} ({correct * 100 // answered}% إجابات صحيحة)\n"
+    if hardest:
+        hardest = f"\n🎯 **أصعب الأسئلة:**\n{hardest}"
 
-    elif query.data == "admin_active_users":
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
-    
-        from bot.database import get_all_active_users
-        active_user_ids = get_all_active_users()
-    
-        if not active_user_ids:
-            keyboard = [[InlineKeyboardButton("🔙 إدارة المستخدمين", callback_data="admin_users")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("❌ لا يوجد مستخدمين نشطين.", reply_markup=reply_markup)
-            return
-    
-        message = f"✅ **المستخدمين النشطين ({len(active_user_ids)}):**\n\n"
-        keyboard = []
-    
-        # Show first 5 active users
-        for i, user_id in enumerate(active_user_ids[:5]):
-            user_data = get_user(user_id)
-            if user_data:
-                telegram_id, username, full_name, has_subscription, subscription_end, join_date, last_active = user_data
-                username_display = f"@{username}" if username else "بدون يوزر"
-            
-            message += f"👤 **{full_name}** ({username_display})\n"
-            message += f"🆔 المعرف: {telegram_id}\n"
-            message += f"📅 ينتهي في: {subscription_end}\n"
-            
-            keyboard.append([InlineKeyboardButton(f"⚙️ إدارة {full_name}", callback_data=f"manage_user_{telegram_id}")])
-            message += "─────────────\n"
-    
-        if len(active_user_ids) > 5:
-            message += f"... و {len(active_user_ids) - 5} مستخدم آخر\n"
-    
-        keyboard.append([InlineKeyboardButton("🔙 إدارة المستخدمين", callback_data="admin_users")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-    
-        await query.edit_message_text(message, reply_markup=reply_markup)  # Remove parse_mode='Markdown'
+    keyboard = [[InlineKeyboardButton("🔙 لوحة الإدارة", callback_data="admin_panel")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
 
-    elif query.data == "admin_expired_users":
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
-    
-        # Get users with expired subscriptions
-        from bot.database import cursor
-        cursor.execute("""
-            SELECT telegram_id, username, full_name, subscription_end, join_date
-            FROM users 
-            WHERE has_subscription = 0 AND subscription_end IS NOT NULL
-            ORDER BY subscription_end DESC
-            LIMIT 10
-        """)
-        expired_users = cursor.fetchall()
-    
-        if not expired_users:
-            keyboard = [[InlineKeyboardButton("🔙 إدارة المستخدمين", callback_data="admin_users")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("❌ لا يوجد مستخدمين منتهي الصلاحية.", reply_markup=reply_markup)
-            return
-    
-        message = f"❌ **المستخدمين منتهي الصلاحية ({len(expired_users)}):**\n\n"
-        keyboard = []
+    await query.edit_message_text(
+        f"📊 **إحصائيات النظام التفصيلية**\n\n"
+        f"👥 **المستخدمين:**\n"
+        f"• إجمالي المستخدمين: {stats['total_users']}\n"
+        f"• المشتركين النشطين: {stats['active_subscribers']}\n"
+        f"• مستخدمين جدد هذا الأسبوع: {stats['new_users']}\n\n"
+        f"💳 **المدفوعات:**\n"
+        f"• دفعات معلقة: {stats['pending_payments']}\n\n"
+        f"🧠 **الاختبارات:**\n"
+        f"• إجمالي المحاولات: {quiz_stats['total_attempts']}\n"
+        f"• متوسط النتائج: {quiz_stats['avg_score']}%\n"
+        f"• مشاركين هذا الأسبوع: {quiz_stats['weekly_participants']}\n"
+        f"{hardest}\n"
+        f"📅 **آخر تحديث:** {datetime.now().strftime('%Y-%m-%d %H:%M')}",
+        reply_markup=reply_markup
+    )
+
+@callbacks.route("admin_users")
+async def admin_users_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
     
-        for user_data in expired_users:
-            telegram_id, username, full_name, subscription_end, join_date = user_data
-            username_display = f"@{username}" if username else "بدون يوزر"
-        
-            message += f"👤 **{full_name}** ({username_display})\n"
-            message += f"🆔 المعرف: {telegram_id}\n"
-            message += f"📅 انتهى في: {subscription_end}\n"
-        
-            keyboard.append([InlineKeyboardButton(f"⚙️ إدارة {full_name}", callback_data=f"manage_user_{telegram_id}")])
-            message += "─────────────\n"
+    keyboard = [
+        [InlineKeyboardButton("👥 عرض جميع المستخدمين", callback_data="admin_list_users")],
+        [InlineKeyboardButton("🔍 البحث عن مستخدم", callback_data="admin_search_user")],
+        [InlineKeyboardButton("📊 المستخدمين النشطين", callback_data="admin_active_users")],
+        [InlineKeyboardButton("⏰ المستخدمين منتهي الصلاحية", callback_data="admin_expired_users")],
+        [InlineKeyboardButton("🔙 لوحة الإدارة", callback_data="admin_panel")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await query.edit_message_text(
+        "👥 **إدارة المستخدمين**\n\n"
+        "اختر العملية التي تريد تنفيذها:",
+        reply_markup=reply_markup
+    )
+
+@callbacks.route("admin_list_users")
+async def admin_list_users_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
     
-        keyboard.append([InlineKeyboardButton("🔙 إدارة المستخدمين", callback_data="admin_users")])
+    # Get recent users (last 10)
+    from bot.async_database import get_recent_users
+    recent_users = await get_recent_users(10)
+
+    if not recent_users:
+        keyboard = [[InlineKeyboardButton("🔙 إدارة المستخدمين", callback_data="admin_users")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
-    
-        await query.edit_message_text(message, reply_markup=reply_markup)  # Remove parse_mode='Markdown'
+        await query.edit_message_text("❌ لا يوجد مستخدمين.", reply_markup=reply_markup)
+        return
 
-    elif query.data.startswith("manage_user_"):
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
-    
-        user_id = int(query.data.replace("manage_user_", ""))
-        user_data = get_user(user_id)
-    
-        if not user_data:
-            await query.answer("❌ المستخدم غير موجود", show_alert=True)
-            return
-    
-        telegram_id, username, full_name, has_subscription, subscription_end, join_date, last_active = user_data
-        username_display = f"@{username}" if username else "بدون يوزر"
+    message = "👥 **آخر 10 مستخدمين:**\n\n"
+    keyboard = []
+
+    for user_data in recent_users:
+        telegram_id, full_name, username, has_subscription, subscription_end, join_date = user_data
         status = "✅ نشط" if has_subscription else "❌ منتهي"
-        admin_status = "👑 مشرف" if is_admin(user_id) else "👤 مستخدم عادي"
-    
-        keyboard = [
-            [InlineKeyboardButton("📅 تمديد الاشتراك", callback_data=f"extend_user_{user_id}")],
-            [InlineKeyboardButton("🔄 تجديد الاشتراك", callback_data=f"renew_user_{user_id}")],
-            [InlineKeyboardButton("⏸️ إيقاف الاشتراك", callback_data=f"suspend_user_{user_id}")],
-            [InlineKeyboardButton("👑 رفع كمشرف", callback_data=f"promote_user_{user_id}")],
-            [InlineKeyboardButton("👤 إزالة الإدارة", callback_data=f"demote_user_{user_id}")],
-            [InlineKeyboardButton("🗑️ حذف المستخدم", callback_data=f"delete_user_{user_id}")],
-            [InlineKeyboardButton("🔙 قائمة المستخدمين", callback_data="admin_list_users")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-    
-        message = f"⚙️ **إدارة المستخدم**\n\n"
-        message += f"👤 **الاسم:** {full_name}\n"
-        message += f"📱 **اليوزر:** {username_display}\n"
-        message += f"🆔 **المعرف:** {telegram_id}\n"
-        message += f"📊 **حالة الاشتراك:** {status}\n"
-        message += f"🔰 **الصلاحية:** {admin_status}\n"
+        username_display = f"@{username}" if username else "بدون يوزر"
+
+        message += f"👤 **{full_name}** ({username_display})\n"
+        message += f"🆔 المعرف: {telegram_id}\n"
+        message += f"📊 الحالة: {status}\n"
         if subscription_end:
-            message += f"📅 **ينتهي في:** {subscription_end}\n"
+            message += f"📅 ينتهي في: {subscription_end}\n"
         message += f"📅 انضم في: {join_date}\n"
-        message += f"⏰ **آخر نشاط:** {last_active}\n\n"
-        message += "اختر العملية التي تريد تنفيذها:"
-    
-        await query.edit_message_text(message, reply_markup=reply_markup)  # Remove parse_mode='Markdown'
 
-    elif query.data.startswith("extend_user_"):
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
-    
-        user_id = int(query.data.replace("extend_user_", ""))
+        keyboard.append([InlineKeyboardButton(f"⚙️ إدارة {full_name}", callback_data=encode_callback("manage_user", telegram_id))])
+        message += "─────────────\n"
+
+    keyboard.append([InlineKeyboardButton("🔙 إدارة المستخدمين", callback_data="admin_users")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await query.edit_message_text(message, reply_markup=reply_markup)  # Remove parse_mode='Markdown'
+
+@callbacks.route("admin_active_users")
+async def admin_active_users_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
     
-        keyboard = [
-            [InlineKeyboardButton("📅 7 أيام", callback_data=f"extend_days_{user_id}_7")],
-            [InlineKeyboardButton("📅 15 يوم", callback_data=f"extend_days_{user_id}_15")],
-            [InlineKeyboardButton("📅 30 يوم", callback_data=f"extend_days_{user_id}_30")],
-            [InlineKeyboardButton("📅 90 يوم", callback_data=f"extend_days_{user_id}_90")],
-            [InlineKeyboardButton("🔙 رجوع", callback_data=f"manage_user_{user_id}")]
-        ]
+    from bot.async_database import get_all_active_users
+    active_user_ids = await get_all_active_users(include_blocked=True)
+
+    if not active_user_ids:
+        keyboard = [[InlineKeyboardButton("🔙 إدارة المستخدمين", callback_data="admin_users")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
-    
-        await query.edit_message_text(
-            "📅 **تمديد الاشتراك**\n\n"
-            "اختر عدد الأيام التي تريد إضافتها:",
-            reply_markup=reply_markup
-        )
+        await query.edit_message_text("❌ لا يوجد مستخدمين نشطين.", reply_markup=reply_markup)
+        return
 
-    elif query.data.startswith("extend_days_"):
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
-    
-        parts = query.data.split("_")
-        user_id = int(parts[2])
-        days = int(parts[3])
-    
-        from bot.database import extend_subscription
-        success = extend_subscription(user_id, days)
-    
-        if success:
-            user_data = get_user(user_id)
-            try:
-                await context.bot.send_message(
-                    user_id,
-                    f"🎉 **تم تمديد اشتراكك!**\n\n"
-                    f"📅 تم إضافة {days} يوم لاشتراكك\n"
-                    f"📅 ينتهي اشتراكك الآن في: {user_data[4]}\n\n"
-                    f"شكراً لك! 🎓"
-                )
-            except:
-                pass
-        
-            await query.edit_message_text(
-                f"✅ **تم تمديد الاشتراك بنجاح!**\n\n"
-                f"👤 المستخدم: {user_data[2]}\n"
-                f"📅 تم إضافة: {days} يوم\n"
-                f"📅 ينتهي في: {user_data[4]}"
-            )
-        else:
-            await query.edit_message_text("❌ فشل في تمديد الاشتراك")
+    message = f"✅ **المستخدمين النشطين ({len(active_user_ids)}):**\n\n"
+    keyboard = []
 
-    elif query.data.startswith("renew_user_"):
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
-    
-        user_id = int(query.data.replace("renew_user_", ""))
+    # Show first 5 active users
+    for i, user_id in enumerate(active_user_ids[:5]):
+        user_data = await get_user(user_id)
+        if user_data:
+            telegram_id, username, full_name, has_subscription, subscription_end, join_date, last_active = user_data
+            username_display = f"@{username}" if username else "بدون يوزر"
+
+        message += f"👤 **{full_name}** ({username_display})\n"
+        message += f"🆔 المعرف: {telegram_id}\n"
+        message += f"📅 ينتهي في: {subscription_end}\n"
+
+        keyboard.append([InlineKeyboardButton(f"⚙️ إدارة {full_name}", callback_data=encode_callback("manage_user", telegram_id))])
+        message += "─────────────\n"
+
+    if len(active_user_ids) > 5:
+        message += f"... و {len(active_user_ids) - 5} مستخدم آخر\n"
+
+    keyboard.append([InlineKeyboardButton("🔙 إدارة المستخدمين", callback_data="admin_users")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await query.edit_message_text(message, reply_markup=reply_markup)  # Remove parse_mode='Markdown'
+
+@callbacks.route("admin_expired_users")
+async def admin_expired_users_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
     
-        keyboard = [
-            [InlineKeyboardButton("📅 شهري (30 يوم)", callback_data=f"renew_plan_{user_id}_30")],
-            [InlineKeyboardButton("📅 ربع سنوي (90 يوم)", callback_data=f"renew_plan_{user_id}_90")],
-            [InlineKeyboardButton("📅 نصف سنوي (180 يوم)", callback_data=f"renew_plan_{user_id}_180")],
-            [InlineKeyboardButton("📅 سنوي (365 يوم)", callback_data=f"renew_plan_{user_id}_365")],
-            [InlineKeyboardButton("🔙 رجوع", callback_data=f"manage_user_{user_id}")]
-        ]
+    # Get users with expired subscriptions
+    from bot.async_database import get_expired_users
+    expired_users = await get_expired_users(10)
+
+    if not expired_users:
+        keyboard = [[InlineKeyboardButton("🔙 إدارة المستخدمين", callback_data="admin_users")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
-    
-        await query.edit_message_text(
-            "🔄 **تجديد الاشتراك**\n\n"
-            "اختر مدة الاشتراك الجديد:",
-            reply_markup=reply_markup
-        )
+        await query.edit_message_text("❌ لا يوجد مستخدمين منتهي الصلاحية.", reply_markup=reply_markup)
+        return
 
-    elif query.data.startswith("renew_plan_"):
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
+    message = f"❌ **المستخدمين منتهي الصلاحية ({len(expired_users)}):**\n\n"
+    keyboard = []
+
+    for user_data in expired_users:
+        telegram_id, username, full_name, subscription_end, join_date = user_data
+        username_display = f"@{username}" if username else "بدون يوزر"
+
+        message += f"👤 **{full_name}** ({username_display})\n"
+        message += f"🆔 المعرف: {telegram_id}\n"
+        message += f"📅 انتهى في: {subscription_end}\n"
+
+        keyboard.append([InlineKeyboardButton(f"⚙️ إدارة {full_name}", callback_data=encode_callback("manage_user", telegram_id))])
+        message += "─────────────\n"
+
+    keyboard.append([InlineKeyboardButton("🔙 إدارة المستخدمين", callback_data="admin_users")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await query.edit_message_text(message, reply_markup=reply_markup)  # Remove parse_mode='Markdown'
+
+@callbacks.route("manage_user")
+async def manage_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
     
-        parts = query.data.split("_")
-        user_id = int(parts[2])
-        days = int(parts[3])
+    user_id = int(context.args[0])
+    user_data = await get_user(user_id)
+
+    if not user_data:
+        await query.answer("❌ المستخدم غير موجود", show_alert=True)
+        return
+
+    telegram_id, username, full_name, has_subscription, subscription_end, join_date, last_active = user_data
+    username_display = f"@{username}" if username else "بدون يوزر"
+    status = "✅ نشط" if has_subscription else "❌ منتهي"
+    admin_status = "👑 مشرف" if await is_admin(user_id) else "👤 مستخدم عادي"
+
+    keyboard = [
+        [InlineKeyboardButton("📅 تمديد الاشتراك", callback_data=encode_callback("extend_user", user_id))],
+        [InlineKeyboardButton("🔄 تجديد الاشتراك", callback_data=encode_callback("renew_user", user_id))],
+        [InlineKeyboardButton("⏸️ إيقاف الاشتراك", callback_data=encode_callback("suspend_user", user_id))],
+        [InlineKeyboardButton("👑 رفع كمشرف", callback_data=encode_callback("promote_user", user_id))],
+        [InlineKeyboardButton("👤 إزالة الإدارة", callback_data=encode_callback("demote_user", user_id))],
+        [InlineKeyboardButton("🗑️ حذف المستخدم", callback_data=encode_callback("delete_user", user_id))],
+        [InlineKeyboardButton("🔙 قائمة المستخدمين", callback_data="admin_list_users")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    message = f"⚙️ **إدارة المستخدم**\n\n"
+    message += f"👤 **الاسم:** {full_name}\n"
+    message += f"📱 **اليوزر:** {username_display}\n"
+    message += f"🆔 **المعرف:** {telegram_id}\n"
+    message += f"📊 **حالة الاشتراك:** {status}\n"
+    message += f"🔰 **الصلاحية:** {admin_status}\n"
+    if subscription_end:
+        message += f"📅 **ينتهي في:** {subscription_end}\n"
+    message += f"📅 انضم في: {join_date}\n"
+    message += f"⏰ **آخر نشاط:** {last_active}\n\n"
+    message += "اختر العملية التي تريد تنفيذها:"
+
+    await query.edit_message_text(message, reply_markup=reply_markup)  # Remove parse_mode='Markdown'
+
+@callbacks.route("extend_user")
+async def extend_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
     
-        # Activate new subscription
-        end_date = datetime.now() + timedelta(days=days)
-        update_user_subscription(user_id, True, end_date.strftime('%Y-%m-%d'))
+    user_id = int(context.args[0])
+
+    keyboard = [
+        [InlineKeyboardButton("📅 7 أيام", callback_data=encode_callback("extend_days", user_id, 7))],
+        [InlineKeyboardButton("📅 15 يوم", callback_data=encode_callback("extend_days", user_id, 15))],
+        [InlineKeyboardButton("📅 30 يوم", callback_data=encode_callback("extend_days", user_id, 30))],
+        [InlineKeyboardButton("📅 90 يوم", callback_data=encode_callback("extend_days", user_id, 90))],
+        [InlineKeyboardButton("🔙 رجوع", callback_data=encode_callback("manage_user", user_id))]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await query.edit_message_text(
+        "📅 **تمديد الاشتراك**\n\n"
+        "اختر عدد الأيام التي تريد إضافتها:",
+        reply_markup=reply_markup
+    )
+
+@callbacks.route("extend_days")
+async def extend_days_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
     
-        user_data = get_user(user_id)
+    user_id = int(context.args[0])
+    days = int(context.args[1])
+
+    from bot.async_database import extend_subscription
+    success = await extend_subscription(user_id, days)
+
+    if success:
+        user_data = await get_user(user_id)
         try:
             await context.bot.send_message(
                 user_id,
-                f"🎉 **تم تجديد اشتراكك!**\n\n"
-                f"📅 مدة الاشتراك الجديد: {days} يوم\n"
-                f"📅 ينتهي اشتراكك في: {user_data[4]}\n\n"
-                f"مرحباً بك مرة أخرى! 🎓"
+                f"🎉 **تم تمديد اشتراكك!**\n\n"
+                f"📅 تم إضافة {days} يوم لاشتراكك\n"
+                f"📅 ينتهي اشتراكك الآن في: {user_data[4]}\n\n"
+                f"شكراً لك! 🎓"
             )
         except:
             pass
-    
+
         await query.edit_message_text(
-            f"✅ **تم تجديد الاشتراك بنجاح!**\n\n"
+            f"✅ **تم تمديد الاشتراك بنجاح!**\n\n"
             f"👤 المستخدم: {user_data[2]}\n"
-            f"📅 مدة الاشتراك: {days} يوم\n"
+            f"📅 تم إضافة: {days} يوم\n"
             f"📅 ينتهي في: {user_data[4]}"
         )
+    else:
+        await query.edit_message_text("❌ فشل في تمديد الاشتراك")
 
-    elif query.data.startswith("suspend_user_"):
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
+@callbacks.route("renew_user")
+async def renew_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = int(context.args[0])
 
-        user_id = int(query.data.replace("suspend_user_", ""))
+    keyboard = [
+        [InlineKeyboardButton("📅 شهري (30 يوم)", callback_data=encode_callback("renew_plan", user_id, 30))],
+        [InlineKeyboardButton("📅 ربع سنوي (90 يوم)", callback_data=encode_callback("renew_plan", user_id, 90))],
+        [InlineKeyboardButton("📅 نصف سنوي (180 يوم)", callback_data=encode_callback("renew_plan", user_id, 180))],
+        [InlineKeyboardButton("📅 سنوي (365 يوم)", callback_data=encode_callback("renew_plan", user_id, 365))],
+        [InlineKeyboardButton("🔙 رجوع", callback_data=encode_callback("manage_user", user_id))]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
 
-        # Suspend subscription
-        update_user_subscription(user_id, False, None)
-        
+    await query.edit_message_text(
+        "🔄 **تجديد الاشتراك**\n\n"
+        "اختر مدة الاشتراك الجديد:",
+        reply_markup=reply_markup
+    )
+
+@callbacks.route("renew_plan")
+async def renew_plan_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = int(context.args[0])
+    days = int(context.args[1])
+
+    # Activate new subscription
+    end_date = datetime.now() + timedelta(days=days)
+    await update_user_subscription(user_id, True, end_date.strftime('%Y-%m-%d'))
+
+    user_data = await get_user(user_id)
+    try:
+        await context.bot.send_message(
+            user_id,
+            f"🎉 **تم تجديد اشتراكك!**\n\n"
+            f"📅 مدة الاشتراك الجديد: {days} يوم\n"
+            f"📅 ينتهي اشتراكك في: {user_data[4]}\n\n"
+            f"مرحباً بك مرة أخرى! 🎓"
+        )
+    except:
+        pass
+
+    await query.edit_message_text(
+        f"✅ **تم تجديد الاشتراك بنجاح!**\n\n"
+        f"👤 المستخدم: {user_data[2]}\n"
+        f"📅 مدة الاشتراك: {days} يوم\n"
+        f"📅 ينتهي في: {user_data[4]}"
+    )
+
+@callbacks.route("suspend_user")
+async def suspend_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = int(context.args[0])
+
+    # Suspend subscription
+    await update_user_subscription(user_id, False, None)
+
+    # Remove user from linked group if exists
+    linked_group = await get_linked_group()
+    if linked_group:
+        try:
+            # Check if user is in the group first
+            member = await context.bot.get_chat_member(linked_group, user_id)
+            if member.status not in ['left', 'kicked']:
+                # Kick user from group
+                await context.bot.ban_chat_member(linked_group, user_id)
+                # Immediately unban to allow them to rejoin later if they resubscribe
+                await context.bot.unban_chat_member(linked_group, user_id)
+                group_removal_msg = "\n🚫 تم إزالته من المجموعة"
+            else:
+                group_removal_msg = "\n📝 المستخدم لم يكن في المجموعة"
+        except Exception as e:
+            group_removal_msg = f"\n⚠️ خطأ في إزالة المستخدم من المجموعة: {str(e)}"
+    else:
+        group_removal_msg = "\n📝 لا توجد مجموعة مربوطة"
+
+    user_data = await get_user(user_id)
+    try:
+        await context.bot.send_message(
+            user_id,
+            f"⏸️ **تم إيقاف اشتراكك**\n\n"
+            f"📝 تم إيقاف اشتراكك من قبل الإدارة.\n"
+            f"🚫 تم إزالتك من مجموعة أكاديمية DevDZ\n"
+            f"💬 للاستفسار، تواصل مع الإدارة.\n\n"
+            f"يمكنك تجديد اشتراكك في أي وقت."
+        )
+    except:
+        pass
+
+    await query.edit_message_text(
+        f"⏸️ **تم إيقاف الاشتراك**\n\n"
+        f"👤 المستخدم: {user_data[2]}\n"
+        f"📊 الحالة: معلق{group_removal_msg}"
+    )
+
+@callbacks.route("promote_user")
+async def promote_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = int(context.args[0])
+
+    if await is_admin(user_id):
+        await query.answer("❌ المستخدم مشرف بالفعل", show_alert=True)
+        return
+
+    user_data = await get_user(user_id)
+    await add_admin(user_id, user_data[2])
+
+    try:
+        await context.bot.send_message(
+            user_id,
+            f"👑 **تهانينا! تم رفعك كمشرف**\n\n"
+            f"🎉 أصبحت الآن مشرفاً في أكاديمية DevDZ\n"
+            f"⚙️ يمكنك الوصول للوحة الإدارة من /start\n\n"
+            f"مبروك! 🎓"
+        )
+    except:
+        pass
+
+    await query.edit_message_text(
+        f"👑 **تم رفع المستخدم كمشرف**\n\n"
+        f"👤 المستخدم: {user_data[2]}\n"
+        f"🔰 الصلاحية الجديدة: مشرف"
+    )
+
+@callbacks.route("demote_user")
+async def demote_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = int(context.args[0])
+
+    if not await is_admin(user_id):
+        await query.answer("❌ المستخدم ليس مشرفاً", show_alert=True)
+        return
+
+    if await is_main_admin(user_id):
+        await query.answer("❌ لا يمكن إزالة المشرف الرئيسي", show_alert=True)
+        return
+
+    user_data = await get_user(user_id)
+    await remove_admin(user_id)
+
+    try:
+        await context.bot.send_message(
+            user_id,
+            f"👤 **تم إزالة صلاحيات الإدارة**\n\n"
+            f"📝 تم إزالة صلاحيات الإدارة من حسابك\n"
+            f"👤 أصبحت الآن مستخدماً عادياً\n\n"
+            f"شكراً لخدمتك! 🎓"
+        )
+    except:
+        pass
+
+    await query.edit_message_text(
+        f"👤 **تم إزالة صلاحيات الإدارة**\n\n"
+        f"👤 المستخدم: {user_data[2]}\n"
+        f"🔰 الصلاحية الجديدة: مستخدم عادي"
+    )
+
+@callbacks.route("delete_user")
+async def delete_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = int(context.args[0])
+
+    if await is_main_admin(user_id):
+        await query.answer("❌ لا يمكن حذف المشرف الرئيسي", show_alert=True)
+        return
+
+    user_data = await get_user(user_id)
+
+    keyboard = [
+        [InlineKeyboardButton("✅ نعم، احذف", callback_data=encode_callback("confirm_delete", user_id))],
+        [InlineKeyboardButton("❌ إلغاء", callback_data=encode_callback("manage_user", user_id))]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await query.edit_message_text(
+        f"⚠️ **تأكيد الحذف**\n\n"
+        f"👤 المستخدم: {user_data[2]}\n"
+        f"🆔 المعرف: {user_id}\n\n"
+        f"❗ هذا الإجراء لا يمكن التراجع عنه!\n"
+        f"سيتم حذف جميع بيانات المستخدم.\n\n"
+        f"هل أنت متأكد؟",
+        reply_markup=reply_markup
+    )
+
+@callbacks.route("confirm_delete")
+async def confirm_delete_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = int(context.args[0])
+    user_data = await get_user(user_id)
+
+    from bot.async_database import remove_user
+    success = await remove_user(user_id)
+
+    if success:
         # Remove user from linked group if exists
-        linked_group = get_linked_group()
+        linked_group = await get_linked_group()
         if linked_group:
             try:
                 # Check if user is in the group first
@@ -1038,7 +1281,7 @@ async def subscription_callback(update: Update, context: ContextTypes.DEFAULT_TY
                     await context.bot.ban_chat_member(linked_group, user_id)
                     # Immediately unban to allow them to rejoin later if they resubscribe
                     await context.bot.unban_chat_member(linked_group, user_id)
-                    group_removal_msg = "\n🚫 تم إزالته من المجموعة"
+                    group_removal_msg = "\n🚫 تم إزالته من المجموعة المرتبطة"
                 else:
                     group_removal_msg = "\n📝 المستخدم لم يكن في المجموعة"
             except Exception as e:
@@ -1046,376 +1289,211 @@ async def subscription_callback(update: Update, context: ContextTypes.DEFAULT_TY
         else:
             group_removal_msg = "\n📝 لا توجد مجموعة مربوطة"
 
-        user_data = get_user(user_id)
         try:
             await context.bot.send_message(
                 user_id,
-                f"⏸️ **تم إيقاف اشتراكك**\n\n"
-                f"📝 تم إيقاف اشتراكك من قبل الإدارة.\n"
+                f"🗑️ **تم حذف حسابك**\n\n"
+                f"📝 تم حذف حسابك وجميع بياناتك من النظام\n"
                 f"🚫 تم إزالتك من مجموعة أكاديمية DevDZ\n"
-                f"💬 للاستفسار، تواصل مع الإدارة.\n\n"
-                f"يمكنك تجديد اشتراكك في أي وقت."
+                f"💬 للاستفسار، تواصل مع الإدارة\n\n"
+                f"يمكنك إنشاء حساب جديد في أي وقت بإرسال /start"
             )
         except:
             pass
 
         await query.edit_message_text(
-            f"⏸️ **تم إيقاف الاشتراك**\n\n"
+            f"🗑️ **تم حذف المستخدم بنجاح**\n\n"
             f"👤 المستخدم: {user_data[2]}\n"
-            f"📊 الحالة: معلق{group_removal_msg}"
+            f"🆔 المعرف: {user_id}\n\n"
+            f"✅ تم حذف جميع البيانات المرتبطة بالمستخدم{group_removal_msg}"
         )
+    else:
+        await query.edit_message_text("❌ فشل في حذف المستخدم")
 
-    elif query.data.startswith("promote_user_"):
-        if not is_main_admin(user.id):
-            await query.answer("❌ هذا الإجراء متاح للمشرف الرئيسي فقط", show_alert=True)
-            return
-    
-        user_id = int(query.data.replace("promote_user_", ""))
-    
-        if is_admin(user_id):
-            await query.answer("❌ المستخدم مشرف بالفعل", show_alert=True)
-            return
-    
-        user_data = get_user(user_id)
-        add_admin(user_id, user_data[2])
-    
-        try:
-            await context.bot.send_message(
-                user_id,
-                f"👑 **تهانينا! تم رفعك كمشرف**\n\n"
-                f"🎉 أصبحت الآن مشرفاً في أكاديمية DevDZ\n"
-                f"⚙️ يمكنك الوصول للوحة الإدارة من /start\n\n"
-                f"مبروك! 🎓"
-            )
-        except:
-            pass
+@callbacks.route("back_to_main")
+async def back_to_main_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    user = query.from_user
     
-        await query.edit_message_text(
-            f"👑 **تم رفع المستخدم كمشرف**\n\n"
-            f"👤 المستخدم: {user_data[2]}\n"
-            f"🔰 الصلاحية الجديدة: مشرف"
-        )
+    keyboard = [
+        [InlineKeyboardButton("📚 الاشتراك", callback_data="subscribe")],
+        [InlineKeyboardButton("📊 حالة الاشتراك", callback_data="status")],
+        [InlineKeyboardButton("🔗 رابط الإحالة", callback_data="referral")],
+        [InlineKeyboardButton("❓ مساعدة", callback_data="help")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
 
-    elif query.data.startswith("demote_user_"):
-        if not is_main_admin(user.id):
-            await query.answer("❌ هذا الإجراء متاح للمشرف الرئيسي فقط", show_alert=True)
-            return
-    
-        user_id = int(query.data.replace("demote_user_", ""))
-    
-        if not is_admin(user_id):
-            await query.answer("❌ المستخدم ليس مشرفاً", show_alert=True)
-            return
-    
-        if is_main_admin(user_id):
-            await query.answer("❌ لا يمكن إزالة المشرف الرئيسي", show_alert=True)
-            return
-    
-        user_data = get_user(user_id)
-        remove_admin(user_id)
+    await query.edit_message_text(
+        f"مرحباً {user.first_name}! 👋\n\n"
+        f"🎓 أهلاً بك في أكاديمية DevDZ للبرمجة!\n\n"
+        f"💡 اختر من الأزرار أدناه:",
+        reply_markup=reply_markup
+    )
+
+@callbacks.route("admin_search_user")
+async def admin_search_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
     
-        try:
-            await context.bot.send_message(
-                user_id,
-                f"👤 **تم إزالة صلاحيات الإدارة**\n\n"
-                f"📝 تم إزالة صلاحيات الإدارة من حسابك\n"
-                f"👤 أصبحت الآن مستخدماً عادياً\n\n"
-                f"شكراً لخدمتك! 🎓"
-            )
-        except:
-            pass
+    keyboard = [[InlineKeyboardButton("🔙 إدارة المستخدمين", callback_data="admin_users")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await query.edit_message_text(
+        "🔍 **البحث عن مستخدم**\n\n"
+        "أرسل معرف المستخدم (User ID) أو اسم المستخدم (@username) للبحث عنه.\n\n"
+        "مثال:\n"
+        "• `123456789`\n"
+        "• `@username`\n\n"
+        "💡 يمكنك الحصول على معرف المستخدم من خلال إعادة توجيه رسالة منه إلى @userinfobot",
+        reply_markup=reply_markup,
+        parse_mode='Markdown'
+    )
+
+@callbacks.route("admin_requests")
+async def admin_requests_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
     
+    # Get linked group
+    linked_group = await get_linked_group()
+
+    if not linked_group:
+        keyboard = [[InlineKeyboardButton("🔙 لوحة الإدارة", callback_data="admin_panel")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text(
-            f"👤 **تم إزالة صلاحيات الإدارة**\n\n"
-            f"👤 المستخدم: {user_data[2]}\n"
-            f"🔰 الصلاحية الجديدة: مستخدم عادي"
+            "❌ **لا توجد مجموعة مربوطة**\n\n"
+            "يجب ربط مجموعة أولاً باستخدام /link_group",
+            reply_markup=reply_markup
         )
+        return
+
+    try:
+        # Try to get group info to check if bot has access
+        group_info = await context.bot.get_chat(linked_group)
 
-    elif query.data.startswith("delete_user_"):
-        if not is_main_admin(user.id):
-            await query.answer("❌ هذا الإجراء متاح للمشف الرئيسي فقط", show_alert=True)
-            return
-    
-        user_id = int(query.data.replace("delete_user_", ""))
-    
-        if is_main_admin(user_id):
-            await query.answer("❌ لا يمكن حذف المشرف الرئيسي", show_alert=True)
-            return
-    
-        user_data = get_user(user_id)
-    
         keyboard = [
-            [InlineKeyboardButton("✅ نعم، احذف", callback_data=f"confirm_delete_{user_id}")],
-            [InlineKeyboardButton("❌ إلغاء", callback_data=f"manage_user_{user_id}")]
+            [InlineKeyboardButton("🔄 تحديث", callback_data="admin_requests")],
+            [InlineKeyboardButton("🔙 لوحة الإدارة", callback_data="admin_panel")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-    
+
         await query.edit_message_text(
-            f"⚠️ **تأكيد الحذف**\n\n"
-            f"👤 المستخدم: {user_data[2]}\n"
-            f"🆔 المعرف: {user_id}\n\n"
-            f"❗ هذا الإجراء لا يمكن التراجع عنه!\n"
-            f"سيتم حذف جميع بيانات المستخدم.\n\n"
-            f"هل أنت متأكد؟",
+            f"📋 **طلبات الانضمام للمجموعة**\n\n"
+            f"📱 **المجموعة:** {group_info.title}\n"
+            f"🆔 **المعرف:** {linked_group}\n\n"
+            f"ℹ️ **ملاحظة:**\n"
+            f"طلبات الانضمام يتم التعامل معها تلقائياً:\n"
+            f"• ✅ قبول المشتركين النشطين\n"
+            f"• ❌ رفض غير المشتركين مع توجيههم للاشتراك\n\n"
+            f"📊 لمراجعة المستخدمين، استخدم قسم 'إدارة المستخدمين'",
             reply_markup=reply_markup
         )
 
-    elif query.data.startswith("confirm_delete_"):
-        if not is_main_admin(user.id):
-            await query.answer("❌ هذا الإجراء متاح للمشرف الرئيسي فقط", show_alert=True)
-            return
-
-        user_id = int(query.data.replace("confirm_delete_", ""))
-        user_data = get_user(user_id)
-
-        from bot.database import remove_user
-        success = remove_user(user_id)
-
-        if success:
-            # Remove user from linked group if exists
-            linked_group = get_linked_group()
-            if linked_group:
-                try:
-                    # Check if user is in the group first
-                    member = await context.bot.get_chat_member(linked_group, user_id)
-                    if member.status not in ['left', 'kicked']:
-                        # Kick user from group
-                        await context.bot.ban_chat_member(linked_group, user_id)
-                        # Immediately unban to allow them to rejoin later if they resubscribe
-                        await context.bot.unban_chat_member(linked_group, user_id)
-                        group_removal_msg = "\n🚫 تم إزالته من المجموعة المرتبطة"
-                    else:
-                        group_removal_msg = "\n📝 المستخدم لم يكن في المجموعة"
-                except Exception as e:
-                    group_removal_msg = f"\n⚠️ خطأ في إزالة المستخدم من المجموعة: {str(e)}"
-            else:
-                group_removal_msg = "\n📝 لا توجد مجموعة مربوطة"
-        
-            try:
-                await context.bot.send_message(
-                    user_id,
-                    f"🗑️ **تم حذف حسابك**\n\n"
-                    f"📝 تم حذف حسابك وجميع بياناتك من النظام\n"
-                    f"🚫 تم إزالتك من مجموعة أكاديمية DevDZ\n"
-                    f"💬 للاستفسار، تواصل مع الإدارة\n\n"
-                    f"يمكنك إنشاء حساب جديد في أي وقت بإرسال /start"
-                )
-            except:
-                pass
-    
-            await query.edit_message_text(
-                f"🗑️ **تم حذف المستخدم بنجاح**\n\n"
-                f"👤 المستخدم: {user_data[2]}\n"
-                f"🆔 المعرف: {user_id}\n\n"
-                f"✅ تم حذف جميع البيانات المرتبطة بالمستخدم{group_removal_msg}"
-            )
-        else:
-            await query.edit_message_text("❌ فشل في حذف المستخدم")
-    
-    elif query.data == "back_to_main":
-        keyboard = [
-            [InlineKeyboardButton("📚 الاشتراك", callback_data="subscribe")],
-            [InlineKeyboardButton("📊 حالة الاشتراك", callback_data="status")],
-            [InlineKeyboardButton("🔗 رابط الإحالة", callback_data="referral")],
-            [InlineKeyboardButton("❓ مساعدة", callback_data="help")]
-        ]
+    except Exception as e:
+        keyboard = [[InlineKeyboardButton("🔙 لوحة الإدارة", callback_data="admin_panel")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await query.edit_message_text(
-            f"مرحباً {user.first_name}! 👋\n\n"
-            f"🎓 أهلاً بك في أكاديمية DevDZ للبرمجة!\n\n"
-            f"💡 اختر من الأزرار أدناه:",
+            f"❌ **خطأ في الوصول للمجموعة**\n\n"
+            f"🆔 المعرف: {linked_group}\n"
+            f"⚠️ الخطأ: {str(e)}\n\n"
+            f"💡 قد تحتاج لربط المجموعة مرة أخرى",
             reply_markup=reply_markup
         )
-    elif query.data == "admin_search_user":
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
-        
-        keyboard = [[InlineKeyboardButton("🔙 إدارة المستخدمين", callback_data="admin_users")]]
+
+@callbacks.route("admin_members")
+async def admin_members_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    # Get linked group
+    linked_group = await get_linked_group()
+
+    if not linked_group:
+        keyboard = [[InlineKeyboardButton("🔙 لوحة الإدارة", callback_data="admin_panel")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await query.edit_message_text(
-            "🔍 **البحث عن مستخدم**\n\n"
-            "أرسل معرف المستخدم (User ID) أو اسم المستخدم (@username) للبحث عنه.\n\n"
-            "مثال:\n"
-            "• `123456789`\n"
-            "• `@username`\n\n"
-            "💡 يمكنك الحصول على معرف المستخدم من خلال إعادة توجيه رسالة منه إلى @userinfobot",
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
+            "❌ **لا توجد مجموعة مربوطة**\n\n"
+            "يجب ربط مجموعة أولاً باستخدام /link_group",
+            reply_markup=reply_markup
         )
+        return
 
-    elif query.data == "admin_requests":
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
-        
-        # Get linked group
-        linked_group = get_linked_group()
-        
-        if not linked_group:
-            keyboard = [[InlineKeyboardButton("🔙 لوحة الإدارة", callback_data="admin_panel")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                "❌ **لا توجد مجموعة مربوطة**\n\n"
-                "يجب ربط مجموعة أولاً باستخدام /link_group",
-                reply_markup=reply_markup
-            )
-            return
-        
-        try:
-            # Try to get group info to check if bot has access
-            group_info = await context.bot.get_chat(linked_group)
-            
-            keyboard = [
-                [InlineKeyboardButton("🔄 تحديث", callback_data="admin_requests")],
-                [InlineKeyboardButton("🔙 لوحة الإدارة", callback_data="admin_panel")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                f"📋 **طلبات الانضمام للمجموعة**\n\n"
-                f"📱 **المجموعة:** {group_info.title}\n"
-                f"🆔 **المعرف:** {linked_group}\n\n"
-                f"ℹ️ **ملاحظة:**\n"
-                f"طلبات الانضمام يتم التعامل معها تلقائياً:\n"
-                f"• ✅ قبول المشتركين النشطين\n"
-                f"• ❌ رفض غير المشتركين مع توجيههم للاشتراك\n\n"
-                f"📊 لمراجعة المستخدمين، استخدم قسم 'إدارة المستخدمين'",
-                reply_markup=reply_markup
-            )
-            
-        except Exception as e:
-            keyboard = [[InlineKeyboardButton("🔙 لوحة الإدارة", callback_data="admin_panel")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                f"❌ **خطأ في الوصول للمجموعة**\n\n"
-                f"🆔 المعرف: {linked_group}\n"
-                f"⚠️ الخطأ: {str(e)}\n\n"
-                f"💡 قد تحتاج لربط المجموعة مرة أخرى",
-                reply_markup=reply_markup
-            )
+    try:
+        # Get group info
+        group_info = await context.bot.get_chat(linked_group)
+        member_count = await context.bot.get_chat_member_count(linked_group)
 
-    elif query.data == "admin_members":
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
-        
-        # Get linked group
-        linked_group = get_linked_group()
-        
-        if not linked_group:
-            keyboard = [[InlineKeyboardButton("🔙 لوحة الإدارة", callback_data="admin_panel")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                "❌ **لا توجد مجموعة مربوطة**\n\n"
-                "يجب ربط مجموعة أولاً باستخدام /link_group",
-                reply_markup=reply_markup
-            )
-            return
-        
-        try:
-            # Get group info
-            group_info = await context.bot.get_chat(linked_group)
-            member_count = await context.bot.get_chat_member_count(linked_group)
-            
-            # Get active subscribers count
-            from bot.database import get_all_active_users
-            active_users = get_all_active_users()
-            
-            keyboard = [
-                [InlineKeyboardButton("👥 عرض المشتركين النشطين", callback_data="admin_active_users")],
-                [InlineKeyboardButton("🔄 تنظيف المجموعة", callback_data="admin_cleanup_group")],
-                [InlineKeyboardButton("🔄 تحديث", callback_data="admin_members")],
-                [InlineKeyboardButton("🔙 لوحة الإدارة", callback_data="admin_panel")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                f"👥 **أعضاء المجموعة**\n\n"
-                f"📱 **المجموعة:** {group_info.title}\n"
-                f"🆔 **المعرف:** {linked_group}\n"
-                f"👥 **إجمالي الأعضاء:** {member_count}\n"
-                f"✅ **المشتركين النشطين:** {len(active_users)}\n\n"
-                f"🔧 **الإجراءات المتاحة:**\n"
-                f"• عرض قائمة المشتركين النشطين\n"
-                f"• تنظيف المجموعة (إزالة منتهي الصلاحية)\n"
-                f"• إدارة المستخدمين الفردية",
-                reply_markup=reply_markup
-            )
-            
-        except Exception as e:
-            keyboard = [[InlineKeyboardButton("🔙 لوحة الإدارة", callback_data="admin_panel")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                f"❌ **خطأ في الوصول للمجموعة**\n\n"
-                f"🆔 المعرف: {linked_group}\n"
-                f"⚠️ الخطأ: {str(e)}\n\n"
-                f"💡 قد تحتاج لربط المجموعة مرة أخرى",
-                reply_markup=reply_markup
-            )
+        # Get active subscribers count
+        from bot.async_database import get_all_active_users
+        active_users = await get_all_active_users(include_blocked=True)
 
-    elif query.data == "admin_cleanup_group":
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
-        
         keyboard = [
-            [InlineKeyboardButton("✅ نعم، نظف المجموعة", callback_data="confirm_cleanup_group")],
-            [InlineKeyboardButton("❌ إلغاء", callback_data="admin_members")]
+            [InlineKeyboardButton("👥 عرض المشتركين النشطين", callback_data="admin_active_users")],
+            [InlineKeyboardButton("🔄 تنظيف المجموعة", callback_data="admin_cleanup_group")],
+            [InlineKeyboardButton("🔄 تحديث", callback_data="admin_members")],
+            [InlineKeyboardButton("🔙 لوحة الإدارة", callback_data="admin_panel")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        
+
         await query.edit_message_text(
-            "⚠️ **تأكيد تنظيف المجموعة**\n\n"
-            "🔄 سيتم البحث عن المستخدمين منتهي الصلاحية وإزالتهم من المجموعة.\n\n"
-            "📝 **ما سيحدث:**\n"
-            "• فحص جميع المستخدمين في قاعدة البيانات\n"
-            "• إزالة المستخدمين منتهي الصلاحية من المجموعة\n"
-            "• إرسال إشعار للمستخدمين المحذوفين\n"
-            "• تقرير بالنتائج\n\n"
-            "❗ هذا الإجراء لا يمكن التراجع عنه!\n\n"
-            "هل أنت متأكد؟",
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
+            f"👥 **أعضاء المجموعة**\n\n"
+            f"📱 **المجموعة:** {group_info.title}\n"
+            f"🆔 **المعرف:** {linked_group}\n"
+            f"👥 **إجمالي الأعضاء:** {member_count}\n"
+            f"✅ **المشتركين النشطين:** {len(active_users)}\n\n"
+            f"🔧 **الإجراءات المتاحة:**\n"
+            f"• عرض قائمة المشتركين النشطين\n"
+            f"• تنظيف المجموعة (إزالة منتهي الصلاحية)\n"
+            f"• إدارة المستخدمين الفردية",
+            reply_markup=reply_markup
         )
 
-    elif query.data == "confirm_cleanup_group":
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
-        
-        await query.edit_message_text("🔄 **جاري تنظيف المجموعة...**\n\nيرجى الانتظار...")
-        
-        # Import the cleanup function
-        from bot.scheduler import remove_expired_users_from_group
-        
-        try:
-            # Run the cleanup
-            await remove_expired_users_from_group(context)
-            
-            keyboard = [[InlineKeyboardButton("🔙 إدارة الأعضاء", callback_data="admin_members")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                "✅ **تم تنظيف المجموعة بنجاح!**\n\n"
-                "🔄 تم فحص جميع المستخدمين وإزالة منتهي الصلاحية.\n"
-                "📊 تحقق من الرسائل السابقة لمعرفة التفاصيل.\n\n"
-                "💡 يتم تنظيف المجموعة تلقائياً كل يوم في الساعة 11 مساءً.",
-                reply_markup=reply_markup
-            )
-            
-        except Exception as e:
-            keyboard = [[InlineKeyboardButton("🔙 إدارة الأعضاء", callback_data="admin_members")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                f"❌ **خطأ في تنظيف المجموعة**\n\n"
-                f"⚠️ الخطأ: {str(e)}\n\n"
-                f"💡 تأكد من أن البوت مشرف في المجموعة مع صلاحيات كافية.",
-                reply_markup=reply_markup
-            )
+    except Exception as e:
+        keyboard = [[InlineKeyboardButton("🔙 لوحة الإدارة", callback_data="admin_panel")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await query.edit_message_text(
+            f"❌ **خطأ في الوصول للمجموعة**\n\n"
+            f"🆔 المعرف: {linked_group}\n"
+            f"⚠️ الخطأ: {str(e)}\n\n"
+            f"💡 قد تحتاج لربط المجموعة مرة أخرى",
+            reply_markup=reply_markup
+        )
+
+@callbacks.route("admin_cleanup_group")
+async def admin_cleanup_group_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    keyboard = [
+        [InlineKeyboardButton("✅ نعم، نظف المجموعة", callback_data="confirm_cleanup_group")],
+        [InlineKeyboardButton("❌ إلغاء", callback_data="admin_members")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await query.edit_message_text(
+        "⚠️ **تأكيد تنظيف المجموعة**\n\n"
+        "🔄 سيتم البحث عن المستخدمين منتهي الصلاحية وإزالتهم من المجموعة.\n\n"
+        "📝 **ما سيحدث:**\n"
+        "• فحص جميع المستخدمين في قاعدة البيانات\n"
+        "• إزالة المستخدمين منتهي الصلاحية من المجموعة\n"
+        "• إرسال إشعار للمستخدمين المحذوفين\n"
+        "• تقرير بالنتائج\n\n"
+        "❗ هذا الإجراء لا يمكن التراجع عنه!\n\n"
+        "هل أنت متأكد؟",
+        reply_markup=reply_markup,
+        parse_mode='Markdown'
+    )
+
+@callbacks.route("confirm_cleanup_group")
+async def confirm_cleanup_group_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    keyboard = [[InlineKeyboardButton("🔙 إدارة الأعضاء", callback_data="admin_members")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await _start_group_cleanup(context, query.message, reply_markup)
+
 
 async def handle_new_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle when new members join the linked group"""
@@ -1423,7 +1501,7 @@ async def handle_new_chat_members(update: Update, context: ContextTypes.DEFAULT_
         return
     
     chat = update.message.chat
-    linked_group = get_linked_group()
+    linked_group = _linked_group
     
     # Only handle joins in the linked group
     if not linked_group or chat.id != linked_group:
@@ -1505,9 +1583,10 @@ async def handle_new_chat_members(update: Update, context: ContextTypes.DEFAULT_
             except Exception as e:
                 logger.error(f"❌ Failed to revoke invite link for user {user_id}: {e}")
 
+@callbacks.route("back_to_quizzes")
 async def quiz_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    user_data = get_user(user.id)
+    user_data = await get_user(user.id)
     
     if not user_data or not user_data[3]:  # No active subscription
         keyboard = [
@@ -1522,15 +1601,7 @@ async def quiz_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    # Load available quizzes
-    available_quizzes = []
-    quiz_num = 1
-    while True:
-        quiz = load_quiz(quiz_num)
-        if quiz is None:
-            break
-        available_quizzes.append((quiz_num, quiz['title']))
-        quiz_num += 1
+    available_quizzes = get_quiz_catalog().titles()
     
     if not available_quizzes:
         await update.message.reply_text("❌ لا توجد اختبارات متاحة حالياً.")
@@ -1538,7 +1609,7 @@ async def quiz_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     keyboard = []
     for quiz_num, title in available_quizzes:
-        keyboard.append([InlineKeyboardButton(f"🧠 {title}", callback_data=f"quiz_{quiz_num}")])
+        keyboard.append([InlineKeyboardButton(f"🧠 {title}", callback_data=encode_callback("quiz", quiz_num))])
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -1548,90 +1619,112 @@ async def quiz_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
+@callbacks.route("quiz")
 async def quiz_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    if query.data.startswith("quiz_"):
-        quiz_num = int(query.data.replace("quiz_", ""))
-        quiz = load_quiz(quiz_num)
+    if context.args:
+        quiz_num = int(context.args[0])
+        quiz = get_quiz_catalog().get(quiz_num)
         
         if not quiz:
             await query.edit_message_text("❌ الاختبار غير متاح.")
             return
         
+        if quiz.weekly and await has_completed_quiz(update.effective_user.id, quiz_num):
+            keyboard = [[InlineKeyboardButton("🔄 اختبار آخر", callback_data="back_to_quizzes")]]
+            await query.edit_message_text(
+                "✅ لقد أكملت هذا الاختبار بالفعل.\n\nيمكن حل كل اختبار أسبوعي مرة واحدة فقط.",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+            return
+        
         # Store quiz session
-        context.user_data['current_quiz'] = quiz_num
-        context.user_data['quiz_questions'] = quiz['questions']
-        context.user_data['current_question'] = 0
-        context.user_data['score'] = 0
-        context.user_data['answers'] = []
+        context.user_data['quiz_session'] = QuizSession.start(quiz)
         
         # Start first question
         await show_question(update, context)
 
+async def _expired_quiz_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Tell the user their quiz session is gone (restart or quiz file updated)"""
+    context.user_data.pop('quiz_session', None)
+    keyboard = [[InlineKeyboardButton("🔄 اختبار آخر", callback_data="back_to_quizzes")]]
+    await update.callback_query.edit_message_text(
+        "⚠️ انتهت جلسة الاختبار أو تم تحديث الاختبار.\n\nيرجى البدء من جديد.",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
 async def show_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     
-    quiz_num = context.user_data['current_quiz']
-    questions = context.user_data['quiz_questions']
-    current_q = context.user_data['current_question']
+    session = context.user_data.get('quiz_session')
+    quiz = session.quiz() if session else None
+    if not quiz:
+        await _expired_quiz_session(update, context)
+        return
     
-    if current_q >= len(questions):
+    if session.finished(quiz):
         # Quiz finished
         await show_quiz_results(update, context)
         return
     
+    questions = quiz.questions
+    current_q = session.index
     question = questions[current_q]
     
     keyboard = []
-    for i, option in enumerate(question['options']):
-        keyboard.append([InlineKeyboardButton(f"{chr(65+i)}. {option}", callback_data=f"answer_{i}")])
+    for i, option in enumerate(question.options):
+        keyboard.append([InlineKeyboardButton(f"{chr(65+i)}. {option}", callback_data=encode_callback("answer", i))])
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     await query.edit_message_text(
         f"🧠 **السؤال {current_q + 1}/{len(questions)}**\n\n"
-        f"❓ {question['question']}\n\n"
+        f"❓ {question.question}\n\n"
         f"اختر الإجابة الصحيحة:",
         reply_markup=reply_markup
     )
 
+@callbacks.route("answer")
 async def answer_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    if query.data.startswith("answer_"):
-        answer_index = int(query.data.replace("answer_", ""))
-        
-        questions = context.user_data['quiz_questions']
-        current_q = context.user_data['current_question']
-        question = questions[current_q]
-        
-        # Check if answer is correct
-        is_correct = answer_index == question['correct']
-        if is_correct:
-            context.user_data['score'] += 1
+    if context.args:
+        answer_index = int(context.args[0])
         
-        context.user_data['answers'].append({
-            'question': question['question'],
-            'selected': answer_index,
-            'correct': question['correct'],
-            'is_correct': is_correct
-        })
+        session = context.user_data.get('quiz_session')
+        quiz = session.quiz() if session else None
+        if not quiz or session.finished(quiz):
+            await _expired_quiz_session(update, context)
+            return
         
-        # Move to next question
-        context.user_data['current_question'] += 1
+        # Check the answer and move to the next question
+        try:
+            session.record(quiz, answer_index)
+        except ValueError:
+            return
         
         await show_question(update, context)
 
 async def show_quiz_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     
-    quiz_num = context.user_data['current_quiz']
-    questions = context.user_data['quiz_questions']
-    score = context.user_data['score']
-    answers = context.user_data['answers']
+    session = context.user_data.pop('quiz_session')
+    quiz = session.quiz()
+    quiz_num = session.quiz_id
+    questions = quiz.questions
+    score = session.score
+    
+    result_id = await save_quiz_attempt(
+        update.effective_user.id, quiz_num, session.answers,
+        [question.correct for question in questions], once=quiz.weekly
+    )
+    if result_id is None:
+        # Finished twice in parallel (e.g. two chats); only the first attempt counts
+        await query.edit_message_text("✅ لقد أكملت هذا الاختبار بالفعل.")
+        return
     
     total_questions = len(questions)
     percentage = (score / total_questions) * 100
@@ -1655,11 +1748,12 @@ async def show_quiz_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Show detailed answers
     result_text += "📝 **مراجعة الإجابات:**\n\n"
-    for i, answer in enumerate(answers):
-        status = "✅" if answer['is_correct'] else "❌"
-        result_text += f"{status} **السؤال {i+1}:** {answer['question'][:50]}...\n"
-        if not answer['is_correct']:
-            correct_option = questions[i]['options'][answer['correct']]
+    for i, (question, selected) in enumerate(zip(questions, session.answers)):
+        is_correct = selected == question.correct
+        status = "✅" if is_correct else "❌"
+        result_text += f"{status} **السؤال {i+1}:** {question.question[:50]}...\n"
+        if not is_correct:
+            correct_option = question.options[question.correct]
             result_text += f"   الإجابة الصحيحة: {correct_option}\n"
         result_text += "\n"
     
@@ -1670,48 +1764,45 @@ async def show_quiz_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     await query.edit_message_text(result_text, reply_markup=reply_markup)
-    
-    # Clear quiz session
-    context.user_data.clear()
 
 # Admin commands
+@require_role(MAIN_ADMIN)
 async def add_admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_main_admin(update.effective_user.id):
-        await update.message.reply_text("❌ هذا الأمر متاح للمشرف الرئيسي فقط.")
-        return
-    
     if not context.args:
         await update.message.reply_text("❌ يرجى تحديد معرف المستخدم.\nمثال: /add_admin 123456789")
         return
     
     try:
         user_id = int(context.args[0])
-        add_admin(user_id)
+        await add_admin(user_id)
         await update.message.reply_text(f"✅ تم إضافة المشرف {user_id}")
     except ValueError:
         await update.message.reply_text("❌ معرف المستخدم يجب أن يكون رقماً.")
 
+@require_role(MAIN_ADMIN)
 async def remove_admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_main_admin(update.effective_user.id):
-        await update.message.reply_text("❌ هذا الأمر متاح للمشرف الرئيسي فقط.")
-        return
-    
     if not context.args:
         await update.message.reply_text("❌ يرجى تحديد معرف المستخدم.\nمثال: /remove_admin 123456789")
         return
     
     try:
         user_id = int(context.args[0])
-        remove_admin(user_id)
+        await remove_admin(user_id)
         await update.message.reply_text(f"✅ تم إزالة المشرف {user_id}")
     except ValueError:
         await update.message.reply_text("❌ معرف المستخدم يجب أن يكون رقماً.")
 
+@require_role(ADMIN)
+async def reload_admins_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Pick up admins added or removed by setup_admin.py while the bot runs"""
+    admin_ids = await refresh_admins()
+    await update.message.reply_text(f"✅ تم تحديث قائمة المشرفين ({len(admin_ids)} مشرف)")
+
 async def set_main_admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Only allow if no main admin is set, or if current user is main admin
-    current_main_admin = get_bot_setting('main_admin_id')
-    if current_main_admin and not is_main_admin(update.effective_user.id):
-        await update.message.reply_text("❌ هذا الأمر متاح للمشرف الرئيسي فقط.")
+    current_main_admin = await get_bot_setting('main_admin_id')
+    if current_main_admin and not await has_role(update, context, MAIN_ADMIN):
+        await deny(update, MAIN_ADMIN)
         return
     
     if not context.args:
@@ -1720,29 +1811,23 @@ async def set_main_admin_command(update: Update, context: ContextTypes.DEFAULT_T
     
     try:
         user_id = int(context.args[0])
-        set_main_admin(user_id)
+        await set_main_admin(user_id)
         await update.message.reply_text(f"✅ تم تعيين المشرف الرئيسي: {user_id}")
     except ValueError:
         await update.message.reply_text("❌ معرف المستخدم يجب أن يكون رقماً.")
 
+@require_role(ADMIN)
 async def set_admin_username_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("❌ هذا الأمر متاح للمشرفين فقط.")
-        return
-    
     if not context.args:
         await update.message.reply_text("❌ يرجى تحديد اسم المستخدم.\nمثال: /set_admin_username devdz_admin")
         return
     
     username = context.args[0].replace('@', '')
-    set_bot_setting('admin_username', username)
+    await set_bot_setting('admin_username', username)
     await update.message.reply_text(f"✅ تم تعيين اسم المستخدم للمشرف: @{username}")
 
+@require_role(MAIN_ADMIN)
 async def link_group_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_main_admin(update.effective_user.id):
-        await update.message.reply_text("❌ هذا الأمر متاح للمشرف الرئيسي فقط.")
-        return
-    
     chat = update.effective_chat
     user = update.effective_user
     
@@ -1788,7 +1873,7 @@ async def link_group_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     
     # Link the group
-    link_group(chat.id, chat.title)
+    await link_group(chat.id, chat.title)
     await update.message.reply_text(
         f"✅ **تم ربط المجموعة بنجاح!**\n\n"
         f"📱 **اسم المجموعة:** {chat.title}\n"
@@ -1796,12 +1881,9 @@ async def link_group_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         f"🎉 الآن عندما يتم قبول دفع أي مستخدم، سيحصل على رابط دعوة لمرة واحدة لهذه المجموعة."
     )
 
+@require_role(ADMIN)
 async def pending_payments_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("❌ هذا الأمر متاح للمشرفين فط.")
-        return
-    
-    pending = get_pending_payments()
+    pending = await get_pending_payments()
     
     if not pending:
         await update.message.reply_text("✅ لا توجد دفعات معلقة.")
@@ -1818,12 +1900,9 @@ async def pending_payments_command(update: Update, context: ContextTypes.DEFAULT
     
     await update.message.reply_text(message, parse_mode='Markdown')
 
+@require_role(ADMIN)
 async def check_linked_group_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("❌ هذا الأمر متاح للمشرفين فقط.")
-        return
-    
-    linked_group = get_linked_group()
+    linked_group = await get_linked_group()
     
     if not linked_group:
         await update.message.reply_text("❌ لا توجد مجموعة مربوطة حالياً.\n\nاستخدم /link_group في المجموعة التي تريد ربطها.")
@@ -1856,15 +1935,15 @@ async def handle_chat_join_request(update: Update, context: ContextTypes.DEFAULT
     chat = chat_join_request.chat
     
     # Check if this is the linked group
-    linked_group = get_linked_group()
+    linked_group = _linked_group
     if not linked_group or chat.id != linked_group:
         return
     
     # Add user to database if not exists
-    add_user(user.id, user.username, user.first_name)
+    await add_user(user.id, user.username, user.first_name)
     
     # Check if user has active subscription
-    user_data = get_user(user.id)
+    user_data = await get_user(user.id)
     
     if user_data and user_data[3]:  # has_subscription
         # User already has subscription, approve the request
@@ -1908,39 +1987,70 @@ async def handle_chat_join_request(update: Update, context: ContextTypes.DEFAULT
         except Exception as e:
             print(f"Error declining join request or sending message: {e}")
 
-async def cleanup_group_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("❌ هذا الأمر متاح للمشرفين فقط.")
-        return
-    
-    await update.message.reply_text("🔄 **جاري تنظيف المجموعة...**\n\nيرجى الانتظار...")
-    
-    # Import the cleanup function
+def _cleanup_result_text(summary):
+    """Admin reply for a manual group cleanup"""
+    if summary is None:
+        return "⏳ **تنظيف المجموعة قيد التنفيذ بالفعل**\n\nستصلك النتيجة عند انتهائه."
+    text = (
+        "✅ **تم تنظيف المجموعة بنجاح!**\n\n"
+        f"🗑️ تمت إزالة: {summary['removed']}\n"
+        f"⚠️ فشلت إزالة: {summary['failed']}\n"
+    )
+    if summary['pending']:
+        text += f"⏳ بانتظار ربط المجموعة: {summary['pending']}\n"
+    text += (
+        "📊 تحقق من الرسائل السابقة لمعرفة التفاصيل.\n\n"
+        "💡 يتم تنظيف المجموعة تلقائياً كل يوم في الساعة 11 مساءً."
+    )
+    return text
+
+async def _start_group_cleanup(context: ContextTypes.DEFAULT_TYPE, message, reply_markup=None):
+    """Run the group cleanup as a background task and put its result in `message`"""
     from bot.scheduler import remove_expired_users_from_group
-    
+    from bot.tasks import get_task_manager
+
+    async def cleanup(task):
+        return await remove_expired_users_from_group(context, progress=task.report)
+
+    # The result must not be overwritten by the "in progress" edit below
+    shown = asyncio.Event()
+
+    async def report(task):
+        await shown.wait()
+        if task.status == 'done':
+            text = _cleanup_result_text(task.result)
+        elif task.status == 'cancelled':
+            text = (
+                f"🛑 **تم إلغاء تنظيف المجموعة**\n\n"
+                f"🗑️ تمت معالجة {task.done} من {task.total or 0}.\n"
+                f"💡 سيتم إكمال الباقي في التنظيف القادم."
+            )
+        else:
+            text = (
+                f"❌ **خطأ في تنظيف المجموعة**\n\n"
+                f"⚠️ الخطأ: {task.error}\n\n"
+                f"💡 تأكد من أن البوت مشرف في المجموعة مع صلاحيات كافية."
+            )
+        await context.bot.edit_message_text(text, message.chat_id, message.message_id, reply_markup=reply_markup)
+
+    task = get_task_manager().start(
+        'cleanup', "تنظيف المجموعة", cleanup, owner_id=message.chat_id, on_finish=report
+    )
     try:
-        # Run the cleanup
-        await remove_expired_users_from_group(context)
-        
-        await update.message.reply_text(
-            "✅ **تم تنظيف المجموعة بنجاح!**\n\n"
-            "🔄 تم فحص جميع المستخدمين وإزالة منتهي الصلاحية.\n"
-            "📊 تحقق من الرسائل السابقة لمعرفة التفاصيل.\n\n"
-            "💡 يتم تنظيف المجموعة تلقائياً كل يوم في الساعة 11 مساءً."
-        )
-        
-    except Exception as e:
-        await update.message.reply_text(
-            f"❌ **خطأ في تنظيف المجموعة**\n\n"
-            f"⚠️ الخطأ: {str(e)}\n\n"
-            f"💡 تأكد من أن البوت مشرف في المجموعة مع صلاحيات كافية."
+        await message.edit_text(
+            f"🔄 **جاري تنظيف المجموعة...**\n\n"
+            f"🆔 المهمة #{task.id} — تابع التقدم بـ /tasks أو ألغها بـ /cancel_task {task.id}"
         )
+    finally:
+        shown.set()
+
+@require_role(ADMIN)
+async def cleanup_group_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = await update.message.reply_text("🔄 **جاري تنظيف المجموعة...**")
+    await _start_group_cleanup(context, message)
 
+@require_role(ADMIN)
 async def set_payment_info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("❌ هذا الأمر متاح للمشرفين فقط.")
-        return
-    
     if len(context.args) < 4:
         await update.message.reply_text(
             "❌ يرجى تحديد معلومات الدفع.\n\n"
@@ -1958,10 +2068,13 @@ async def set_payment_info_command(update: Update, context: ContextTypes.DEFAULT
     beneficiary_name = " ".join(context.args[3:]).replace("_", " ")
     
     # Save payment information
-    set_bot_setting('ccp_number', ccp_number)
-    set_bot_setting('baridimob_number', baridimob_number)
-    set_bot_setting('baridimoney_number', baridimoney_number)
-    set_bot_setting('beneficiary_name', beneficiary_name)
+    from bot.async_database import set_bot_settings
+    await set_bot_settings({
+        'ccp_number': ccp_number,
+        'baridimob_number': baridimob_number,
+        'baridimoney_number': baridimoney_number,
+        'beneficiary_name': beneficiary_name,
+    })
     
     await update.message.reply_text(
         f"✅ **تم تحديث معلومات الدفع:**\n\n"
@@ -1973,15 +2086,14 @@ async def set_payment_info_command(update: Update, context: ContextTypes.DEFAULT
         parse_mode='Markdown'
     )
 
+@require_role(ADMIN)
 async def get_payment_info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("❌ هذا الأمر متاح للمشرفين فقط.")
-        return
-    
-    ccp_number = get_bot_setting('ccp_number') or "غير محدد"
-    baridimob_number = get_bot_setting('baridimob_number') or "غير محدد"
-    baridimoney_number = get_bot_setting('baridimoney_number') or "غير محدد"
-    beneficiary_name = get_bot_setting('beneficiary_name') or "غير محدد"
+    from bot.async_database import get_bot_settings
+    settings = await get_bot_settings()
+    ccp_number = settings.get('ccp_number') or "غير محدد"
+    baridimob_number = settings.get('baridimob_number') or "غير محدد"
+    baridimoney_number = settings.get('baridimoney_number') or "غير محدد"
+    beneficiary_name = settings.get('beneficiary_name') or "غير محدد"
     
     await update.message.reply_text(
         f"💳 **معلومات الدفع الحالية:**\n\n"
@@ -1994,11 +2106,8 @@ async def get_payment_info_command(update: Update, context: ContextTypes.DEFAULT
         parse_mode='Markdown'
     )
 
+@require_role(ADMIN)
 async def send_announcement_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("❌ هذا الأمر متاح للمشرفين فقط.")
-        return
-    
     if not context.args:
         await update.message.reply_text(
             "❌ يرجى كتابة الإعلان.\n\n"
@@ -2020,7 +2129,7 @@ async def send_announcement_command(update: Update, context: ContextTypes.DEFAUL
     full_announcement = f"📢 **إعلان من أكاديمية DevDZ**\n\n{announcement_text}\n\n🎓 أكاديمية DevDZ للبرمجة"
     
     # Send to linked group first
-    linked_group = get_linked_group()
+    linked_group = await get_linked_group()
     group_sent = False
     if linked_group:
         try:
@@ -2033,61 +2142,30 @@ async def send_announcement_command(update: Update, context: ContextTypes.DEFAUL
         except Exception as e:
             print(f"Error sending announcement to group: {e}")
     
-    # Get all active subscribers
-    from bot.database import get_all_active_users
-    active_users = get_all_active_users()
-    
-    # Send to all active subscribers
-    sent_count = 0
-    failed_count = 0
-    
-    await update.message.reply_text("🔄 **جاري إرسال الإعلان...**\n\nيرجى الانتظار...")
-    
-    for user_id in active_users:
-        try:
-            await context.bot.send_message(
-                user_id,
-                full_announcement,
-                parse_mode='Markdown'
-            )
-            sent_count += 1
-        except Exception as e:
-            failed_count += 1
-            print(f"Failed to send announcement to user {user_id}: {e}")
-    
-    # Send summary report
-    report = f"✅ **تم إرسال الإعلان بنجاح!**\n\n"
-    report += f"📊 **تقرير الإرسال:**\n"
-    if group_sent:
-        report += f"📱 تم الإرسال للمجموعة: ✅\n"
-    else:
-        report += f"📱 تم الإرسال للمجموعة: ❌ (لا توجد مجموعة مربوطة أو خطأ)\n"
-    
-    report += f"👥 المشتركين النشطين: {len(active_users)}\n"
-    report += f"✅ تم الإرسال بنجاح: {sent_count}\n"
-    report += f"❌ فشل الإرسال: {failed_count}\n\n"
-    
-    if failed_count > 0:
-        report += f"💡 **ملاحظة:** قد يكون سبب فشل الإرسال:\n"
-        report += f"• المستخدم حظر البوت\n"
-        report += f"• المستخدم حذف حسابه\n"
-        report += f"• مشاكل تقنية مؤقتة"
+    status_message = await update.message.reply_text(
+        "🔄 **جاري إرسال الإعلان...**\n\n"
+        "سيتم إرسال تقرير عند الانتهاء، وتابع التقدم بـ /tasks."
+    )
     
-    await update.message.reply_text(report)
+    # Persisted job sent in the background: the handler returns immediately and
+    # an interrupted announcement resumes on the next start without re-sending
+    from bot.broadcast import start_job
+    await start_job(
+        context.application, "announcement", full_announcement, parse_mode='Markdown',
+        admin_chat_id=status_message.chat_id, status_message_id=status_message.message_id,
+        meta={'group_sent': group_sent},
+    )
 
+@callbacks.route("admin_announcements")
+@callbacks.route("create_announcement")
+@callbacks.route("announcement_stats")
 async def announcement_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    user = query.from_user
-    
     if query.data == "admin_announcements":
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
-        
         # Get linked group info
-        linked_group = get_linked_group()
+        linked_group = await get_linked_group()
         group_info = ""
         if linked_group:
             try:
@@ -2099,8 +2177,8 @@ async def announcement_callback(update: Update, context: ContextTypes.DEFAULT_TY
             group_info = f"❌ **المجموعة المربوطة:** غير مربوطة\n"
         
         # Get active users count
-        from bot.database import get_all_active_users
-        active_users = get_all_active_users()
+        from bot.async_database import get_all_active_users
+        active_users = await get_all_active_users()
         
         keyboard = [
             [InlineKeyboardButton("📝 إرسال إعلان جديد", callback_data="create_announcement")],
@@ -2124,10 +2202,6 @@ async def announcement_callback(update: Update, context: ContextTypes.DEFAULT_TY
         )
     
     elif query.data == "create_announcement":
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
-        
         keyboard = [[InlineKeyboardButton("🔙 إدارة الإعلانات", callback_data="admin_announcements")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
@@ -2150,16 +2224,13 @@ async def announcement_callback(update: Update, context: ContextTypes.DEFAULT_TY
         )
     
     elif query.data == "announcement_stats":
-        if not is_admin(user.id):
-            await query.answer("❌ غير مصرح لك بهذا الإجراء", show_alert=True)
-            return
-        
         # Get statistics
-        from bot.database import get_all_active_users
-        active_users = get_all_active_users()
+        from bot.async_database import get_all_active_users, get_blocked_users_count
+        active_users = await get_all_active_users()
+        blocked_count = await get_blocked_users_count()
         
         # Get linked group info
-        linked_group = get_linked_group()
+        linked_group = await get_linked_group()
         group_members = 0
         if linked_group:
             try:
@@ -2173,6 +2244,7 @@ async def announcement_callback(update: Update, context: ContextTypes.DEFAULT_TY
         await query.edit_message_text(
             f"📊 **إحصائيات الإعلانات**\n\n"
             f"👥 **المشتركين النشطين:** {len(active_users)}\n"
+            f"🚫 **حظروا البوت:** {blocked_count}\n"
             f"📱 **أعضاء المجموعة:** {group_members}\n\n"
             f"📋 **معلومات الإرسال:**\n"
             f"• يتم إرسال الإعلانات لجميع المشتركين النشطين\n"
@@ -2186,6 +2258,108 @@ async def announcement_callback(update: Update, context: ContextTypes.DEFAULT_TY
             reply_markup=reply_markup
         )
 
+@require_role(ADMIN)
+async def scheduled_jobs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    from bot.scheduler import get_scheduler
+    scheduler = get_scheduler()
+    if not scheduler:
+        await update.message.reply_text("❌ المهام المجدولة غير مفعلة.")
+        return
+    
+    message = "⏰ **المهام المجدولة**\n\n"
+    for job in scheduler.status():
+        state = "🔄 قيد التشغيل" if job['running'] else ("❌ فشل" if job['last_error'] else "✅")
+        message += f"{state} **{job['name']}**\n"
+        message += f"• آخر تشغيل: {job['last_run'] or 'لم يتم بعد'}\n"
+        if job['last_duration'] is not None:
+            message += f"• المدة: {job['last_duration']} ثانية\n"
+        message += f"• التشغيل القادم: {job['next_run'] or 'غير محدد'}\n"
+        if job['last_error']:
+            message += f"• الخطأ: {job['last_error']}\n"
+        message += "\n"
+    
+    await update.message.reply_text(message)
+
+@require_role(ADMIN)
+async def callback_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    rows = callbacks.stats()
+    if not rows:
+        await update.message.reply_text("📊 لم يتم الضغط على أي زر بعد.")
+        return
+    
+    lines = []
+    for row in rows:
+        p95 = f"≤{row['p95_ms']}" if row['p95_ms'] is not None else ">5000"
+        line = f"• {row['action']}: {row['count']} ضغطة، متوسط {row['mean_ms']} ms، p95 {p95} ms"
+        if row['errors']:
+            line += f"، أخطاء {row['errors']}"
+        if row['denied']:
+            line += f"، مرفوض {row['denied']}"
+        lines.append(line)
+    
+    from bot.broadcast import paginate
+    for page in paginate("📊 **زمن الاستجابة للأزرار**\n\n", lines):
+        await update.message.reply_text(page)
+
+TASK_STATES = {'running': "🔄", 'done': "✅", 'failed': "❌", 'cancelled': "🛑", 'interrupted': "⏸️"}
+TASK_KINDS = {'cleanup': "🧹 تنظيف المجموعة", 'broadcast': "📢 إرسال"}
+
+@require_role(ADMIN)
+async def tasks_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    from bot.tasks import get_task_manager
+    manager = get_task_manager()
+    tasks = manager.status() if manager else []
+    if not tasks:
+        await update.message.reply_text("⚙️ لا توجد مهام في الخلفية.")
+        return
+    
+    lines = []
+    for task in tasks:
+        line = f"{TASK_STATES[task['status']]} #{task['id']} {TASK_KINDS.get(task['kind'], task['kind'])}"
+        if task['kind'] != 'cleanup':
+            line += f" ({task['title']})"
+        if task['total']:
+            line += f" — {task['done']}/{task['total']} ({task['done'] * 100 // task['total']}%)"
+        line += f"، {task['seconds']:.0f} ثانية"
+        if task['error']:
+            line += f"\n   ⚠️ {task['error']}"
+        lines.append(line)
+    
+    from bot.broadcast import paginate
+    pages = paginate("⚙️ **المهام في الخلفية**\n\n", lines, "\n💡 للإلغاء: /cancel_task رقم_المهمة")
+    for page in pages:
+        await update.message.reply_text(page)
+
+@require_role(ADMIN)
+async def cancel_task_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args or not context.args[0].lstrip('#').isdigit():
+        await update.message.reply_text("❌ يرجى تحديد رقم المهمة.\nمثال: /cancel_task 3")
+        return
+    
+    from bot.tasks import get_task_manager
+    manager = get_task_manager()
+    task_id = int(context.args[0].lstrip('#'))
+    if manager and manager.cancel(task_id):
+        await update.message.reply_text(f"🛑 جاري إلغاء المهمة #{task_id}...")
+    else:
+        await update.message.reply_text(f"❌ لا توجد مهمة قيد التشغيل بالرقم {task_id}.")
+
+@require_role(ADMIN)
+async def update_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    processor = context.application.update_processor
+    if not hasattr(processor, 'snapshot'):
+        await update.message.reply_text("❌ المعالجة المتوازية للتحديثات غير مفعلة.")
+        return
+    
+    stats = processor.snapshot()
+    await update.message.reply_text(
+        f"⚙️ **معالجة التحديثات**\n\n"
+        f"• قيد المعالجة: {stats['active']} من {stats['max_concurrent']}\n"
+        f"• في الانتظار: {stats['waiting']} لدى {stats['backlogged_users']} مستخدم (أطول طابور: {stats['deepest_queue']})\n"
+        f"• تمت معالجتها: {stats['processed']}\n"
+        f"• انتظرت خلف تحديث سابق لنفس المستخدم: {stats['queued']} (أقصى عمق: {stats['max_depth']}، أطول انتظار: {stats['max_wait_ms']} ms)"
+    )
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log the error and send a telegram message to notify the developer."""
     logger.error("Exception while handling an update:", exc_info=context.error)
@@ -2215,6 +2389,10 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
             pass  # If we can't send the message, just continue
 
 def register_handlers(app):
+    callbacks.check_roles()
+    _on_linked_group_changed('linked_group_id', database.get_bot_setting('linked_group_id'))
+    database.subscribe_setting('linked_group_id', _on_linked_group_changed)
+
     # Add error handler first
     app.add_error_handler(error_handler)
     
@@ -2224,6 +2402,7 @@ def register_handlers(app):
     app.add_handler(CommandHandler("quiz", quiz_command))
     app.add_handler(CommandHandler("add_admin", add_admin_command))
     app.add_handler(CommandHandler("remove_admin", remove_admin_command))
+    app.add_handler(CommandHandler("reload_admins", reload_admins_command))
     app.add_handler(CommandHandler("set_main_admin", set_main_admin_command))
     app.add_handler(CommandHandler("set_admin_username", set_admin_username_command))
     app.add_handler(CommandHandler("link_group", link_group_command))
@@ -2233,6 +2412,11 @@ def register_handlers(app):
     app.add_handler(CommandHandler("set_payment_info", set_payment_info_command))
     app.add_handler(CommandHandler("get_payment_info", get_payment_info_command))
     app.add_handler(CommandHandler("announce", send_announcement_command))
+    app.add_handler(CommandHandler("jobs", scheduled_jobs_command))
+    app.add_handler(CommandHandler("callback_stats", callback_stats_command))
+    app.add_handler(CommandHandler("update_stats", update_stats_command))
+    app.add_handler(CommandHandler("tasks", tasks_command))
+    app.add_handler(CommandHandler("cancel_task", cancel_task_command))
     
     # Add chat join request handler
     from telegram.ext import ChatJoinRequestHandler
@@ -2242,8 +2426,6 @@ def register_handlers(app):
     from telegram.ext import MessageHandler, filters
     app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, handle_new_chat_members))
     
-    app.add_handler(CallbackQueryHandler(subscription_callback, pattern="^(subscribe|plan_|payment_completed|approve_|reject_|status|referral|help|back_to_main|admin_panel|admin_pending_payments|admin_stats|admin_users|admin_list_users|admin_search_user|admin_active_users|admin_expired_users|admin_requests|admin_members|admin_cleanup_group|confirm_cleanup_group|manage_user_|extend_user_|extend_days_|renew_user_|renew_plan_|suspend_user_|promote_user_|demote_user_|delete_user_|confirm_delete_)"))
-    app.add_handler(CallbackQueryHandler(announcement_callback, pattern="^(admin_announcements|create_announcement|announcement_stats)"))
-    app.add_handler(CallbackQueryHandler(quiz_callback, pattern="^quiz_"))
-    app.add_handler(CallbackQueryHandler(answer_callback, pattern="^answer_"))
-    app.add_handler(CallbackQueryHandler(lambda u, c: quiz_command(u, c), pattern="^back_to_quizzes$"))
+    # One handler for all inline buttons: actions are looked up in a dict
+    # instead of being tried one by one (see bot/router.py)
+    app.add_handler(CallbackQueryHandler(callbacks.dispatch))
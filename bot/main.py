@@ -3,7 +3,14 @@ import asyncio
 from dotenv import load_dotenv
 from telegram.ext import Application
 from bot.database import create_tables, migrate_database
+from bot import async_database
+from bot.broadcast import resume_jobs
+from bot.scheduler import setup_scheduler
 from bot.handlers import register_handlers
+from bot.quizzes import load_quizzes
+from bot.persistence import SQLitePersistence
+from bot.update_processor import OrderedUpdateProcessor
+from bot.tasks import setup_task_manager
 import logging
 import signal
 
@@ -60,9 +67,18 @@ async def main():
             
             # Create/update tables
             create_tables()
+            
+            # Parse the quiz files once; later edits are picked up without a restart
+            logger.info(f"Loaded {load_quizzes()} quizzes")
 
             # Create application with connection pool settings and timeouts
-            app = Application.builder().token(token).job_queue(None).build()
+            app = (
+                Application.builder().token(token).job_queue(None)
+                .persistence(SQLitePersistence())
+                # Different users' updates run in parallel, each user's in order
+                .concurrent_updates(OrderedUpdateProcessor())
+                .build()
+            )
             
             # Configure connection settings for better reliability
             app.bot._request.connection_pool_size = 8
@@ -70,6 +86,9 @@ async def main():
             app.bot._request.read_timeout = 30.0
             app.bot._request.write_timeout = 30.0
             
+            # Long admin operations (cleanup, announcements) run as tracked tasks
+            task_manager = setup_task_manager(app)
+            
             # Register all handlers
             register_handlers(app)
             
@@ -86,6 +105,13 @@ async def main():
                 bootstrap_retries=3
             )
             
+            # Pick up announcements interrupted by the last shutdown
+            await resume_jobs(app)
+            
+            # Start the recurring tasks (weekly quiz, reminders, group cleanup)
+            scheduler = setup_scheduler(app)
+            await scheduler.start()
+            
             # Set up signal handlers for graceful shutdown
             signal.signal(signal.SIGINT, signal_handler)
             signal.signal(signal.SIGTERM, signal_handler)
@@ -116,6 +142,10 @@ async def main():
             try:
                 if 'app' in locals() and hasattr(app, 'updater'):
                     print("🛑 Shutting down bot...")
+                    if 'scheduler' in locals():
+                        await scheduler.stop()
+                    if 'task_manager' in locals():
+                        await task_manager.stop()
                     if app.updater.running:
                         await app.updater.stop()
                     if app.running:
@@ -127,3 +157,4 @@ async def main():
 
 if __name__ == "__main__":
     asyncio.run(main())
+    async_database.shutdown()
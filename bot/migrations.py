@@ -0,0 +1,376 @@
+"""Versioned schema migrations for the bot database.
+
+The applied version lives in the schema_version table. Pending steps run in
+order inside the caller's write transaction, so a failed step leaves the
+database untouched. Once the schema is current, migrate() costs one SELECT.
+
+To change the schema, append a step with the next version number. Changing
+INDEXES also needs a new step so existing databases pick the index up.
+"""
+import sqlite3
+import time
+from datetime import datetime
+
+# Managed secondary indexes as (name, table, columns), one per hot access path.
+# ensure_indexes() creates them idempotently and drops retired idx_* indexes.
+INDEXES = (
+    # get_all_active_users, get_users_expiring_soon, check_expired_subscriptions, get_expired_users
+    ("idx_users_subscription", "users", "has_subscription, subscription_end"),
+    # get_recent_users, new users in get_user_stats
+    ("idx_users_join_date", "users", "join_date"),
+    # has_completed_quiz, get_quiz_results
+    ("idx_quiz_results_user_quiz", "quiz_results", "telegram_id, quiz_id"),
+    # get_quiz_question_stats (covering)
+    ("idx_quiz_answers_question", "quiz_answers", "quiz_id, question_index, is_correct"),
+    # weekly participants in get_quiz_stats
+    ("idx_quiz_results_date", "quiz_results", "date"),
+    # get_pending_payments, cleanup_old_payments
+    ("idx_payments_status_date", "payment_notifications", "status, date"),
+    # get_payment_history (newest first with a LIMIT)
+    ("idx_payments_date", "payment_notifications", "date"),
+    # get_payment_notification_by_user_id, approve/reject by user ID
+    ("idx_payments_user_status", "payment_notifications", "telegram_id, status, date"),
+    # add_referral, get_referral_stats, get_user_referrals
+    ("idx_referrals_referrer", "referrals", "referrer_id, referred_id"),
+    # remove_user
+    ("idx_referrals_referred", "referrals", "referred_id"),
+    # get_blocked_users_count, get_unreachable_users
+    ("idx_users_blocked", "users", "blocked_at"),
+    # get_pending_expiry_cleanups
+    ("idx_expiry_cleanups_status", "expiry_cleanups", "status"),
+    # claim_due_reminders
+    ("idx_expiry_reminders_status", "expiry_reminders", "status, subscription_end"),
+    # prune_callback_payloads
+    ("idx_callback_payloads_created", "callback_payloads", "created_at"),
+    # get_unfinished_broadcast_jobs at startup
+    ("idx_broadcast_jobs_status", "broadcast_jobs", "status"),
+    # get_latest_broadcast_job for the weekly quiz notice
+    ("idx_broadcast_jobs_kind", "broadcast_jobs", "kind, id"),
+)
+
+# (version, description, step) in the order they must run
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Register a migration step; versions must be added in increasing order"""
+    def decorator(step):
+        if MIGRATIONS and version <= MIGRATIONS[-1][0]:
+            raise ValueError(f"Migration {version} must be newer than {MIGRATIONS[-1][0]}")
+        MIGRATIONS.append((version, description, step))
+        return step
+    return decorator
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _columns(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return {column[1] for column in cursor.fetchall()}
+
+
+USERS_DDL = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        telegram_id INTEGER PRIMARY KEY,
+        username TEXT,
+        full_name TEXT,
+        has_subscription BOOLEAN DEFAULT 0,
+        subscription_end TEXT,
+        join_date TEXT,
+        last_active TEXT
+    )
+"""
+
+ADMINS_DDL = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        telegram_id INTEGER PRIMARY KEY,
+        full_name TEXT,
+        added_date TEXT
+    )
+"""
+
+
+@migration(1, "Base schema (converts the pre-versioning layout if present)")
+def _base_schema(cursor):
+    # Databases from before the rank/subscription_status rewrite: copy users
+    # across in one INSERT ... SELECT instead of row by row
+    users_columns = _columns(cursor, "users")
+    if {'rank', 'subscription_status'} <= users_columns:
+        now = _now()
+        cursor.execute(USERS_DDL.format(name="users_new"))
+        cursor.execute("""
+            INSERT OR IGNORE INTO users_new
+            (telegram_id, username, full_name, has_subscription, subscription_end, join_date, last_active)
+            SELECT telegram_id, username, full_name,
+                   CASE WHEN subscription_status IN ('نشط', 'دائم') THEN 1 ELSE 0 END,
+                   subscription_end, ?, ?
+            FROM users
+        """, (now, now))
+        cursor.execute("DROP TABLE users")
+        cursor.execute("ALTER TABLE users_new RENAME TO users")
+        cursor.execute("DROP TABLE IF EXISTS subscription_requests")
+
+    # Early admins tables only stored the telegram ID
+    admins_columns = _columns(cursor, "admins")
+    if admins_columns and 'full_name' not in admins_columns:
+        cursor.execute(ADMINS_DDL.format(name="admins_new"))
+        cursor.execute("""
+            INSERT OR IGNORE INTO admins_new (telegram_id, full_name, added_date)
+            SELECT telegram_id, 'Admin', ? FROM admins
+        """, (_now(),))
+        cursor.execute("DROP TABLE admins")
+        cursor.execute("ALTER TABLE admins_new RENAME TO admins")
+
+    cursor.execute(USERS_DDL.format(name="users"))
+    cursor.execute(ADMINS_DDL.format(name="admins"))
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS referrals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            referrer_id INTEGER,
+            referred_id INTEGER,
+            date TEXT,
+            FOREIGN KEY (referrer_id) REFERENCES users(telegram_id),
+            FOREIGN KEY (referred_id) REFERENCES users(telegram_id)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS quiz_results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER,
+            quiz_id INTEGER,
+            score INTEGER,
+            total_questions INTEGER,
+            date TEXT,
+            FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS payment_notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER,
+            username TEXT,
+            full_name TEXT,
+            plan_name TEXT,
+            amount TEXT,
+            date TEXT,
+            status TEXT DEFAULT 'pending',
+            FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bot_settings (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at TEXT
+        )
+    """)
+
+
+@migration(2, "Broadcast jobs and per-recipient deliveries")
+def _broadcast_jobs(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT,
+            text TEXT,
+            parse_mode TEXT,
+            status TEXT DEFAULT 'running',
+            total INTEGER DEFAULT 0,
+            last_user_id INTEGER DEFAULT 0,
+            admin_chat_id INTEGER,
+            status_message_id INTEGER,
+            meta TEXT,
+            created_at TEXT,
+            finished_at TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            job_id INTEGER,
+            telegram_id INTEGER,
+            status TEXT DEFAULT 'pending',
+            error TEXT,
+            updated_at TEXT,
+            PRIMARY KEY (job_id, telegram_id),
+            FOREIGN KEY (job_id) REFERENCES broadcast_jobs(id)
+        ) WITHOUT ROWID
+    """)
+
+
+@migration(3, "Track users who blocked the bot")
+def _blocked_users(cursor):
+    columns = _columns(cursor, "users")
+    if 'blocked_at' not in columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN blocked_at TEXT")
+    if 'failure_count' not in columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN failure_count INTEGER DEFAULT 0")
+
+
+@migration(4, "Expired member cleanup ledger")
+def _expiry_cleanups(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS expiry_cleanups (
+            telegram_id INTEGER,
+            subscription_end TEXT,
+            status TEXT DEFAULT 'pending',
+            error TEXT,
+            claimed_at TEXT,
+            processed_at TEXT,
+            PRIMARY KEY (telegram_id, subscription_end)
+        ) WITHOUT ROWID
+    """)
+
+
+@migration(5, "Expiry reminder ledger")
+def _expiry_reminders(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS expiry_reminders (
+            telegram_id INTEGER,
+            subscription_end TEXT,
+            reminder_kind INTEGER,
+            status TEXT DEFAULT 'pending',
+            error TEXT,
+            sent_at TEXT,
+            PRIMARY KEY (telegram_id, subscription_end, reminder_kind)
+        ) WITHOUT ROWID
+    """)
+
+
+@migration(6, "Per-question quiz answers")
+def _quiz_answers(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS quiz_answers (
+            result_id INTEGER,
+            question_index INTEGER,
+            quiz_id INTEGER,
+            selected INTEGER,
+            is_correct INTEGER,
+            PRIMARY KEY (result_id, question_index)
+        ) WITHOUT ROWID
+    """)
+
+
+@migration(7, "Persisted handler state")
+def _bot_persistence(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bot_persistence (
+            kind TEXT,
+            key TEXT,
+            value BLOB,
+            updated_at TEXT,
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID
+    """)
+
+
+@migration(8, "Server-side callback payloads")
+def _callback_payloads(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS callback_payloads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            action TEXT,
+            args TEXT,
+            created_at TEXT
+        )
+    """)
+
+
+@migration(9, "Look up broadcast jobs by kind")
+def _broadcast_jobs_kind(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_kind ON broadcast_jobs (kind, id)")
+
+
+def ensure_indexes(cursor):
+    """Create the managed secondary indexes and drop retired ones"""
+    for name, table, columns in INDEXES:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+
+    declared = {name for name, _, _ in INDEXES}
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'")
+    for (name,) in cursor.fetchall():
+        if name not in declared:
+            cursor.execute(f"DROP INDEX {name}")
+
+
+def current_version(cursor):
+    """Return the applied schema version, 0 for an unversioned database"""
+    try:
+        cursor.execute("SELECT MAX(version) FROM schema_version")
+    except sqlite3.OperationalError:  # no schema_version table yet
+        return 0
+    return cursor.fetchone()[0] or 0
+
+
+def latest_version():
+    return MIGRATIONS[-1][0]
+
+
+def migrate(cursor, dry_run=False):
+    """Apply pending migrations using a cursor inside a write transaction.
+
+    With dry_run the steps run inside a savepoint that is rolled back, so the
+    report's timings and row counts are measured rather than guessed.
+    """
+    start_version = current_version(cursor)
+    report = {
+        'from_version': start_version,
+        'to_version': start_version,
+        'dry_run': dry_run,
+        'steps': [],
+        'rows_touched': 0,
+        'seconds': 0.0,
+    }
+    pending = [step for step in MIGRATIONS if step[0] > start_version]
+    if not pending:
+        return report
+
+    conn = cursor.connection
+    cursor.execute("SAVEPOINT migrate")
+    try:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TEXT,
+                duration_ms REAL
+            )
+        """)
+        for version, description, step in pending:
+            changes_before = conn.total_changes
+            started = time.perf_counter()
+            step(cursor)
+            elapsed = time.perf_counter() - started
+            cursor.execute(
+                "INSERT INTO schema_version (version, description, applied_at, duration_ms) VALUES (?, ?, ?, ?)",
+                (version, description, _now(), round(elapsed * 1000, 3)),
+            )
+            report['steps'].append({
+                'version': version,
+                'description': description,
+                'rows_touched': conn.total_changes - changes_before,
+                'seconds': round(elapsed, 4),
+            })
+
+        started = time.perf_counter()
+        ensure_indexes(cursor)
+        report['steps'].append({
+            'version': None,
+            'description': "Managed indexes",
+            'rows_touched': 0,
+            'seconds': round(time.perf_counter() - started, 4),
+        })
+    except BaseException:
+        cursor.execute("ROLLBACK TO migrate")
+        cursor.execute("RELEASE migrate")
+        raise
+
+    if dry_run:
+        cursor.execute("ROLLBACK TO migrate")
+    cursor.execute("RELEASE migrate")
+
+    report['to_version'] = pending[-1][0]
+    report['rows_touched'] = sum(step['rows_touched'] for step in report['steps'])
+    report['seconds'] = round(sum(step['seconds'] for step in report['steps']), 4)
+    return report
@@ -0,0 +1,160 @@
+"""SQLite-backed persistence for python-telegram-bot.
+
+Keeps user_data, chat_data, bot_data, callback_data and conversation states
+in the bot_persistence table, so quiz progress and the invite links stored in
+bot_data survive a restart. The Application hands over the entries it used
+every `update_interval` seconds; each entry is pickled and compared with the
+digest of what was last written, only the ones that changed are queued, and
+the queue goes to SQLite in one transaction shortly after each round and on
+flush() at shutdown.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import pickle
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from bot.async_database import load_persistence, save_persistence
+
+logger = logging.getLogger(__name__)
+
+UPDATE_INTERVAL = float(os.getenv("DEVDZ_PERSISTENCE_INTERVAL", "30"))
+# How long a round of update_* calls may take before its batch is written
+BATCH_DELAY = 0.5
+
+USER, CHAT, BOT, CALLBACK = 'user', 'chat', 'bot', 'callback'
+
+
+def _digest(blob):
+    return hashlib.blake2b(blob, digest_size=16).digest()
+
+
+class SQLitePersistence(BasePersistence):
+    """BasePersistence that writes only changed entries, in batches"""
+
+    def __init__(self, store_data=None, update_interval=UPDATE_INTERVAL):
+        super().__init__(store_data=store_data or PersistenceInput(), update_interval=update_interval)
+        self._written = {}   # (kind, key) -> digest of the stored pickle
+        self._pending = {}   # (kind, key) -> pickle to write, or None to delete
+        self._flush_task = None
+        self.stats = {'batches': 0, 'rows_written': 0, 'unchanged': 0}
+
+    async def _load(self, kind):
+        rows = await load_persistence(kind)
+        for key, blob in rows:
+            self._written[(kind, key)] = _digest(blob)
+        return [(key, pickle.loads(blob)) for key, blob in rows]
+
+    def _stage(self, kind, key, value):
+        """Queue `value` for writing if it differs from what is stored"""
+        if value is None:
+            if (kind, key) not in self._written and (kind, key) not in self._pending:
+                return
+            self._pending[(kind, key)] = None
+        else:
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            if self._written.get((kind, key)) == _digest(blob):
+                self._pending.pop((kind, key), None)
+                self.stats['unchanged'] += 1
+                return
+            self._pending[(kind, key)] = blob
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(BATCH_DELAY)
+        try:
+            await self._write_pending()
+        except Exception as e:
+            logger.error(f"Failed to write persisted bot state: {e}")
+
+    async def _write_pending(self):
+        if not self._pending:
+            return
+        batch = self._pending
+        self._pending = {}
+        try:
+            await save_persistence([(kind, key, blob) for (kind, key), blob in batch.items()])
+        except Exception:
+            # Requeue unless a newer value was staged meanwhile
+            for entry, blob in batch.items():
+                self._pending.setdefault(entry, blob)
+            raise
+        for entry, blob in batch.items():
+            if blob is None:
+                self._written.pop(entry, None)
+            else:
+                self._written[entry] = _digest(blob)
+        self.stats['batches'] += 1
+        self.stats['rows_written'] += len(batch)
+
+    # Loading, once at startup
+
+    async def get_user_data(self):
+        return {int(key): value for key, value in await self._load(USER)}
+
+    async def get_chat_data(self):
+        return {int(key): value for key, value in await self._load(CHAT)}
+
+    async def get_bot_data(self):
+        # Stored per key, so one new invite link doesn't rewrite the whole dict
+        return dict(value for _, value in await self._load(BOT))
+
+    async def get_callback_data(self):
+        rows = await self._load(CALLBACK)
+        return rows[0][1] if rows else None
+
+    async def get_conversations(self, name):
+        return dict(value for _, value in await self._load(f"conversation:{name}"))
+
+    # Updates from the Application
+
+    async def update_user_data(self, user_id, data):
+        self._stage(USER, str(user_id), data or None)
+
+    async def update_chat_data(self, chat_id, data):
+        self._stage(CHAT, str(chat_id), data or None)
+
+    async def update_bot_data(self, data):
+        keys = {repr(key) for key in data}
+        for key, value in data.items():
+            self._stage(BOT, repr(key), (key, value))
+        for kind, key in list(self._written) + list(self._pending):
+            if kind == BOT and key not in keys:
+                self._stage(BOT, key, None)
+
+    async def update_callback_data(self, data):
+        self._stage(CALLBACK, '', data)
+
+    async def update_conversation(self, name, key, new_state):
+        kind = f"conversation:{name}"
+        self._stage(kind, repr(key), None if new_state is None else (key, new_state))
+
+    async def drop_user_data(self, user_id):
+        self._stage(USER, str(user_id), None)
+
+    async def drop_chat_data(self, chat_id):
+        self._stage(CHAT, str(chat_id), None)
+
+    # The in-memory data is always the newest copy, nothing to refresh
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        """Write everything still queued; called by Application.shutdown()"""
+        if self._flush_task and not self._flush_task.done():
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self._write_pending()
+        logger.info(
+            f"Persistence flushed: {self.stats['rows_written']} rows in {self.stats['batches']} batches, "
+            f"{self.stats['unchanged']} unchanged entries skipped"
+        )
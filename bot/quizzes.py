@@ -0,0 +1,191 @@
+"""Quiz catalog kept in memory and reloaded when files under quizzes/ change.
+
+Every quizN.json is parsed and validated once into immutable Quiz objects.
+/quiz and the quiz callbacks read from memory; at most every RELOAD_INTERVAL
+seconds the catalog stats the directory and re-reads only files whose mtime
+or size changed, so instructors can drop in a new quiz without a restart.
+"""
+import json
+import logging
+import os
+import re
+import time
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+QUIZ_DIR = os.getenv("DEVDZ_QUIZ_DIR", "quizzes")
+RELOAD_INTERVAL = float(os.getenv("DEVDZ_QUIZ_RELOAD_INTERVAL", "5"))
+
+FILE_RE = re.compile(r"^quiz(\d+)\.json$")
+
+
+class Question(NamedTuple):
+    question: str
+    options: tuple
+    correct: int
+
+
+class Quiz(NamedTuple):
+    number: int
+    title: str
+    questions: tuple
+    version: int = 0  # mtime_ns of the file it was read from
+    weekly: bool = True  # one attempt per user; "weekly": false allows retakes
+
+
+def parse_quiz(number, data):
+    """Build a Quiz from decoded JSON, raising ValueError if it is malformed"""
+    if not isinstance(data, dict) or not isinstance(data.get('title'), str):
+        raise ValueError("missing title")
+    raw_questions = data.get('questions')
+    if not isinstance(raw_questions, list) or not raw_questions:
+        raise ValueError("no questions")
+
+    questions = []
+    for index, item in enumerate(raw_questions, 1):
+        options = item.get('options') if isinstance(item, dict) else None
+        if not isinstance(item, dict) or not isinstance(item.get('question'), str):
+            raise ValueError(f"question {index} has no text")
+        if not isinstance(options, list) or len(options) < 2:
+            raise ValueError(f"question {index} needs at least two options")
+        correct = item.get('correct')
+        if not isinstance(correct, int) or not 0 <= correct < len(options):
+            raise ValueError(f"question {index} has an invalid correct index")
+        questions.append(Question(item['question'], tuple(str(option) for option in options), correct))
+    return Quiz(number, data['title'], tuple(questions), weekly=bool(data.get('weekly', True)))
+
+
+class QuizCatalog:
+    """All quizzes in `directory`, keyed by number"""
+
+    def __init__(self, directory=QUIZ_DIR, reload_interval=RELOAD_INTERVAL):
+        self.directory = directory
+        self.reload_interval = reload_interval
+        self._quizzes = {}
+        self._titles = ()
+        self._signatures = {}  # filename -> (mtime_ns, size) last read
+        self._checked = None
+        self.reloads = 0
+
+    def refresh(self, force=False):
+        """Re-read added or changed files and drop deleted ones"""
+        now = time.monotonic()
+        if not force and self._checked is not None and now - self._checked < self.reload_interval:
+            return
+        self._checked = now
+
+        seen = {}
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            entries = []
+        for entry in entries:
+            match = FILE_RE.match(entry.name)
+            if match and entry.is_file():
+                stat = entry.stat()
+                seen[entry.name] = (int(match.group(1)), (stat.st_mtime_ns, stat.st_size), entry.path)
+
+        changed = False
+        for name in list(self._signatures):
+            if name not in seen:
+                number = FILE_RE.match(name).group(1)
+                self._quizzes.pop(int(number), None)
+                del self._signatures[name]
+                logger.info(f"Quiz {name} removed")
+                changed = True
+
+        for name, (number, signature, path) in seen.items():
+            if self._signatures.get(name) == signature:
+                continue
+            self._signatures[name] = signature
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    quiz = parse_quiz(number, json.load(f))
+            except (OSError, ValueError) as e:
+                # Keep serving the last good version until the file is fixed
+                logger.error(f"Skipping invalid quiz file {name}: {e}")
+                continue
+            self.reloads += 1
+            self._quizzes[number] = quiz._replace(version=signature[0])
+            changed = True
+
+        if changed:
+            self._titles = tuple((number, self._quizzes[number].title) for number in sorted(self._quizzes))
+
+    def get(self, number):
+        """Quiz by number, or None"""
+        self.refresh()
+        return self._quizzes.get(number)
+
+    def titles(self):
+        """(number, title) for every quiz, in order"""
+        self.refresh()
+        return self._titles
+
+    def __len__(self):
+        return len(self._quizzes)
+
+
+class QuizSession:
+    """One user's progress through a quiz.
+
+    Holds the quiz number and version plus one byte per selected option;
+    question text stays in the shared catalog and results are rendered
+    from it at the end.
+    """
+
+    __slots__ = ('quiz_id', 'version', 'index', 'score', 'answers')
+
+    def __init__(self, quiz_id, version, index=0, score=0, answers=None):
+        self.quiz_id = quiz_id
+        self.version = version
+        self.index = index
+        self.score = score
+        self.answers = answers if answers is not None else bytearray()
+
+    @classmethod
+    def start(cls, quiz):
+        return cls(quiz.number, quiz.version)
+
+    def __getstate__(self):
+        return (self.quiz_id, self.version, self.index, self.score, bytes(self.answers))
+
+    def __setstate__(self, state):
+        quiz_id, version, index, score, answers = state
+        self.__init__(quiz_id, version, index, score, bytearray(answers))
+
+    def quiz(self, catalog=None):
+        """The quiz this session was started on, or None if it changed or was removed"""
+        quiz = (_catalog if catalog is None else catalog).get(self.quiz_id)
+        if quiz is None or quiz.version != self.version:
+            return None
+        return quiz
+
+    def finished(self, quiz):
+        return self.index >= len(quiz.questions)
+
+    def record(self, quiz, choice):
+        """Store the answer to the current question and return whether it was correct"""
+        question = quiz.questions[self.index]
+        if not 0 <= choice < len(question.options):
+            raise ValueError(f"option {choice} out of range")
+        self.answers.append(choice)
+        self.index += 1
+        correct = choice == question.correct
+        if correct:
+            self.score += 1
+        return correct
+
+
+_catalog = QuizCatalog()
+
+
+def get_quiz_catalog():
+    return _catalog
+
+
+def load_quizzes():
+    """Load the catalog at startup and return how many quizzes it holds"""
+    _catalog.refresh(force=True)
+    return len(_catalog)
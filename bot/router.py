@@ -0,0 +1,166 @@
+"""Dispatch inline-button presses through a dict of registered actions.
+
+callback_data is parsed once into (action, args): the compact encoding from
+bot.callback_codec, "action:arg1:arg2", or the older "action_arg1_arg2" form
+still sitting on buttons in sent messages. The handler registered for the
+action is looked up in a dict and called with context.args set to the
+arguments, the same way command handlers get theirs. Actions listed in the
+router's role table are checked with bot.auth before their handler runs. Every
+dispatch is timed into a per-action latency histogram.
+"""
+import bisect
+import logging
+import time
+
+from bot import auth, callback_codec
+from bot.async_database import get_callback_payload
+
+logger = logging.getLogger(__name__)
+
+SEPARATOR = ":"
+# Upper bounds in milliseconds; the last bucket counts everything slower
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class StoredArgs(int):
+    """Row ID of callback arguments kept in callback_payloads"""
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram for one action"""
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total_ms = 0.0
+        self.errors = 0
+        self.denied = 0
+
+    def record(self, ms):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, ms)] += 1
+        self.total_ms += ms
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile, or None if slower than all"""
+        target = self.count * p / 100
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return None
+
+
+class CallbackRouter:
+    """Maps callback actions to handlers.
+
+    `roles` maps an action to the bot.auth role it needs; actions not listed
+    are open to everyone.
+    """
+
+    def __init__(self, roles=None):
+        self._handlers = {}
+        self._histograms = {}
+        self._roles = dict(roles or {})
+        self.unknown = 0
+
+    def add(self, action, handler):
+        if action in self._handlers:
+            raise ValueError(f"Callback action {action!r} registered twice")
+        self._handlers[action] = handler
+        self._histograms[action] = LatencyHistogram()
+
+    def route(self, action):
+        """Decorator form of add()"""
+        def decorator(handler):
+            self.add(action, handler)
+            return handler
+        return decorator
+
+    def check_roles(self):
+        """Raise ValueError if the role table names an action nobody registered"""
+        unknown = sorted(set(self._roles) - set(self._handlers))
+        if unknown:
+            raise ValueError(f"Roles declared for unregistered callback actions: {unknown}")
+
+    def parse(self, data):
+        """Split callback_data into (action, args), or (None, []) if no action matches.
+
+        For encoded data whose arguments are stored server-side, args is the
+        StoredArgs row ID; dispatch() loads them.
+        """
+        if callback_codec.is_encoded(data):
+            try:
+                action, args, stored = callback_codec.decode(data)
+            except ValueError as e:
+                logger.warning(str(e))
+                return None, []
+            if action not in self._handlers or (stored and len(args) != 1):
+                return None, []
+            return action, StoredArgs(args[0]) if stored else args
+        if SEPARATOR in data:
+            action, *args = data.split(SEPARATOR)
+            return (action, args) if action in self._handlers else (None, [])
+        if data in self._handlers:
+            return data, []
+        # Legacy "action_arg_arg": the shortest registered prefix wins, so
+        # arguments may themselves contain underscores (plan_semi_annual)
+        index = data.find("_")
+        while index != -1:
+            if data[:index] in self._handlers:
+                return data[:index], data[index + 1:].split("_")
+            index = data.find("_", index + 1)
+        return None, []
+
+    async def dispatch(self, update, context):
+        """CallbackQueryHandler callback for every inline button"""
+        query = update.callback_query
+        action, args = self.parse(query.data or "")
+        if action is None:
+            self.unknown += 1
+            logger.warning(f"No handler for callback data {query.data!r}")
+            await query.answer()
+            return
+
+        histogram = self._histograms[action]
+        role = self._roles.get(action)
+        if role and not await auth.has_role(update, context, role):
+            histogram.denied += 1
+            await auth.deny(update, role)
+            return
+
+        if isinstance(args, StoredArgs):
+            args = await get_callback_payload(args, action)
+            if args is None:
+                logger.warning(f"Stored callback payload for {action!r} is gone")
+                await query.answer()
+                return
+
+        context.args = args
+        start = time.perf_counter()
+        try:
+            await self._handlers[action](update, context)
+        except Exception:
+            histogram.errors += 1
+            raise
+        finally:
+            histogram.record((time.perf_counter() - start) * 1000)
+
+    def stats(self):
+        """Per-action count, mean, p50/p95 bucket bound, errors and denials, busiest first"""
+        rows = []
+        for action, histogram in self._histograms.items():
+            if histogram.count or histogram.denied:
+                rows.append({
+                    'action': action,
+                    'count': histogram.count,
+                    'mean_ms': round(histogram.total_ms / histogram.count, 1) if histogram.count else 0,
+                    'p50_ms': histogram.percentile(50),
+                    'p95_ms': histogram.percentile(95),
+                    'errors': histogram.errors,
+                    'denied': histogram.denied,
+                })
+        return sorted(rows, key=lambda row: row['count'], reverse=True)
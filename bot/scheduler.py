@@ -1,157 +1,374 @@
+import asyncio
 import logging
-from datetime import datetime, time
+import os
+import random
+import time
+from datetime import datetime, timedelta, time as dtime
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from telegram.ext import ContextTypes
-from bot.database import get_users_expiring_soon, get_all_active_users, check_expired_subscriptions, get_linked_group
+from bot.broadcast import (
+    BLOCKED, CONCURRENCY, FAILED, SENT, call_with_limits, is_unreachable, paginate, run_job, send_with_limits
+)
+from bot.async_database import (
+    claim_due_reminders, record_reminder, claim_expired_users, record_expiry_cleanup, get_linked_group, create_broadcast_job,
+    get_latest_broadcast_job, mark_user_unreachable, get_bot_setting, set_bot_setting, prune_callback_payloads
+)
 
 logger = logging.getLogger(__name__)
 
+# Held while expired members are being removed; the daily job and the admin
+# cleanup button must not work through the same ledger rows at once
+_cleanup_lock = asyncio.Lock()
+
 async def send_weekly_quiz(context: ContextTypes.DEFAULT_TYPE):
     """Send weekly quiz notification to all active users"""
+    message = "🧠 كويز الأسبوع متاح الآن!\n\nاستخدم /quiz لبدء الحل\n⏰ لديك أسبوع كامل للإجابة"
+    
+    # One notice per scheduled slot: a run interrupted by a restart is
+    # finished by resume_jobs, so the catch-up run must not start another
+    slot = context.scheduled_for.strftime('%Y-%m-%d %H:%M')
+    latest = await get_latest_broadcast_job("weekly_quiz")
+    if latest and latest['meta'].get('slot') == slot:
+        logger.info(f"Weekly quiz notice for {slot} already sent, skipping")
+        return
+    
+    job_id = await create_broadcast_job("weekly_quiz", message, meta={'slot': slot})
+    stats = await run_job(context.bot, job_id)
+    logger.info(f"Weekly quiz notification sent to {stats.sent} users ({stats.rate:.1f}/s)")
+
+def _reminder_offsets():
+    """Days before expiry to remind on, from DEVDZ_REMINDER_DAYS (default 7,3,1)"""
+    raw = os.getenv("DEVDZ_REMINDER_DAYS", "7,3,1")
     try:
-        active_users = get_all_active_users()
-        message = "🧠 كويز الأسبوع متاح الآن!\n\nاستخدم /quiz لبدء الحل\n⏰ لديك أسبوع كامل للإجابة"
-        
-        sent_count = 0
-        for user_id in active_users:
-            try:
-                await context.bot.send_message(user_id, message)
-                sent_count += 1
-            except Exception as e:
-                logger.warning(f"Failed to send quiz notification to {user_id}: {e}")
-        
-        logger.info(f"Weekly quiz notification sent to {sent_count} users")
-    except Exception as e:
-        logger.error(f"Error sending weekly quiz: {e}")
+        offsets = sorted({int(day) for day in raw.split(",") if day.strip()}, reverse=True)
+    except ValueError:
+        offsets = []
+    if not offsets or min(offsets) < 0:
+        logger.warning(f"Invalid DEVDZ_REMINDER_DAYS {raw!r}, using 7,3,1")
+        return (7, 3, 1)
+    return tuple(offsets)
+
+def _days_left(subscription_end):
+    """Whole days from today until `subscription_end`"""
+    end = datetime.strptime(subscription_end[:10], "%Y-%m-%d").date()
+    return max((end - datetime.now().date()).days, 0)
+
+def _reminder_text(end_date, days_left):
+    if days_left <= 1:
+        when = "غداً" if days_left == 1 else "اليوم"
+    else:
+        when = f"خلال {days_left} أيام"
+    return f"⚠️ تنبيه: اشتراكك سينتهي {when} ({end_date})\n\n" \
+           f"لتجديد اشتراكك، استخدم /start واختر خطة الاشتراك"
 
 async def check_expiring_subscriptions(context: ContextTypes.DEFAULT_TYPE):
-    """Check for subscriptions expiring in 3 days and send reminders"""
-    try:
-        expiring_users = get_users_expiring_soon(days=3)
-        
-        for user_id, full_name, end_date in expiring_users:
+    """Send each due expiry reminder once per subscription period and return a report"""
+    report = {'sent': 0, 'failed': 0, 'blocked': 0, 'by_kind': {}}
+    due = await claim_due_reminders(_reminder_offsets())
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    # `kind` is the reminder's ledger key; the text uses the real days left
+    async def remind(user_id, full_name, end_date, kind):
+        async with semaphore:
             try:
-                message = f"⚠️ تنبيه: اشتراكك سينتهي في {end_date}\n\n" \
-                         f"لتجديد اشتراكك، استخدم /start واختر خطة الاشتراك"
-                
-                await context.bot.send_message(user_id, message)
+                await send_with_limits(context.bot, user_id, _reminder_text(end_date[:10], _days_left(end_date)))
             except Exception as e:
+                status = BLOCKED if is_unreachable(e) else FAILED
+                if status == BLOCKED:
+                    await mark_user_unreachable(user_id)
                 logger.warning(f"Failed to send expiry reminder to {user_id}: {e}")
-        
-        if expiring_users:
-            logger.info(f"Expiry reminders sent to {len(expiring_users)} users")
+                await record_reminder(user_id, end_date, kind, status, str(e))
+                report[status] += 1
+                return
+        await record_reminder(user_id, end_date, kind, SENT)
+        report['sent'] += 1
+        report['by_kind'][kind] = report['by_kind'].get(kind, 0) + 1
+
+    await asyncio.gather(*(remind(*row) for row in due))
+    if due:
+        by_kind = ", ".join(f"{kind}d: {count}" for kind, count in sorted(report['by_kind'].items()))
+        logger.info(
+            f"Expiry reminders: {report['sent']} sent ({by_kind}), "
+            f"{report['failed']} failed, {report['blocked']} blocked"
+        )
+    return report
+
+async def _remove_expired_user(bot, group_id, user_id, full_name):
+    """Kick one expired member from the group and tell them; returns an error or None"""
+    try:
+        await call_with_limits(lambda: bot.ban_chat_member(chat_id=group_id, user_id=user_id))
+        # Immediately unban to allow them to rejoin later if they renew
+        await call_with_limits(lambda: bot.unban_chat_member(chat_id=group_id, user_id=user_id))
     except Exception as e:
-        logger.error(f"Error checking expiring subscriptions: {e}")
+        return str(e)
 
-async def remove_expired_users_from_group(context: ContextTypes.DEFAULT_TYPE):
-    """Remove users with expired subscriptions from the linked group"""
     try:
-        # Check for expired subscriptions and get the list of expired users
-        expired_users = check_expired_subscriptions()
-        
-        if not expired_users:
-            return
-        
+        await send_with_limits(
+            bot, user_id,
+            f"⏰ **انتهى اشتراكك**\n\n"
+            f"👋 مرحباً {full_name}،\n\n"
+            f"📅 انتهت صلاحية اشتراكك اليوم وتم إزالتك من مجموعة أكاديمية DevDZ.\n\n"
+            f"🔄 **لتجديد اشتراكك:**\n"
+            f"• استخدم /start\n"
+            f"• اختر خطة الاشتراك المناسبة\n"
+            f"• أكمل عملية الدفع\n\n"
+            f"✨ بعد التجديد ستحصل على رابط دعوة جديد للمجموعة!\n\n"
+            f"شكراً لك على ثقتك في أكاديمية DevDZ 🎓"
+        )
+    except Exception as e:
+        # Removed from the group all the same; only the notice was lost
+        if is_unreachable(e):
+            await mark_user_unreachable(user_id)
+        else:
+            logger.warning(f"Could not notify expired user {user_id}: {e}")
+    return None
+
+async def remove_expired_users_from_group(context: ContextTypes.DEFAULT_TYPE, progress=None):
+    """Remove users with expired subscriptions from the linked group.
+
+    Expired users are queued in the expiry_cleanups ledger and checkpointed
+    one by one, so a run cut short by a restart or cancelled from /tasks
+    resumes with the members it had not reached yet instead of notifying
+    everyone again. `progress(done, total)` is called after each member.
+    Returns a summary dict, or None when another cleanup is already running.
+    """
+    if _cleanup_lock.locked():
+        logger.info("Group cleanup already running, skipping")
+        return None
+
+    async with _cleanup_lock:
+        pending = await claim_expired_users()
+        summary = {'removed': 0, 'failed': 0, 'pending': len(pending)}
+        if not pending:
+            return summary
+
         # Get linked group
-        linked_group = get_linked_group()
+        linked_group = await get_linked_group()
         if not linked_group:
+            # Leave the ledger rows pending for when a group is linked
             logger.warning("No linked group found for removing expired users")
-            return
-        
-        removed_count = 0
-        for user_id, full_name, username in expired_users:
-            try:
-                # Remove user from group
-                await context.bot.ban_chat_member(
-                    chat_id=linked_group,
-                    user_id=user_id
-                )
-                
-                # Immediately unban to allow them to rejoin later if they renew
-                await context.bot.unban_chat_member(
-                    chat_id=linked_group,
-                    user_id=user_id
-                )
-                
-                # Send notification to user
-                username_display = f"@{username}" if username else "المستخدم"
-                await context.bot.send_message(
-                    user_id,
-                    f"⏰ **انتهى اشتراكك**\n\n"
-                    f"👋 مرحباً {full_name}،\n\n"
-                    f"📅 انتهت صلاحية اشتراكك اليوم وتم إزالتك من مجموعة أكاديمية DevDZ.\n\n"
-                    f"🔄 **لتجديد اشتراكك:**\n"
-                    f"• استخدم /start\n"
-                    f"• اختر خطة الاشتراك المناسبة\n"
-                    f"• أكمل عملية الدفع\n\n"
-                    f"✨ بعد التجديد ستحصل على رابط دعوة جديد للمجموعة!\n\n"
-                    f"شكراً لك على ثقتك في أكاديمية DevDZ 🎓"
-                )
-                
-                removed_count += 1
+            return summary
+
+        semaphore = asyncio.Semaphore(CONCURRENCY)
+        removed, failed = [], []
+        if progress:
+            progress(0, len(pending))
+
+        async def process(user_id, full_name, username, subscription_end):
+            full_name = full_name or str(user_id)
+            async with semaphore:
+                error = await _remove_expired_user(context.bot, linked_group, user_id, full_name)
+            username_display = f"@{username}" if username else "بدون يوزر"
+            if error:
+                logger.warning(f"Failed to remove expired user {user_id} from group: {error}")
+                await record_expiry_cleanup(user_id, subscription_end, 'failed', error)
+                failed.append(f"• {full_name} ({username_display}): {error}")
+            else:
                 logger.info(f"Removed expired user {user_id} ({full_name}) from group")
-                
-            except Exception as e:
-                logger.warning(f"Failed to remove expired user {user_id} from group: {e}")
-        
-        if removed_count > 0:
-            logger.info(f"Removed {removed_count} expired users from group")
-            
-            # Notify admins about removed users
-            from bot.database import get_all_admins
-            admins = get_all_admins()
-            
-            admin_message = f"🔄 **تنظيف المجموعة التلقائي**\n\n"
-            admin_message += f"تم إزالة {removed_count} مستخدم منتهي الصلاحية من المجموعة:\n\n"
-            
-            for user_id, full_name, username in expired_users:
-                username_display = f"@{username}" if username else "بدون يوزر"
-                admin_message += f"• {full_name} ({username_display})\n"
-            
-            admin_message += f"\n📅 التاريخ: {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-            
-            for admin_id in admins:
+                await record_expiry_cleanup(user_id, subscription_end, 'removed')
+                removed.append(f"• {full_name} ({username_display})")
+            if progress:
+                progress(len(removed) + len(failed), len(pending))
+
+        await asyncio.gather(*(process(*row) for row in pending))
+        summary.update(removed=len(removed), failed=len(failed), pending=0)
+        logger.info(f"Group cleanup: {len(removed)} removed, {len(failed)} failed")
+
+        # Notify admins about removed users, split under Telegram's message limit
+        from bot.async_database import get_all_admins
+        header = (
+            f"🔄 **تنظيف المجموعة التلقائي**\n\n"
+            f"تم إزالة {len(removed)} مستخدم منتهي الصلاحية من المجموعة:\n\n"
+        )
+        lines = removed
+        if failed:
+            lines = removed + [f"\n⚠️ تعذر إزالة {len(failed)} مستخدم:"] + failed
+        footer = f"\n📅 التاريخ: {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+        pages = paginate(header, lines, footer)
+
+        for admin_id in await get_all_admins():
+            for page in pages:
                 try:
-                    await context.bot.send_message(admin_id, admin_message)
-                except:
-                    continue
-                    
-    except Exception as e:
-        logger.error(f"Error removing expired users from group: {e}")
+                    await send_with_limits(context.bot, admin_id, page)
+                except Exception as e:
+                    logger.warning(f"Could not send cleanup summary to admin {admin_id}: {e}")
+                    break
+        return summary
 
-def setup_scheduler(application):
-    """Setup job queue for scheduled tasks"""
-    try:
-        job_queue = application.job_queue
-        
-        if job_queue is None:
-            logger.warning(
-                "JobQueue is not available. Scheduled tasks will not run. "
-                "Install the job-queue extension with: pip install 'python-telegram-bot[job-queue]'"
-            )
+async def prune_callback_payloads_job(context: ContextTypes.DEFAULT_TYPE):
+    """Delete server-side callback payloads older than 30 days"""
+    pruned = await prune_callback_payloads(30)
+    if pruned:
+        logger.info(f"Pruned {pruned} stored callback payloads")
+
+class ScheduledJob:
+    """A coroutine that runs daily, or weekly on one weekday, at a wall-clock time"""
+
+    def __init__(self, name, callback, at, weekday=None, jitter=0):
+        self.name = name
+        self.callback = callback
+        self.at = at                # datetime.time in the scheduler's timezone
+        self.weekday = weekday      # 0 = Monday ... 6 = Sunday; None = every day
+        self.jitter = jitter        # random delay in seconds added to each run
+        self.lock = asyncio.Lock()  # one run at a time, scheduled or manual
+        self.last_run = None
+        self.last_duration = None
+        self.last_error = None
+        self.next_run = None
+        self.runs = 0
+        self.skipped = 0
+
+    def _matches(self, day):
+        return self.weekday is None or day.weekday() == self.weekday
+
+    def next_after(self, moment):
+        """First scheduled time strictly after `moment`"""
+        candidate = datetime.combine(moment.date(), self.at, tzinfo=moment.tzinfo)
+        while candidate <= moment or not self._matches(candidate):
+            candidate += timedelta(days=1)
+        return candidate
+
+    def previous_before(self, moment):
+        """Last scheduled time at or before `moment`"""
+        candidate = datetime.combine(moment.date(), self.at, tzinfo=moment.tzinfo)
+        while candidate > moment or not self._matches(candidate):
+            candidate -= timedelta(days=1)
+        return candidate
+
+    def status(self):
+        return {
+            'name': self.name,
+            'last_run': self.last_run.strftime('%Y-%m-%d %H:%M:%S') if self.last_run else None,
+            'last_duration': round(self.last_duration, 2) if self.last_duration is not None else None,
+            'last_error': self.last_error,
+            'next_run': self.next_run.strftime('%Y-%m-%d %H:%M:%S') if self.next_run else None,
+            'running': self.lock.locked(),
+            'runs': self.runs,
+            'skipped': self.skipped,
+        }
+
+
+class Scheduler:
+    """Runs ScheduledJobs on the bot's event loop; no PTB JobQueue needed.
+
+    A job whose last scheduled time passed while the bot was down runs once
+    on start. The time of each successful run is kept in bot_settings.
+    """
+
+    def __init__(self, application, timezone=None):
+        self.application = application
+        self.timezone = timezone
+        self.jobs = {}
+        self._tasks = []
+
+    def now(self):
+        return datetime.now(self.timezone).replace(microsecond=0) if self.timezone else datetime.now().replace(microsecond=0)
+
+    def daily(self, callback, at, name=None, jitter=0):
+        return self._add(ScheduledJob(name or callback.__name__, callback, at, None, jitter))
+
+    def weekly(self, callback, weekday, at, name=None, jitter=0):
+        return self._add(ScheduledJob(name or callback.__name__, callback, at, weekday, jitter))
+
+    def _add(self, job):
+        self.jobs[job.name] = job
+        return job
+
+    async def start(self):
+        for job in self.jobs.values():
+            stored = await get_bot_setting(f"scheduler_last_run:{job.name}")
+            if stored:
+                job.last_run = datetime.strptime(stored, '%Y-%m-%d %H:%M:%S')
+                if self.timezone:
+                    job.last_run = job.last_run.replace(tzinfo=self.timezone)
+            self._tasks.append(asyncio.create_task(self._loop(job)))
+        logger.info(f"Scheduler started with {len(self.jobs)} jobs")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _loop(self, job):
+        # Catch up once if the latest scheduled time passed while we were down
+        if job.last_run and job.last_run < job.previous_before(self.now()):
+            logger.info(f"Catching up missed run of {job.name}")
+            await self.run_now(job.name)
+
+        while True:
+            job.next_run = job.next_after(self.now()) + timedelta(seconds=random.uniform(0, job.jitter))
+            # Sleep in short steps so clock changes and suspends can't make us oversleep
+            while (remaining := (job.next_run - self.now()).total_seconds()) > 0:
+                await asyncio.sleep(min(remaining, 60))
+            await self.run_now(job.name)
+
+    async def run_now(self, name):
+        """Run a job immediately unless it is already running"""
+        job = self.jobs[name]
+        if job.lock.locked():
+            job.skipped += 1
+            logger.warning(f"Skipping {name}: previous run still in progress")
             return False
-        
-        # Send weekly quiz every Monday at 9 AM
-        job_queue.run_daily(
-            send_weekly_quiz,
-            time=time(hour=9, minute=0),
-            days=(0,)  # Monday
-        )
-        
-        # Check for expiring subscriptions daily at 10 AM
-        job_queue.run_daily(
-            check_expiring_subscriptions,
-            time=time(hour=10, minute=0)
-        )
-        
-        # Remove expired users from group daily at 11 PM
-        job_queue.run_daily(
-            remove_expired_users_from_group,
-            time=time(hour=23, minute=0)
-        )
-        
-        logger.info("Scheduled tasks have been set up")
+
+        async with job.lock:
+            started = time.perf_counter()
+            job.last_run = self.now()
+            context = self.application.context_types.context(self.application)
+            context.scheduled_for = job.previous_before(job.last_run)
+            try:
+                await job.callback(context)
+                job.last_error = None
+            except Exception as e:
+                job.last_error = str(e)
+                logger.error(f"Scheduled job {name} failed: {e}")
+            job.last_duration = time.perf_counter() - started
+            job.runs += 1
+            # Only a successful run counts, so a failed one is caught up after a restart
+            if job.last_error is None:
+                await set_bot_setting(f"scheduler_last_run:{name}", job.last_run.strftime('%Y-%m-%d %H:%M:%S'))
+            logger.info(f"Scheduled job {name} finished in {job.last_duration:.1f}s")
         return True
-        
-    except Exception as e:
-        logger.error(f"Error setting up scheduler: {e}")
-        return False
+
+    def status(self):
+        return [job.status() for job in self.jobs.values()]
+
+
+_scheduler = None
+
+
+def get_scheduler():
+    """The running Scheduler, or None before setup_scheduler()"""
+    return _scheduler
+
+
+def _timezone():
+    name = os.getenv("DEVDZ_TIMEZONE", "Africa/Algiers")
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        logger.warning(f"Unknown timezone {name}; scheduling in server local time")
+        return None
+
+
+def setup_scheduler(application):
+    """Create the scheduler with the bot's recurring tasks; call start() on it"""
+    global _scheduler
+    jitter = float(os.getenv("DEVDZ_SCHEDULER_JITTER", "60"))
+    scheduler = Scheduler(application, _timezone())
+    
+    # Send weekly quiz every Monday at 9 AM
+    scheduler.weekly(send_weekly_quiz, weekday=0, at=dtime(hour=9, minute=0), jitter=jitter)
+    
+    # Check for expiring subscriptions daily at 10 AM
+    scheduler.daily(check_expiring_subscriptions, at=dtime(hour=10, minute=0), jitter=jitter)
+    
+    # Remove expired users from group daily at 11 PM
+    scheduler.daily(remove_expired_users_from_group, at=dtime(hour=23, minute=0), jitter=jitter)
+    
+    # Drop stored inline-button arguments nobody can press anymore, daily at 4 AM
+    scheduler.daily(prune_callback_payloads_job, at=dtime(hour=4, minute=0), jitter=jitter)
+    
+    _scheduler = scheduler
+    logger.info("Scheduled tasks have been set up")
+    return scheduler
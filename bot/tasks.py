@@ -0,0 +1,163 @@
+"""Long admin operations run as tracked background tasks.
+
+A handler starts the work with TaskManager.start() and returns right away;
+the work gets a numeric ID, reports its progress on the BackgroundTask it is
+handed, and can be cancelled from /cancel_task. /tasks lists running tasks and
+the most recent finished ones.
+
+Tasks cancelled by an admin end with status 'cancelled' and their on_finish
+hook runs. At shutdown, stop() cancels what is still running as
+'interrupted' instead, without running on_finish, so work that checkpoints
+its progress (broadcast jobs, the expiry cleanup ledger) picks up again on
+the next start.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+KEEP_FINISHED = 20  # finished tasks still listed by /tasks
+
+RUNNING, DONE, FAILED, CANCELLED, INTERRUPTED = 'running', 'done', 'failed', 'cancelled', 'interrupted'
+
+
+class BackgroundTask:
+    """One tracked operation and its progress"""
+
+    def __init__(self, task_id, kind, title, owner_id=None):
+        self.id = task_id
+        self.kind = kind
+        self.title = title
+        self.owner_id = owner_id
+        self.status = RUNNING
+        self.done = 0
+        self.total = None
+        self.result = None
+        self.error = None
+        self.cancel_requested = False
+        self.started_at = datetime.now()
+        self.started = time.monotonic()
+        self.finished = None
+        self._task = None
+
+    def report(self, done, total=None):
+        """Progress callback for the work: `done` out of `total` items"""
+        self.done = done
+        if total is not None:
+            self.total = total
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def status_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'title': self.title,
+            'status': self.status,
+            'done': self.done,
+            'total': self.total,
+            'started_at': self.started_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'seconds': round(self.elapsed, 1),
+            'error': self.error,
+        }
+
+
+class TaskManager:
+    """Starts, tracks and cancels BackgroundTasks on the application's loop"""
+
+    def __init__(self, application, keep_finished=KEEP_FINISHED):
+        self.application = application
+        self.keep_finished = keep_finished
+        self._tasks = {}
+        self._next_id = 1
+
+    def start(self, kind, title, func, owner_id=None, on_finish=None):
+        """Run `await func(task)` in the background and return its BackgroundTask.
+
+        The value func returns is kept as task.result. `on_finish(task)` is
+        awaited once the task is done, failed or cancelled by an admin.
+        """
+        task = BackgroundTask(self._next_id, kind, title, owner_id)
+        self._next_id += 1
+        self._tasks[task.id] = task
+        task._task = self.application.create_task(self._run(task, func, on_finish))
+        logger.info(f"Started background task #{task.id} ({kind})")
+        return task
+
+    async def _run(self, task, func, on_finish):
+        try:
+            task.result = await func(task)
+            task.status = DONE
+        except asyncio.CancelledError:
+            if not task.cancel_requested:
+                # Shutting down; the work resumes from its checkpoint
+                task.status = INTERRUPTED
+                task.finished = time.monotonic()
+                raise
+            task.status = CANCELLED
+            asyncio.current_task().uncancel()
+        except Exception as e:
+            task.status = FAILED
+            task.error = str(e)
+            logger.error(f"Background task #{task.id} ({task.kind}) failed: {e}")
+        task.finished = time.monotonic()
+        logger.info(f"Background task #{task.id} ({task.kind}) {task.status} after {task.elapsed:.1f}s")
+        self._prune()
+
+        if on_finish:
+            try:
+                await on_finish(task)
+            except Exception as e:
+                logger.warning(f"Could not report the end of task #{task.id}: {e}")
+
+    def _prune(self):
+        finished = [task.id for task in self._tasks.values() if task.status != RUNNING]
+        for task_id in finished[:-self.keep_finished or None]:
+            del self._tasks[task_id]
+
+    def get(self, task_id):
+        return self._tasks.get(task_id)
+
+    def running(self, kind=None):
+        return [task for task in self._tasks.values()
+                if task.status == RUNNING and (kind is None or task.kind == kind)]
+
+    def cancel(self, task_id):
+        """Cancel a running task; False if there is no such task or it already ended"""
+        task = self._tasks.get(task_id)
+        if not task or task.status != RUNNING:
+            return False
+        task.cancel_requested = True
+        task._task.cancel()
+        logger.info(f"Cancelling background task #{task_id} ({task.kind})")
+        return True
+
+    def status(self):
+        """Running tasks first, then the finished ones, newest first"""
+        tasks = sorted(self._tasks.values(), key=lambda task: (task.status != RUNNING, -task.id))
+        return [task.status_dict() for task in tasks]
+
+    async def stop(self):
+        """Cancel running tasks for shutdown, leaving their checkpoints to resume from"""
+        pending = [task._task for task in self.running()]
+        for running_task in pending:
+            running_task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+_task_manager = None
+
+
+def get_task_manager():
+    """The TaskManager, or None before setup_task_manager()"""
+    return _task_manager
+
+
+def setup_task_manager(application):
+    global _task_manager
+    _task_manager = TaskManager(application)
+    return _task_manager
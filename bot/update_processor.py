@@ -0,0 +1,103 @@
+"""Concurrent update processing that keeps each user's updates in order.
+
+Updates from different users run in parallel, up to MAX_CONCURRENT_UPDATES at
+a time, so a long announcement or group cleanup no longer stalls everyone
+else. Updates from the same user (or chat, for updates without a user) run
+one after another in arrival order: while one is being handled, later ones
+wait in that user's queue and the running task picks them up when it is done.
+Queued updates hold no concurrency slot, so one user sending many updates
+occupies a single slot and can't starve the others.
+"""
+import collections
+import logging
+import os
+import time
+
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_UPDATES = int(os.getenv("DEVDZ_MAX_CONCURRENT_UPDATES", "16"))
+
+
+def _ordering_key(update):
+    """Updates with the same key are handled in order; None means no ordering needed"""
+    user = getattr(update, 'effective_user', None)
+    if user:
+        return ('user', user.id)
+    chat = getattr(update, 'effective_chat', None)
+    if chat:
+        return ('chat', chat.id)
+    return None
+
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """Runs updates concurrently, serialized per user/chat"""
+
+    def __init__(self, max_concurrent_updates=MAX_CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        self._queues = {}  # key -> deque of (coroutine, queued_at) behind the running update
+        self.active = 0
+        self.stats = {'processed': 0, 'queued': 0, 'max_depth': 0, 'max_wait_ms': 0.0}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        logger.info(
+            f"Update processor: {self.stats['processed']} updates, {self.stats['queued']} waited "
+            f"behind their own user, deepest queue {self.stats['max_depth']}"
+        )
+
+    async def _run(self, coroutine):
+        self.active += 1
+        try:
+            await coroutine
+        except Exception as e:
+            # Application.process_update reports handler errors itself; this
+            # only keeps one failure from dropping the rest of the queue
+            logger.error(f"Unhandled error while processing an update: {e}")
+        finally:
+            self.active -= 1
+            self.stats['processed'] += 1
+
+    async def do_process_update(self, update, coroutine):
+        key = _ordering_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+
+        queue = self._queues.get(key)
+        if queue is not None:
+            # The task handling this user's previous update runs this one next
+            queue.append((coroutine, time.monotonic()))
+            self.stats['queued'] += 1
+            self.stats['max_depth'] = max(self.stats['max_depth'], len(queue))
+            return
+
+        queue = self._queues[key] = collections.deque()
+        try:
+            await self._run(coroutine)
+            while queue:
+                coroutine, queued_at = queue.popleft()
+                waited_ms = (time.monotonic() - queued_at) * 1000
+                self.stats['max_wait_ms'] = max(self.stats['max_wait_ms'], waited_ms)
+                await self._run(coroutine)
+        finally:
+            del self._queues[key]
+            # Only left over if this task was cancelled
+            for coroutine, _ in queue:
+                coroutine.close()
+
+    def snapshot(self):
+        """Current load and totals for /update_stats"""
+        depths = [len(queue) for queue in self._queues.values()]
+        return {
+            'max_concurrent': self.max_concurrent_updates,
+            'active': self.active,
+            'waiting': sum(depths),
+            'backlogged_users': sum(1 for depth in depths if depth),
+            'deepest_queue': max(depths, default=0),
+            **self.stats,
+            'max_wait_ms': round(self.stats['max_wait_ms'], 1),
+        }
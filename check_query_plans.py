@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Fail if any public query in bot.database falls back to a full table scan.
+
+Builds a large synthetic database in a temporary directory, calls every
+public query function with sample arguments while tracing the SQL it runs,
+and checks EXPLAIN QUERY PLAN for each statement. A plain "SCAN <table>"
+(no index) is a failure unless the function is listed in FULL_SCAN_ALLOWED.
+
+Usage: python check_query_plans.py [--users 50000]
+"""
+
+import argparse
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+
+# Functions whose full scans are by design: whole-table aggregates and the
+# admin registry, which loads the handful of admins rows once.
+FULL_SCAN_ALLOWED = {
+    "get_quiz_stats",
+    "get_all_admins",
+    "is_admin",
+    "is_main_admin",
+}
+
+SCAN_RE = re.compile(r"^SCAN (\w+)(?: AS \w+)?$")
+
+
+def seed(database, users):
+    """Fill every table with enough rows for the planner to prefer indexes"""
+    rng = random.Random(42)
+    with database._pool.write() as cursor:
+        cursor.executemany("""
+            INSERT INTO users
+            (telegram_id, username, full_name, has_subscription, subscription_end, join_date, last_active)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (
+            (i, f"user{i}", f"User {i}", int(i % 5 == 0),
+             f"2026-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+             f"2025-{rng.randint(1, 12):02d}-01 10:00:00", "2026-01-01 10:00:00")
+            for i in range(1, users + 1)
+        ))
+        cursor.executemany(
+            "INSERT INTO quiz_results (telegram_id, quiz_id, score, total_questions, date) VALUES (?, ?, ?, ?, ?)",
+            ((rng.randint(1, users), rng.randint(1, 20), rng.randint(0, 5), 5, "2026-01-01") for _ in range(users)),
+        )
+        cursor.executemany("""
+            INSERT INTO payment_notifications (telegram_id, username, full_name, plan_name, amount, date, status)
+            VALUES (?, ?, ?, 'شهري', '1500 دج', ?, ?)
+        """, (
+            (i, f"user{i}", f"User {i}", "2026-01-01 10:00:00", rng.choice(("pending", "approved", "rejected")))
+            for i in range(1, users // 2)
+        ))
+        cursor.executemany(
+            "INSERT INTO referrals (referrer_id, referred_id, date) VALUES (?, ?, '2026-01-01')",
+            ((rng.randint(1, users), rng.randint(1, users)) for _ in range(users // 2)),
+        )
+        cursor.executemany(
+            "INSERT INTO admins (telegram_id, full_name, added_date) VALUES (?, 'Admin', '2026-01-01')",
+            ((i,) for i in range(1, 4)),
+        )
+        cursor.execute("ANALYZE")
+
+
+def sample_calls(database):
+    """Public query functions with sample arguments"""
+    return [
+        (database.get_user, (7,)),
+        (database.add_user, (7, "user7", "User 7")),
+        (database.update_user_subscription, (7, True, "2026-12-31")),
+        (database.is_admin, (7,)),
+        (database.get_all_admins, ()),
+        (database.is_main_admin, (7,)),
+        (database.get_bot_setting, ("admin_username",)),
+        (database.add_referral, (7, 8)),
+        (database.get_user_referrals, (7,)),
+        (database.get_referral_stats, (7,)),
+        (database.get_pending_payments, ()),
+        (database.approve_payment_notification, (9,)),
+        (database.reject_payment_notification, (11,)),
+        (database.get_linked_group, ()),
+        (database.get_quiz_results, (7,)),
+        (database.save_quiz_attempt, (7, 3, [0, 1, 2], [0, 2, 2], True)),
+        (database.get_quiz_question_stats, (3,)),
+        (database.get_quiz_stats, ()),
+        (database.check_expired_subscriptions, ()),
+        (database.claim_expired_users, ()),
+        (database.record_expiry_cleanup, (5, "2026-01-01", "removed")),
+        (database.get_pending_expiry_cleanups, ()),
+        (database.get_active_users, ()),
+        (database.get_user_stats, ()),
+        (database.get_users_expiring_soon, (3,)),
+        (database.claim_due_reminders, ((7, 3, 1),)),
+        (database.record_reminder, (5, "2026-01-01", 3, "sent")),
+        (database.get_all_active_users, ()),
+        (database.has_completed_quiz, (7, 1)),
+        (database.extend_subscription, (7, 10)),
+        (database.get_recent_users, (10,)),
+        (database.get_expired_users, (10,)),
+        (database.get_payment_notification_by_user_id, (13,)),
+        (database.get_pending_payment, (13,)),
+        (database.approve_payment_notification_by_id, (13,)),
+        (database.cleanup_old_payments, (30,)),
+        (database.get_payment_history, (50,)),
+        (database.get_user_payment_history, (7,)),
+        (database.remove_user, (15,)),
+        (database.mark_user_unreachable, (21,)),
+        (database.get_unreachable_users, ([1, 2, 21],)),
+        (database.get_blocked_users_count, ()),
+        (database.create_broadcast_job, ("announcement", "text")),
+        (database.claim_broadcast_recipients, (1, 500)),
+        (database.get_pending_deliveries, (1, 0, 500)),
+        (database.record_delivery, (1, 5, "sent")),
+        (database.get_broadcast_job, (1,)),
+        (database.get_latest_broadcast_job, ("weekly_quiz",)),
+        (database.get_unfinished_broadcast_jobs, ()),
+        (database.finish_broadcast_job, (1,)),
+        (database.save_persistence, ([("user", "7", b"data"), ("user", "8", None)],)),
+        (database.load_persistence, ("user",)),
+        (database.store_callback_payload, ("manage_user", [7])),
+        (database.get_callback_payload, (1, "manage_user")),
+        (database.prune_callback_payloads, (30,)),
+    ]
+
+
+def full_scans(explain, statement):
+    """Return tables a statement reads without any index"""
+    if not re.match(r"\s*(SELECT|UPDATE|DELETE)\b", statement, re.IGNORECASE):
+        return []
+    plan = explain.execute(f"EXPLAIN QUERY PLAN {statement}").fetchall()
+    return [match.group(1) for *_, detail in plan if (match := SCAN_RE.match(detail))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=50_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "plans.db")
+        os.environ["DEVDZ_DB_PATH"] = path
+        from bot import database
+
+        database.create_tables()
+        database.set_user_cache_enabled(False)  # every call must reach SQLite
+        seed(database, args.users)
+        explain = sqlite3.connect(path)
+
+        failures = []
+        for func, call_args in sample_calls(database):
+            statements = []
+            database._pool.set_trace_callback(statements.append)
+            try:
+                func(*call_args)
+            finally:
+                database._pool.set_trace_callback(None)
+
+            for statement in statements:
+                tables = full_scans(explain, statement)
+                if tables and func.__name__ not in FULL_SCAN_ALLOWED:
+                    failures.append((func.__name__, tables, " ".join(statement.split())))
+
+        explain.close()
+
+    if failures:
+        print("❌ Full table scans found:")
+        for name, tables, statement in failures:
+            print(f"• {name}: SCAN {', '.join(tables)}\n    {statement}")
+        sys.exit(1)
+
+    print("✅ Every public query uses an index")
+
+
+if __name__ == "__main__":
+    main()
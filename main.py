@@ -3,7 +3,14 @@ import asyncio
 from dotenv import load_dotenv
 from telegram.ext import Application
 from bot.database import create_tables, migrate_database
+from bot import async_database
+from bot.broadcast import resume_jobs
+from bot.scheduler import setup_scheduler
 from bot.handlers import register_handlers
+from bot.quizzes import load_quizzes
+from bot.persistence import SQLitePersistence
+from bot.update_processor import OrderedUpdateProcessor
+from bot.tasks import setup_task_manager
 import logging
 import signal
 
@@ -37,9 +44,21 @@ async def main():
         
         # Create/update tables
         create_tables()
+        
+        # Parse the quiz files once; later edits are picked up without a restart
+        logger.info(f"Loaded {load_quizzes()} quizzes")
 
         # Create application WITHOUT job queue to avoid weak reference issue
-        app = Application.builder().token(token).job_queue(None).build()
+        app = (
+            Application.builder().token(token).job_queue(None)
+            .persistence(SQLitePersistence())
+            # Different users' updates run in parallel, each user's in order
+            .concurrent_updates(OrderedUpdateProcessor())
+            .build()
+        )
+        
+        # Long admin operations (cleanup, announcements) run as tracked tasks
+        task_manager = setup_task_manager(app)
         
         # Register all handlers
         register_handlers(app)
@@ -52,6 +71,13 @@ async def main():
         await app.start()
         await app.updater.start_polling(drop_pending_updates=True)
         
+        # Pick up announcements interrupted by the last shutdown
+        await resume_jobs(app)
+        
+        # Start the recurring tasks (weekly quiz, reminders, group cleanup)
+        scheduler = setup_scheduler(app)
+        await scheduler.start()
+        
         # Set up signal handlers for graceful shutdown
         signal.signal(signal.SIGINT, signal_handler)
         signal.signal(signal.SIGTERM, signal_handler)
@@ -69,9 +95,14 @@ async def main():
         try:
             if 'app' in locals():
                 print("Shutting down bot...")
+                if 'scheduler' in locals():
+                    await scheduler.stop()
+                if 'task_manager' in locals():
+                    await task_manager.stop()
                 await app.updater.stop()
                 await app.stop()
                 await app.shutdown()
+                async_database.shutdown()
                 print("Bot shutdown complete.")
         except Exception as e:
             logger.error(f"Error during shutdown: {e}")
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+Apply pending database schema migrations.
+
+With --dry-run every pending step runs inside a transaction that is rolled
+back, so the printed timings and row counts show what a real run would cost
+on this database without changing it.
+
+Usage: python migrate.py [--dry-run]
+"""
+
+import argparse
+from dotenv import load_dotenv
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="measure pending steps without committing them")
+    args = parser.parse_args()
+
+    # Imported after load_dotenv() so DEVDZ_DB_* from .env are honoured
+    from bot import database, migrations
+
+    print(f"🗄️ {database.DB_PATH} (latest schema v{migrations.latest_version()})")
+    report = database.migrate_database(dry_run=args.dry_run)
+
+    if not report['steps']:
+        print(f"✅ Schema v{report['to_version']} is up to date")
+    elif args.dry_run:
+        print("ℹ️ Dry run: nothing was changed")
+    else:
+        print(f"✅ Schema upgraded to v{report['to_version']}")
+
+if __name__ == "__main__":
+    main()
@@ -27,6 +27,7 @@ def main():
         print(f"✅ تم إضافة {full_name} كأدمن بنجاح!")
         print(f"🆔 معرف التليجرام: {telegram_id}")
         print("\nيمكنك الآن استخدام /start في البوت لرؤية لوحة تحكم الأدمن.")
+        print("إذا كان البوت يعمل الآن، أرسل /reload_admins من حساب مشرف آخر أو أعد تشغيله.")
         
     except ValueError:
         print("❌ معرف التليجرام يجب أن يكون رقماً")